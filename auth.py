@@ -1,5 +1,9 @@
 import os
 import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
 from jose import jwt
@@ -9,6 +13,18 @@ from urllib.request import urlopen
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = os.environ.get('ALGORITHMS')
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
+# seconds a fetched JWKS document is considered fresh
+JWKS_TTL = float(os.environ.get('JWKS_TTL', 600))
+# minimum seconds between two refreshes triggered by an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = float(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+# seconds to wait for Auth0 before giving up on a refresh
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+# number of verified tokens kept in memory, 0 disables the cache
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+# seconds a token that failed verification is remembered
+TOKEN_CACHE_NEGATIVE_TTL = float(
+    os.environ.get('TOKEN_CACHE_NEGATIVE_TTL', 10))
 
 
 class AuthError(Exception):
@@ -60,11 +76,142 @@ def check_permissions(permission, payload):
     return True
 
 
-def verify_decode_jwt(token):
-    # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+class JWKSCache:
+    """Per-process store of the Auth0 signing keys.
+
+    The JWKS document is fetched once and reused for `ttl` seconds. An
+    unknown kid forces a refresh, but never more often than
+    `min_refresh_interval`, so a stream of forged tokens cannot turn into
+    a stream of requests to Auth0. When the document is stale it is
+    refreshed in a background thread and the last good keys keep being
+    served, also when Auth0 is slow or down. Without any keys yet a
+    failed fetch is retried at most every `min_refresh_interval` too, the
+    requests in between fail right away.
+    """
+
+    def __init__(self, url=None, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        # held by the synchronous fetches, concurrent callers wait for the
+        # running one instead of starting their own
+        self._fetch_lock = threading.Lock()
+        self._refreshing = False
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def _url(self):
+        return self.url or f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+
+    def _fetch(self):
+        jsonurl = urlopen(self._url(), timeout=self.timeout)
+        return json.loads(jsonurl.read())
+
+    def refresh(self):
+        """Fetch the JWKS document and replace the stored keys.
+
+        Returns True on success. On failure the previous keys are kept.
+        """
+        self._last_attempt = time.monotonic()
+        try:
+            self.load(self._fetch())
+        except Exception:
+            self.refresh_failures += 1
+            return False
+        self.refreshes += 1
+        return True
+
+    def load(self, jwks):
+        """Replace the stored keys with the ones of a JWKS document."""
+        keys = {key['kid']: key for key in jwks['keys']}
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+
+    def refresh_async(self):
+        """Refresh in a daemon thread unless a refresh is running."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def refresh_throttled(self):
+        """Refresh now unless a fetch was attempted less than
+        `min_refresh_interval` ago, return True on success."""
+        with self._fetch_lock:
+            if not self._may_refresh():
+                return False
+            return self.refresh()
+
+    def prefetch(self):
+        """Fetch the keys now unless they were already loaded."""
+        if self._fetched_at is None:
+            self.refresh()
+
+    def _is_stale(self):
+        return (self._fetched_at is None or
+                time.monotonic() - self._fetched_at > self.ttl)
+
+    def _may_refresh(self):
+        return (self._last_attempt is None or
+                time.monotonic() - self._last_attempt >=
+                self.min_refresh_interval)
+
+    def get_key(self, kid):
+        """Return the JWK for `kid` or None if Auth0 doesn't know it."""
+        if self._fetched_at is None:
+            # nothing to serve yet, the first fetch has to block, a failed
+            # one is retried at most every min_refresh_interval
+            if not self.refresh_throttled() and self._fetched_at is None:
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch the signing keys.'
+                }, 503)
+        elif self._is_stale() and self._may_refresh():
+            self.refresh_async()
+
+        key = self._keys.get(kid)
+        if key is not None:
+            self.hits += 1
+            return key
+
+        self.misses += 1
+        if self.refresh_throttled():
+            return self._keys.get(kid)
+        return None
+
+    def stats(self):
+        return {
+            'keys': len(self._keys),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'refresh_failures': self.refresh_failures,
+            'age': (None if self._fetched_at is None
+                    else time.monotonic() - self._fetched_at)
+        }
+
 
+jwks_cache = JWKSCache(url=os.environ.get('JWKS_URL'))
+
+
+def verify_decode_jwt(token):
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
 
@@ -76,15 +223,16 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # GET THE PUBLIC KEY FROM THE CACHED AUTH0 JWKS
+    key = jwks_cache.get_key(unverified_header['kid'])
+    if key is not None:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
 
     # Finally, verify!!!
     if rsa_key:
@@ -123,13 +271,105 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+class TokenCache:
+    """Bounded LRU of already verified bearer tokens.
+
+    Entries are keyed by the SHA-256 of the token so raw credentials are
+    not kept in memory. A verified payload lives until the token's `exp`
+    claim, a verification failure is remembered for `negative_ttl`
+    seconds and raised again without running the RS256 check.
+    """
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE,
+                 negative_ttl=TOKEN_CACHE_NEGATIVE_TTL):
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _set(self, key, expires_at, value, failed):
+        with self._lock:
+            self._entries[key] = (expires_at, value, failed)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def verify(self, token, verify=None):
+        """Return the payload of `token`, verifying it on a miss."""
+        verify = verify or verify_decode_jwt
+        if self.maxsize <= 0:
+            return verify(token)
+
+        key = self._key(token)
+        entry = self._get(key)
+        if entry is not None:
+            self.hits += 1
+            expires_at, value, failed = entry
+            if failed:
+                raise AuthError(dict(value[0]), value[1])
+            return value
+
+        self.misses += 1
+        try:
+            payload = verify(token)
+        except AuthError as error:
+            self._set(key, time.time() + self.negative_ttl,
+                      (dict(error.error), error.status_code), True)
+            raise
+        # a token without exp is never cached
+        if isinstance(payload.get('exp'), (int, float)):
+            self._set(key, payload['exp'], payload, False)
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+token_cache = TokenCache()
+
+
+# functions called with the seconds spent authenticating a request
+auth_listeners = []
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            started = time.perf_counter()
+            try:
+                token = get_token_auth_header()
+                payload = token_cache.verify(token)
+                check_permissions(permission, payload)
+            finally:
+                for listener in auth_listeners:
+                    listener(time.perf_counter() - started)
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,229 @@
+"""Throughput and latency of every endpoint on a synthetic catalog.
+
+    python -m benchmarks.bench_api --output results/sqlite.json
+    python -m benchmarks.bench_api --database-url postgresql:///bench \\
+        --actors 100000 --movies 50000 --output results/postgres.json
+
+The tables of the database are dropped and created again, then filled by
+`benchmarks.catalog`. Tokens are minted by `benchmarks.local_auth` and
+checked against its JWKS document served over HTTP, so `auth.py` runs
+like in production without Auth0. Each scenario sends `--warmup`
+untimed requests, then `--requests` timed ones through the Flask test
+client. Reads run first, then writes, then deletes. The JSON report
+holds the commit, the database and the catalog, so two runs can be
+compared.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+from benchmarks import local_auth
+
+
+def percentile(timings, fraction):
+    return timings[min(int(len(timings) * fraction), len(timings) - 1)]
+
+
+def run(client, headers, requests, expected):
+    """Send `requests` of (method, path, body), return their statistics."""
+    timings = []
+    errors = 0
+    received = 0
+    for method, path, body in requests:
+        start = time.perf_counter()
+        res = client.open(path, method=method, headers=headers, json=body)
+        data = res.get_data()
+        timings.append(time.perf_counter() - start)
+        received += len(data)
+        if res.status_code not in expected:
+            errors += 1
+    timings.sort()
+    return {
+        'requests': len(timings),
+        'errors': errors,
+        'requests_per_second': round(len(timings) / sum(timings), 1),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'p50_ms': round(percentile(timings, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(timings, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 3),
+        'bytes_received': received
+    }
+
+
+def scenarios(catalog, created, count, warmup, rng):
+    """Yield (name, expected statuses, warm-up, requests) in execution
+    order.
+
+    `created` holds {'actors': ids, 'movies': ids} inserted for the
+    delete scenarios. Scenarios send `warmup` + `count` requests, the
+    heavy ones (whole table streams, bulk inserts) one + count / 10.
+    """
+    from flaskr.pagination import encode_cursor
+    actors, movies = catalog['actors'], catalog['movies']
+    run_id = int(time.time())
+
+    heavy = max(1, count // 10)
+
+    def repeat(make):
+        return warmup, [make(i) for i in range(warmup + count)]
+
+    def page_after(ids):
+        return encode_cursor(rng.choice(ids) - 1)
+
+    yield 'GET /metrics', (200,), *repeat(
+        lambda i: ('GET', '/metrics', None))
+    yield 'GET /actors', (200,), *repeat(
+        lambda i: ('GET', f'/actors?after={page_after(actors)}', None))
+    yield 'GET /actors?view=short', (200,), *repeat(
+        lambda i: ('GET', '/actors?view=short&limit=100'
+                   f'&after={page_after(actors)}', None))
+    yield 'GET /actors?age_min=&gender=', (200,), *repeat(
+        lambda i: ('GET', f'/actors?age_min={rng.randint(18, 80)}'
+                   f'&gender=Female&after={page_after(actors)}', None))
+    yield 'GET /actors/<id>', (200,), *repeat(
+        lambda i: ('GET', f'/actors/{rng.choice(actors)}', None))
+    yield 'GET /actors/<id>/costars', (200,), *repeat(
+        lambda i: ('GET', f'/actors/{rng.choice(actors)}/costars', None))
+    yield 'GET /actors/<a>/path/<b>', (200,), *repeat(
+        lambda i: ('GET', f'/actors/{rng.choice(actors)}/path/'
+                   f'{rng.choice(actors)}', None))
+    yield 'GET /movies', (200,), *repeat(
+        lambda i: ('GET', f'/movies?after={page_after(movies)}', None))
+    yield 'GET /movies/<id>', (200,), *repeat(
+        lambda i: ('GET', f'/movies/{rng.choice(movies)}', None))
+    yield 'GET /movies?actor_id=', (200,), *repeat(
+        lambda i: ('GET', f'/movies?actor_id={rng.choice(actors)}', None))
+    yield 'GET /movies?release_date_from=', (200,), *repeat(
+        lambda i: ('GET', '/movies?view=short&release_date_from='
+                   f'{rng.randint(1970, 2024)}-01-01', None))
+    yield 'GET /movies?stream=true', (200,), 1, [
+        ('GET', '/movies?stream=true&fields=id,title', None)
+        for _ in range(1 + heavy)]
+    yield 'GET /search/suggest', (200,), *repeat(
+        lambda i: ('GET', '/search/suggest?q=' + rng.choice(
+            ['b', 'br', 'zo', 'mül', 'garc', 'night', 'st', 'gold']),
+            None))
+    yield 'POST /actors', (200,), *repeat(
+        lambda i: ('POST', '/actors', {
+            'name': f'bench actor {run_id}-{i}', 'age': 30,
+            'gender': 'Female', 'movies': []}))
+    yield 'POST /movies', (200,), *repeat(
+        lambda i: ('POST', '/movies', {
+            'title': f'bench movie {run_id}-{i}',
+            'release_date': '2020-01-01', 'actors': []}))
+    yield 'POST /actors/bulk', (200,), 1, [
+        ('POST', '/actors/bulk', [{
+            'name': f'bench bulk actor {run_id}-{i}-{j}', 'age': 40,
+            'movies': [{'title': f'bench bulk movie {run_id}-{i}-{j}',
+                        'release_date': '2021-01-01'}]
+        } for j in range(100)]) for i in range(1 + heavy)]
+    yield 'POST /movies/bulk', (200,), 1, [
+        ('POST', '/movies/bulk', [{
+            'title': f'bench bulk movie {run_id}-{i}-{j}-m',
+            'release_date': '2021-01-01',
+            'actors': [{'name': f'bench bulk actor {run_id}-{i}-{j}-m',
+                        'age': 40}]
+        } for j in range(100)]) for i in range(1 + heavy)]
+    yield 'PATCH /actors/<id>', (200,), *repeat(
+        lambda i: ('PATCH', f'/actors/{rng.choice(actors)}',
+                   {'age': rng.randint(18, 90)}))
+    yield 'PATCH /movies/<id>', (200,), *repeat(
+        lambda i: ('PATCH', f'/movies/{rng.choice(movies)}',
+                   {'release_date': '2019-06-01'}))
+    yield 'DELETE /actors/<id>', (200,), warmup, [
+        ('DELETE', f'/actors/{id}', None) for id in created['actors']]
+    yield 'DELETE /movies/<id>', (200,), warmup, [
+        ('DELETE', f'/movies/{id}', None) for id in created['movies']]
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--database-url',
+                        default='sqlite:////tmp/bench_api.sqlite3')
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=5000)
+    parser.add_argument('--roles-per-actor', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--response-cache', default='memory',
+                        choices=('memory', 'sqlite', 'none'))
+    parser.add_argument('--only', action='append',
+                        help='run only the scenarios starting with this')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='JSON report path, default stdout')
+    args = parser.parse_args(argv)
+
+    # models reads the database URL when it is imported
+    os.environ['DATABASE_URL'] = args.database_url
+    from flaskr import create_app
+    from models import db
+    from benchmarks import catalog as catalog_module
+
+    app = create_app({'RESPONSE_CACHE': args.response_cache})
+    local_auth.install(local_auth.serve_jwks())
+    headers = {'Authorization': f'Bearer {local_auth.mint_token()}'}
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        start = time.perf_counter()
+        catalog = catalog_module.generate(args.actors, args.movies,
+                                          args.roles_per_actor, args.seed)
+        load_seconds = time.perf_counter() - start
+        # rows removed by the delete scenarios
+        count = args.requests + args.warmup
+        created = catalog_module.generate(count, count, 1, args.seed + 1)
+        db.session.remove()
+    client = app.test_client()
+
+    rng = random.Random(args.seed)
+    results = {}
+    for name, expected, warmup, requests in scenarios(
+            catalog, created, args.requests, args.warmup, rng):
+        if args.only and not any(name.startswith(prefix)
+                                 for prefix in args.only):
+            continue
+        run(client, headers, requests[:warmup], expected)
+        results[name] = run(client, headers, requests[warmup:], expected)
+        print(f'{name}: {results[name]["requests_per_second"]} req/s',
+              file=sys.stderr)
+
+    report = {
+        'commit': commit(),
+        'database': args.database_url.split(':', 1)[0],
+        'python': platform.python_version(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'catalog': {
+            'actors': len(catalog['actors']),
+            'movies': len(catalog['movies']),
+            'roles': catalog['roles'],
+            'load_seconds': round(load_seconds, 2)
+        },
+        'response_cache': args.response_cache,
+        'scenarios': results
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+            output.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""Sync workers (wsgi:app) against gevent workers (wsgi_async:app).
+
+    python -m benchmarks.bench_async --database-url postgresql:///bench
+
+Starts gunicorn for each mode with the same number of worker processes
+on a synthetic catalog, then keeps `--concurrency` keep-alive clients
+busy on a mix of list, filter and search requests for `--seconds`. The
+response cache is disabled so every request reaches the database. The
+report gives the throughput, the latencies and the resident memory of
+the workers, idle and under load, divided by the number of concurrent
+connections. `--db-latency-ms` puts a delaying TCP proxy between the
+workers and the database, to model a database on another host.
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import argparse
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlsplit
+from sqlalchemy.engine.url import make_url
+from benchmarks import local_auth
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def worker_pids(master):
+    with open(f'/proc/{master}/task/{master}/children') as children:
+        return [int(pid) for pid in children.read().split()]
+
+
+def rss(pids):
+    """Resident memory of `pids` in bytes (Linux)."""
+    total = 0
+    for pid in pids:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+    return total
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/metrics')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not start')
+
+
+def client(port, headers, paths, deadline, timings, errors, seed):
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request('GET', rng.choice(paths), headers=headers)
+            res = conn.getresponse()
+            res.read()
+            if res.status != 200:
+                errors.append(res.status)
+        except (OSError, http.client.HTTPException) as error:
+            errors.append(type(error).__name__)
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        timings.append(time.perf_counter() - start)
+    conn.close()
+
+
+def load(port, headers, paths, concurrency, seconds):
+    timings, errors = [], []
+    deadline = time.monotonic() + seconds
+    threads = [threading.Thread(target=client, args=(
+        port, headers, paths, deadline, timings, errors, i))
+        for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    return threads, timings, errors
+
+
+class LatencyProxy:
+    """TCP proxy to the database that delays every chunk it forwards.
+
+    Each direction waits `latency / 2`, so a query round trip takes
+    `latency` longer, like a database on another host.
+    """
+
+    def __init__(self, target, latency):
+        self.target = target
+        self.latency = latency
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(128)
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def connect(self):
+        if isinstance(self.target, str):
+            upstream = socket.socket(socket.AF_UNIX)
+        else:
+            upstream = socket.socket()
+        upstream.connect(self.target)
+        return upstream
+
+    def accept(self):
+        while True:
+            downstream, _ = self.server.accept()
+            try:
+                upstream = self.connect()
+            except OSError:
+                downstream.close()
+                continue
+            for source, sink in ((downstream, upstream),
+                                 (upstream, downstream)):
+                threading.Thread(target=self.pipe, args=(source, sink),
+                                 daemon=True).start()
+
+    def pipe(self, source, sink):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                time.sleep(self.latency / 2)
+                sink.sendall(data)
+        except OSError:
+            pass
+        finally:
+            sink.close()
+
+
+def proxied(database_url, latency):
+    """Start a LatencyProxy to `database_url`, return the URL through it."""
+    url = make_url(database_url)
+    host = url.query.get('host') or url.host or \
+        os.environ.get('PGHOST', '/var/run/postgresql')
+    port = url.port or 5432
+    target = f'{host}/.s.PGSQL.{port}' if host.startswith('/') \
+        else (host, port)
+    proxy = LatencyProxy(target, latency)
+    url.host, url.port = '127.0.0.1', proxy.port
+    url.query = {key: value for key, value in url.query.items()
+                 if key != 'host'}
+    return str(url)
+
+
+def run_mode(mode, args, env, headers, paths):
+    port = args.port
+    # gunicorn 20.0 has no __main__ module
+    command = [sys.executable, '-c',
+               'from gunicorn.app.wsgiapp import run; run()', '--bind',
+               f'127.0.0.1:{port}', '--workers', str(args.workers),
+               '--log-level', 'warning']
+    if mode == 'gevent':
+        command += ['--worker-class', 'gevent', '--worker-connections',
+                    str(max(args.concurrency, 100)), 'wsgi_async:app']
+    else:
+        command += ['wsgi:app']
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+    try:
+        wait_until_up(port)
+        # one warm-up round so every worker has its pool and mappers ready
+        threads, _, _ = load(port, headers, paths, args.concurrency, 2)
+        for thread in threads:
+            thread.join()
+        pids = worker_pids(server.pid)
+        idle = rss(pids)
+
+        threads, timings, errors = load(port, headers, paths,
+                                        args.concurrency, args.seconds)
+        time.sleep(args.seconds / 2)
+        busy = rss(pids)
+        for thread in threads:
+            thread.join()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    timings.sort()
+    return {
+        'requests': len(timings),
+        'errors': len(errors),
+        'requests_per_second': round(len(timings) / args.seconds, 1),
+        'p50_ms': round(timings[len(timings) // 2] * 1000, 2),
+        'p99_ms': round(timings[int(len(timings) * 0.99)] * 1000, 2),
+        'workers_rss_idle_mb': round(idle / 2 ** 20, 1),
+        'workers_rss_busy_mb': round(busy / 2 ** 20, 1),
+        'kb_per_connection': round(
+            max(busy - idle, 0) / args.concurrency / 1024, 1)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--db-latency-ms', type=float, default=0)
+    parser.add_argument('--port', type=int, default=8071)
+    parser.add_argument('--mode', action='append',
+                        choices=('sync', 'gevent'))
+    args = parser.parse_args(argv)
+
+    os.environ['DATABASE_URL'] = args.database_url
+    from flaskr import create_app
+    from models import db
+    from benchmarks import catalog
+
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        rows = catalog.generate(args.actors, args.movies, 5)
+        db.session.remove()
+
+    env = dict(os.environ, JWKS_URL=local_auth.serve_jwks(),
+               RESPONSE_CACHE='none', PYTHONPATH=ROOT)
+    if args.db_latency_ms:
+        env['DATABASE_URL'] = proxied(args.database_url,
+                                      args.db_latency_ms / 1000)
+    headers = {'Authorization': f'Bearer {local_auth.mint_token()}'}
+    actors = rows['actors']
+    rng = random.Random(1)
+    paths = [f'/actors?view=short&limit=20&age_min={rng.randint(18, 80)}'
+             for _ in range(50)]
+    paths += [f'/movies?actor_id={rng.choice(actors)}' for _ in range(50)]
+    paths += [f'/search/suggest?q={q}' for q in ('br', 'zo', 'gar', 'ni')]
+
+    results = {
+        'database': urlsplit(args.database_url).scheme,
+        'workers': args.workers,
+        'concurrency': args.concurrency,
+        'db_latency_ms': args.db_latency_ms
+    }
+    for mode in args.mode or ('sync', 'gevent'):
+        results[mode] = run_mode(mode, args, env, headers, paths)
+        print(f'{mode}: {results[mode]["requests_per_second"]} req/s',
+              file=sys.stderr)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
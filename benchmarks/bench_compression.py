@@ -0,0 +1,86 @@
+"""CPU time against bytes sent for gzip and brotli levels.
+
+    python -m benchmarks.bench_compression --sizes 50 500 --link-mbps 2
+
+Loads a synthetic catalog into SQLite and encodes GET /movies pages of
+each size (the long view, through the JSON provider) at every level,
+reporting the best of `--repeat` compression times, the encoded size and
+the time the body takes on a `--link-mbps` link, compression included.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+
+LEVELS = {'gzip': (1, 4, 6, 9), 'br': (1, 4, 6, 9, 11)}
+
+
+def best(f, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url',
+                        default='sqlite:////tmp/bench_compression.sqlite3')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 500])
+    parser.add_argument('--link-mbps', type=float, default=2)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    os.environ['DATABASE_URL'] = args.database_url
+    from flaskr import create_app
+    from flaskr.compression import ResponseCompressor, brotli
+    from models import db, Movie
+    from benchmarks import catalog
+
+    app = create_app()
+    provider = app.extensions['json_provider']
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        movies = max(args.sizes)
+        catalog.generate(movies * 2, movies, 5)
+        items = Movie.long_many(Movie.query.order_by(Movie.id)
+                                .limit(movies).all())
+        db.session.remove()
+
+    def transfer_ms(size, seconds=0.0):
+        return round((seconds + size * 8 / (args.link_mbps * 1e6)) * 1000, 1)
+
+    results = {'link_mbps': args.link_mbps}
+    for size in args.sizes:
+        with app.app_context():
+            body = provider.dumps({'success': True, 'movies': items[:size],
+                                   'next': None})
+        rows = {'identity': {'bytes': len(body),
+                             'transfer_ms': transfer_ms(len(body))}}
+        for encoding, levels in LEVELS.items():
+            if encoding == 'br' and brotli is None:
+                continue
+            for level in levels:
+                compressor = ResponseCompressor(
+                    [encoding], gzip_level=level, brotli_level=level)
+                encoded = compressor.compress(body, encoding)
+                seconds = best(lambda: compressor.compress(body, encoding),
+                               args.repeat)
+                rows[f'{encoding}-{level}'] = {
+                    'bytes': len(encoded),
+                    'ratio': round(len(encoded) / len(body), 3),
+                    'cpu_ms': round(seconds * 1000, 2),
+                    'transfer_ms': transfer_ms(len(encoded), seconds)
+                }
+        results[size] = rows
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
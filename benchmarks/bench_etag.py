@@ -0,0 +1,86 @@
+"""Polling workload with and without conditional GET.
+
+    python -m benchmarks.bench_etag --actors 500 --polls 200
+
+A client polls GET /movies and GET /actors. The plain client downloads
+the whole page every time, the conditional client sends the ETag of its
+last response back in If-None-Match.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+from benchmarks import local_auth
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from flaskr import create_app
+from models import db, Actor, Movie
+
+
+def populate(actors, movies_per_actor):
+    movies = [Movie(title=f'movie {i}',
+                    release_date=datetime.date(2000 + i % 20, 1, 1))
+              for i in range(actors)]
+    for i in range(actors):
+        actor = Actor(name=f'actor {i}', age=20 + i % 50, gender='F')
+        for j in range(movies_per_actor):
+            actor.movies.append(movies[(i + j) % actors])
+        db.session.add(actor)
+    db.session.commit()
+
+
+def poll(client, headers, polls, conditional):
+    etags = {}
+    timings = []
+    sent = 0
+    for i in range(polls):
+        path = '/movies' if i % 2 else '/actors'
+        request_headers = dict(headers)
+        if conditional and path in etags:
+            request_headers['If-None-Match'] = etags[path]
+        start = time.perf_counter()
+        res = client.get(path, headers=request_headers)
+        timings.append(time.perf_counter() - start)
+        assert res.status_code in (200, 304), res.status_code
+        etags[path] = res.headers.get('ETag')
+        sent += len(res.data)
+    timings.sort()
+    return {
+        'requests': polls,
+        'requests_per_second': round(polls / sum(timings), 1),
+        'p50_ms': round(timings[len(timings) // 2] * 1000, 3),
+        'p99_ms': round(timings[int(len(timings) * 0.99)] * 1000, 3),
+        'bytes_sent': sent
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--actors', type=int, default=500)
+    parser.add_argument('--movies-per-actor', type=int, default=5)
+    parser.add_argument('--polls', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    app = create_app({'DEFAULT_PAGE_SIZE': args.actors})
+    local_auth.install()
+    headers = {'Authorization': f'Bearer {local_auth.mint_token()}'}
+    with app.app_context():
+        db.create_all()
+        populate(args.actors, args.movies_per_actor)
+    client = app.test_client()
+
+    results = {
+        'actors': args.actors,
+        'movies_per_actor': args.movies_per_actor,
+        'plain': poll(client, headers, args.polls, False),
+        'conditional': poll(client, headers, args.polls, True)
+    }
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Latency of the first requests after a deploy, with and without
+gunicorn.conf.py.
+
+    python -m benchmarks.bench_first_request --database-url postgresql:///bench
+
+Starts gunicorn twice on the same catalog. The first run uses an empty
+config file, which gives the plain `gunicorn wsgi:app` of the old
+Procfile. The second run uses the checked-in gunicorn.conf.py
+(preloading, post_fork, warm-up). Both runs use the same worker count.
+For each run the report gives the seconds until the port answers, then
+the latency of the first requests on fresh connections, which land on
+cold workers, and of later ones.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import tempfile
+import subprocess
+import http.client
+from urllib.parse import urlsplit
+from benchmarks import local_auth
+from benchmarks.bench_async import ROOT
+
+
+def get(port, path, headers):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    start = time.perf_counter()
+    conn.request('GET', path, headers=headers)
+    res = conn.getresponse()
+    res.read()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return res.status, elapsed
+
+
+def run(config, args, env, headers):
+    command = [sys.executable, '-c',
+               'from gunicorn.app.wsgiapp import run; run()',
+               '--config', config, '--bind', f'127.0.0.1:{args.port}',
+               '--workers', str(args.workers), '--log-level', 'warning',
+               'wsgi:app']
+    started = time.perf_counter()
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+    try:
+        while True:
+            try:
+                status, first = get(args.port, args.path, headers)
+                break
+            except OSError:
+                if time.perf_counter() - started > 60:
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.05)
+        ready = time.perf_counter() - started - first
+        timings = [first] + [get(args.port, args.path, headers)[1]
+                             for _ in range(args.requests - 1)]
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    cold = timings[:args.workers]
+    warm = sorted(timings[args.workers:])
+    return {
+        'status': status,
+        'seconds_until_serving': round(ready, 2),
+        'first_request_ms': round(first * 1000, 1),
+        'slowest_of_first_per_worker_ms': round(max(cold) * 1000, 1),
+        'steady_p50_ms': round(warm[len(warm) // 2] * 1000, 1)
+        if warm else None
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--path', default='/actors')
+    parser.add_argument('--port', type=int, default=8072)
+    args = parser.parse_args(argv)
+
+    os.environ['DATABASE_URL'] = args.database_url
+    from flaskr import create_app
+    from models import db
+    from benchmarks import catalog
+
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        catalog.generate(args.actors, args.movies, 5)
+        db.session.remove()
+
+    # the workers fetch the keys over HTTP, like from Auth0
+    env = dict(os.environ, JWKS_URL=local_auth.serve_jwks(),
+               RESPONSE_CACHE='none', PYTHONPATH=ROOT)
+    headers = {'Authorization': f'Bearer {local_auth.mint_token()}'}
+    with tempfile.NamedTemporaryFile(suffix='.py') as empty:
+        results = {
+            'database': urlsplit(args.database_url).scheme,
+            'workers': args.workers,
+            'path': args.path,
+            'plain': run(empty.name, args, env, headers),
+            'gunicorn.conf.py': run(os.path.join(ROOT, 'gunicorn.conf.py'),
+                                    args, env, headers)
+        }
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
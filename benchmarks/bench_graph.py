@@ -0,0 +1,93 @@
+"""Latency and memory of the co-star graph.
+
+    python -m benchmarks.bench_graph --actors 1000000 --movies 200000
+
+Builds a RolesGraph where every actor plays in `--roles-per-actor` movies
+on average, picked with a skew so some movies have large casts, then
+times co-star lookups and shortest paths between random actors, plus
+incremental link writes.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+from array import array
+from flaskr.graph import RolesGraph
+
+
+def links(actors, movies, roles_per_actor, rng):
+    for actor_id in range(1, actors + 1):
+        count = rng.randint(0, 2 * roles_per_actor)
+        # squaring skews the picks towards the first movies
+        for movie_id in {1 + int(movies * rng.random() ** 2)
+                         for _ in range(count)}:
+            yield movie_id, actor_id
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return {
+        'p50_us': round(timings[len(timings) // 2] * 1e6, 1),
+        'p99_us': round(timings[int(len(timings) * 0.99)] * 1e6, 1)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--actors', type=int, default=1000000)
+    parser.add_argument('--movies', type=int, default=200000)
+    parser.add_argument('--roles-per-actor', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+
+    movie_ids, actor_ids = array('I'), array('I')
+    for movie_id, actor_id in links(args.actors, args.movies,
+                                    args.roles_per_actor, rng):
+        movie_ids.append(movie_id)
+        actor_ids.append(actor_id)
+    graph = RolesGraph()
+    start = time.perf_counter()
+    graph.load(zip(movie_ids, actor_ids))
+    build_seconds = time.perf_counter() - start
+    del movie_ids, actor_ids
+
+    pairs = [(rng.randint(1, args.actors), rng.randint(1, args.actors))
+             for _ in range(args.queries)]
+    costars, paths, degrees = [], [], {}
+    for source, target in pairs:
+        start = time.perf_counter()
+        graph.costars(source, 50)
+        costars.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        path = graph.path(source, target)
+        paths.append(time.perf_counter() - start)
+        key = len(path) // 2 if path else None
+        degrees[key] = degrees.get(key, 0) + 1
+
+    writes = []
+    for i in range(1000):
+        movie_id, actor_id = rng.randint(1, args.movies), i + 1
+        start = time.perf_counter()
+        graph.add(movie_id, actor_id)
+        graph.remove(movie_id, actor_id)
+        writes.append(time.perf_counter() - start)
+
+    json.dump({
+        'actors': args.actors,
+        'movies': args.movies,
+        'edges': len(graph),
+        'build_seconds': round(build_seconds, 2),
+        'memory_mb': round(graph.memory() / 2 ** 20, 1),
+        'costars': percentiles(costars),
+        'path': percentiles(paths),
+        'degrees': {str(key): count for key, count in degrees.items()},
+        'add_and_remove': percentiles(writes)
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
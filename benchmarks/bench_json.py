@@ -0,0 +1,77 @@
+"""Serialization time of Movie.long() lists, stdlib json against orjson.
+
+    python -m benchmarks.bench_json --sizes 50 500 5000
+
+Loads a synthetic catalog into SQLite, reads the first movies with
+Movie.long_many (the rows of GET /movies) and times both JSON providers
+on lists of each size, reporting the best of `--repeat` runs. The two
+outputs are compared byte for byte first. Run it with JSON_AS_ASCII=false
+to see the cost of escaping the non-ASCII names.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+
+def best(f, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url',
+                        default='sqlite:////tmp/bench_json.sqlite3')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[50, 500, 5000])
+    parser.add_argument('--roles-per-actor', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    os.environ['DATABASE_URL'] = args.database_url
+    from flaskr import create_app
+    from flaskr.jsonprovider import StdlibProvider, make_provider, orjson
+    from models import db, Movie
+    from benchmarks import catalog
+
+    if orjson is None:
+        sys.exit('orjson is not installed')
+    app = create_app()
+    results = {}
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        movies = max(args.sizes)
+        catalog.generate(movies * 2, movies, args.roles_per_actor)
+        items = Movie.long_many(Movie.query.order_by(Movie.id)
+                                .limit(movies).all())
+        db.session.remove()
+
+        providers = (StdlibProvider(),
+                     make_provider(dict(app.config, JSON_PROVIDER='orjson')))
+        for size in args.sizes:
+            document = {'success': True, 'movies': items[:size],
+                        'next': None}
+            outputs = [provider.dumps(document) for provider in providers]
+            if outputs[0] != outputs[1]:
+                sys.exit(f'outputs differ for {size} movies')
+            stdlib, fast = (best(lambda: provider.dumps(document),
+                                 args.repeat) for provider in providers)
+            results[size] = {
+                'bytes': len(outputs[0]),
+                'stdlib_ms': round(stdlib * 1000, 3),
+                'orjson_ms': round(fast * 1000, 3),
+                'speedup': round(stdlib / fast, 1)
+            }
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Lookup timings on roles with and without its primary key and index.
+
+    python -m benchmarks.bench_roles --links 1000000
+    python -m benchmarks.bench_roles --database-url postgresql:///bench
+
+Two copies of the association table are loaded with the same links:
+`roles_plain` has the original shape (no key, no index), `roles_keyed`
+has the composite primary key (movie_id, actor_id) and the index on
+actor_id. Each lookup is timed on both.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import sqlalchemy as sa
+
+
+def create_tables(engine, metadata):
+    plain = sa.Table('roles_plain', metadata,
+                     sa.Column('movie_id', sa.Integer),
+                     sa.Column('actor_id', sa.Integer))
+    keyed = sa.Table('roles_keyed', metadata,
+                     sa.Column('movie_id', sa.Integer, primary_key=True),
+                     sa.Column('actor_id', sa.Integer, primary_key=True,
+                               index=True))
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    return plain, keyed
+
+
+def load(engine, tables, actors, movies, links, seed):
+    rng = random.Random(seed)
+    pairs = set()
+    while len(pairs) < links:
+        pairs.add((rng.randrange(movies), rng.randrange(actors)))
+    rows = [{'movie_id': m, 'actor_id': a} for m, a in pairs]
+    for table in tables:
+        with engine.begin() as conn:
+            for start in range(0, len(rows), 50000):
+                conn.execute(table.insert(), rows[start:start + 50000])
+    with engine.begin() as conn:
+        conn.execute('ANALYZE')
+
+
+def timed(engine, statement, params, repeat):
+    with engine.connect() as conn:
+        start = time.perf_counter()
+        for values in params[:repeat]:
+            conn.execute(statement, values).fetchall()
+        return (time.perf_counter() - start) / repeat * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url',
+                        default='sqlite:////tmp/bench_roles.sqlite3')
+    parser.add_argument('--actors', type=int, default=100000)
+    parser.add_argument('--movies', type=int, default=50000)
+    parser.add_argument('--links', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    engine = sa.create_engine(args.database_url)
+    plain, keyed = create_tables(engine, sa.MetaData())
+    load(engine, (plain, keyed), args.actors, args.movies, args.links,
+         args.seed)
+
+    rng = random.Random(args.seed + 1)
+    actor_ids = [{'id': rng.randrange(args.actors)}
+                 for _ in range(args.repeat)]
+    movie_ids = [{'id': rng.randrange(args.movies)}
+                 for _ in range(args.repeat)]
+    pages = [{'ids': [rng.randrange(args.actors) for _ in range(50)]}
+             for _ in range(args.repeat)]
+
+    results = {'links': args.links, 'database': engine.dialect.name}
+    for table in (plain, keyed):
+        by_actor = sa.select([table.c.movie_id])\
+            .where(table.c.actor_id == sa.bindparam('id'))
+        by_movie = sa.select([table.c.actor_id])\
+            .where(table.c.movie_id == sa.bindparam('id'))
+        page = sa.select([table.c.actor_id, table.c.movie_id])\
+            .where(table.c.actor_id.in_(sa.bindparam('ids',
+                                                     expanding=True)))
+        results[table.name] = {
+            'movies_for_actor_ms': round(
+                timed(engine, by_actor, actor_ids, args.repeat), 3),
+            'actors_for_movie_ms': round(
+                timed(engine, by_movie, movie_ids, args.repeat), 3),
+            'page_of_50_actors_ms': round(
+                timed(engine, page, pages, args.repeat), 3)
+        }
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
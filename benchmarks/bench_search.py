@@ -0,0 +1,83 @@
+"""Latency and memory of the type-ahead index.
+
+    python -m benchmarks.bench_search --entries 1000000
+
+Builds a PrefixIndex over synthetic actor names and movie titles (half
+each) and times suggestions for random 1 to 6 character prefixes, plus
+incremental inserts and deletes.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+from flaskr.search import PrefixIndex
+
+
+FIRST = ['James', 'Mary', 'Zoë', 'José', 'Anna', 'Li', 'Omar', 'Chloé',
+         'Brad', 'Ingrid', 'Kenji', 'Amélie', 'Tom', 'Priya', 'Ivan']
+LAST = ['Smith', 'García', 'Müller', 'Rossi', 'Dubois', 'Tanaka', 'Kim',
+        'Nowak', 'Silva', 'Brand', 'Pitt', 'Öztürk', 'Hansen', 'Cohen']
+WORDS = ['night', 'river', 'empire', 'silent', 'last', 'golden', 'city',
+         'dream', 'shadow', 'return', 'storm', 'garden', 'star', 'café']
+
+
+def labels(count, rng):
+    for i in range(count):
+        if i % 2:
+            yield 'movies', i, '%s %s %d' % (rng.choice(WORDS).title(),
+                                             rng.choice(WORDS), i)
+        else:
+            yield 'actors', i, '%s %s %d' % (rng.choice(FIRST),
+                                             rng.choice(LAST), i)
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return {
+        'p50_us': round(timings[len(timings) // 2] * 1e6, 1),
+        'p99_us': round(timings[int(len(timings) * 0.99)] * 1e6, 1)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+
+    index = PrefixIndex()
+    start = time.perf_counter()
+    index.load(labels(args.entries, rng))
+    build_seconds = time.perf_counter() - start
+
+    prefixes = [rng.choice(FIRST + LAST + WORDS)[:rng.randint(1, 6)]
+                for _ in range(args.queries)]
+    timings = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        index.suggest(prefix, 10)
+        timings.append(time.perf_counter() - start)
+
+    writes = []
+    for i in range(200):
+        start = time.perf_counter()
+        index.add('actors', args.entries + i, 'Bench Actor %d' % i)
+        index.remove('actors', args.entries + i)
+        writes.append(time.perf_counter() - start)
+
+    json.dump({
+        'entries': args.entries,
+        'keys': len(index),
+        'build_seconds': round(build_seconds, 2),
+        'memory_mb': round(index.memory() / 2 ** 20, 1),
+        'suggest': percentiles(timings),
+        'add_and_remove': percentiles(writes)
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
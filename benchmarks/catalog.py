@@ -0,0 +1,73 @@
+"""Synthetic catalogs of actors, movies and roles.
+
+`generate()` fills the tables of `models` through SQLAlchemy Core, in
+chunks, so a catalog of a few hundred thousand rows loads in seconds on
+SQLite and on Postgres. The same seed always gives the same catalog.
+Ids are left to the database, so sequences stay usable by the API.
+"""
+import random
+import datetime
+from models import db, roles, Movie, Actor, bump_versions
+
+
+FIRST = ['James', 'Mary', 'Zoë', 'José', 'Anna', 'Li', 'Omar', 'Chloé',
+         'Brad', 'Ingrid', 'Kenji', 'Amélie', 'Tom', 'Priya', 'Ivan']
+LAST = ['Smith', 'García', 'Müller', 'Rossi', 'Dubois', 'Tanaka', 'Kim',
+        'Nowak', 'Silva', 'Brand', 'Pitt', 'Öztürk', 'Hansen', 'Cohen']
+WORDS = ['night', 'river', 'empire', 'silent', 'last', 'golden', 'city',
+         'dream', 'shadow', 'return', 'storm', 'garden', 'star', 'café']
+GENDERS = ['Male', 'Female']
+CHUNK_SIZE = 10000
+
+
+def insert(table, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+
+
+def last_id(model):
+    return db.session.query(db.func.max(model.id)).scalar() or 0
+
+
+def ids_after(model, id):
+    return [id for id, in db.session.query(model.id)
+            .filter(model.id > id).order_by(model.id)]
+
+
+def generate(actors=1000, movies=500, roles_per_actor=5, seed=1):
+    """Insert a catalog in the current app's database.
+
+    Every actor plays in `roles_per_actor` distinct movies on average
+    (uniformly between 0 and twice the mean). Returns the
+    {'actors': ids, 'movies': ids, 'roles': count} of the new rows.
+    """
+    rng = random.Random(seed)
+    first_actor = last_id(Actor)
+    first_movie = last_id(Movie)
+
+    insert(Movie.__table__, [{
+        'title': '%s %s %d' % (rng.choice(WORDS).title(), rng.choice(WORDS),
+                               first_movie + i),
+        'release_date': datetime.date(1970, 1, 1) +
+        datetime.timedelta(days=rng.randrange(365 * 55))
+    } for i in range(movies)])
+    insert(Actor.__table__, [{
+        'name': '%s %s %d' % (rng.choice(FIRST), rng.choice(LAST),
+                              first_actor + i),
+        'age': rng.randint(18, 90),
+        'gender': rng.choice(GENDERS)
+    } for i in range(actors)])
+    movie_ids = ids_after(Movie, first_movie)
+    actor_ids = ids_after(Actor, first_actor)
+
+    links = []
+    if movie_ids:
+        per_actor = min(roles_per_actor, len(movie_ids))
+        for actor_id in actor_ids:
+            count = min(rng.randint(0, 2 * per_actor), len(movie_ids))
+            links.extend({'movie_id': movie_id, 'actor_id': actor_id}
+                         for movie_id in rng.sample(movie_ids, count))
+    insert(roles, links)
+    bump_versions(('actors', 'movies', 'roles'))
+    db.session.commit()
+    return {'actors': actor_ids, 'movies': movie_ids, 'roles': len(links)}
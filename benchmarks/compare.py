@@ -0,0 +1,48 @@
+"""Compare two bench_api reports scenario by scenario.
+
+    python -m benchmarks.compare results/before.json results/after.json
+
+Prints the p50 and p99 latencies and the throughput of both runs and
+flags the scenarios whose p50 grew by more than `--threshold` percent.
+Exits with status 1 when one did, so it can gate a CI job.
+"""
+import sys
+import json
+import argparse
+
+
+def load(path):
+    with open(path) as report:
+        return json.load(report)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10)
+    args = parser.parse_args(argv)
+    before, after = load(args.before), load(args.after)
+
+    print(f'{"scenario":36} {"p50 ms":>17} {"p99 ms":>17} {"req/s":>17}')
+    regressions = 0
+    for name, new in after['scenarios'].items():
+        old = before['scenarios'].get(name)
+        if old is None:
+            print(f'{name:36} (new)')
+            continue
+        change = (new['p50_ms'] / old['p50_ms'] - 1) * 100 \
+            if old['p50_ms'] else 0
+        flag = ''
+        if change > args.threshold:
+            flag = f'  +{change:.0f}% p50'
+            regressions += 1
+        print(f'{name:36} {old["p50_ms"]:>8} {new["p50_ms"]:>8} '
+              f'{old["p99_ms"]:>8} {new["p99_ms"]:>8} '
+              f'{old["requests_per_second"]:>8} '
+              f'{new["requests_per_second"]:>8}{flag}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""Offline stand-in for the Auth0 tenant.
+
+Import this module before `auth` (or `flaskr`): it sets the Auth0
+variables to local values, generates an RSA key pair and mints RS256
+tokens that `auth.verify_decode_jwt` accepts once `install()` has loaded
+the matching JWKS document in `auth.jwks_cache`. `serve_jwks()` serves
+the document over HTTP, so the fetch path of `auth.py` runs too.
+"""
+import os
+import json
+import time
+import base64
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+os.environ.setdefault('AUTH0_DOMAIN', 'auth.local')
+os.environ.setdefault('API_AUDIENCE', 'capstoneApi')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+
+import rsa
+from jose import jwt
+
+
+KID = 'local-benchmark-key'
+PERMISSIONS = ['get:actors', 'get:movies', 'post:actors', 'post:movies',
+               'patch:actors', 'patch:movies', 'delete:actors',
+               'delete:movies']
+
+_keys = {}
+
+
+def keypair():
+    """Return the (public, private) RSA keys, generated once."""
+    if not _keys:
+        _keys['public'], _keys['private'] = rsa.newkeys(2048)
+    return _keys['public'], _keys['private']
+
+
+def b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def jwks():
+    """Return the JWKS document of the local key."""
+    public, _ = keypair()
+    return {'keys': [{'kty': 'RSA', 'kid': KID, 'use': 'sig',
+                      'alg': 'RS256', 'n': b64(public.n),
+                      'e': b64(public.e)}]}
+
+
+def mint_token(permissions=PERMISSIONS, ttl=3600, sub='local|benchmark'):
+    """Return a signed bearer token with the given permissions."""
+    _, private = keypair()
+    now = int(time.time())
+    claims = {
+        'iss': f'https://{os.environ["AUTH0_DOMAIN"]}/',
+        'aud': os.environ['API_AUDIENCE'],
+        'sub': sub,
+        'iat': now,
+        'exp': now + ttl,
+        'permissions': list(permissions)
+    }
+    return jwt.encode(claims, private.save_pkcs1().decode(),
+                      algorithm='RS256', headers={'kid': KID})
+
+
+class JWKSHandler(BaseHTTPRequestHandler):
+    """Answers every GET with the local JWKS document."""
+
+    body = b''
+
+    def do_GET(self):
+        body = self.body
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_jwks(host='127.0.0.1', port=0):
+    """Serve the JWKS document from a daemon thread, return its URL."""
+    # the key pair takes seconds to generate, not within a fetch timeout
+    handler = type('Handler', (JWKSHandler,),
+                   {'body': json.dumps(jwks()).encode()})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}/.well-known/jwks.json'
+
+
+def install(url=None):
+    """Point the process wide key store at the local keys.
+
+    With `url` (see `serve_jwks()`) the keys are fetched over HTTP like
+    in production, otherwise the document is loaded directly.
+    """
+    import auth
+    if url is None:
+        auth.jwks_cache.load(jwks())
+        return
+    auth.jwks_cache.url = url
+    if not auth.jwks_cache.refresh():
+        raise RuntimeError(f'cannot fetch the JWKS document from {url}')
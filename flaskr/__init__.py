@@ -1,13 +1,83 @@
-from flask import Flask, jsonify, abort, request
-from models import setup_db, Movie, Actor
+import os
+from flask import Flask, Response, abort, request
+from models import setup_db, db, Movie, Actor
 from flask_cors import CORS
 from auth import requires_auth, AuthError
+from .pagination import page_args, read_limit
+from .projection import (requested_fields, list_page, requested_ids,
+                         fetch_by_ids)
+from .filters import list_filters
+from sqlalchemy.exc import IntegrityError
+from .bulk import (bulk_create, get_or_create, in_transaction, insert_row,
+                   update_row, link_rows)
+from .streaming import wants_stream, stream_response
+from .etag import conditional, request_versions
+from .cache import cached, make_cache
+from .search import make_index
+from .graph import make_graph
+from .metrics import init_metrics, CONTENT_TYPE
+from .jsonprovider import jsonify, make_provider
+from .compression import init_compression
+from .replicas import init_replicas
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.config.from_mapping(
+        DEFAULT_PAGE_SIZE=int(os.environ.get('DEFAULT_PAGE_SIZE', 50)),
+        MAX_PAGE_SIZE=int(os.environ.get('MAX_PAGE_SIZE', 500)),
+        ALLOW_UNPAGINATED=os.environ.get(
+            'ALLOW_UNPAGINATED', '').lower() in ('1', 'true'),
+        BULK_BATCH_SIZE=int(os.environ.get('BULK_BATCH_SIZE', 500)),
+        STREAM_BATCH_SIZE=int(os.environ.get('STREAM_BATCH_SIZE', 1000)),
+        RESPONSE_CACHE=os.environ.get('RESPONSE_CACHE', 'memory'),
+        RESPONSE_CACHE_SIZE=int(os.environ.get('RESPONSE_CACHE_SIZE', 1024)),
+        RESPONSE_CACHE_PATH=os.environ.get('RESPONSE_CACHE_PATH'),
+        SEARCH_MAX_LIMIT=int(os.environ.get('SEARCH_MAX_LIMIT', 50)),
+        SEARCH_REBUILD_INTERVAL=float(
+            os.environ.get('SEARCH_REBUILD_INTERVAL', 60)),
+        GRAPH_MAX_DEGREES=int(os.environ.get('GRAPH_MAX_DEGREES', 6)),
+        GRAPH_REBUILD_INTERVAL=float(
+            os.environ.get('GRAPH_REBUILD_INTERVAL', 60)),
+        DB_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', 5)),
+        DB_MAX_OVERFLOW=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        DB_POOL_TIMEOUT=float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        DB_POOL_RECYCLE=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        DB_POOL_PRE_PING=os.environ.get(
+            'DB_POOL_PRE_PING', 'true').lower() in ('1', 'true'),
+        DB_STATEMENT_TIMEOUT=int(
+            os.environ.get('DB_STATEMENT_TIMEOUT', 30000)),
+        DB_WRITE_ATTEMPTS=int(os.environ.get('DB_WRITE_ATTEMPTS', 3)),
+        DB_RETRY_BACKOFF=float(os.environ.get('DB_RETRY_BACKOFF', 0.05)),
+        JSON_PROVIDER=os.environ.get('JSON_PROVIDER', 'auto'),
+        JSON_AS_ASCII=os.environ.get(
+            'JSON_AS_ASCII', 'true').lower() in ('1', 'true'),
+        COMPRESS_ENCODINGS=os.environ.get('COMPRESS_ENCODINGS', 'br,gzip'),
+        COMPRESS_MIN_SIZE=int(os.environ.get('COMPRESS_MIN_SIZE', 500)),
+        COMPRESS_GZIP_LEVEL=int(os.environ.get('COMPRESS_GZIP_LEVEL', 6)),
+        COMPRESS_BROTLI_LEVEL=int(os.environ.get('COMPRESS_BROTLI_LEVEL', 4)),
+        COMPRESS_CACHE_SIZE=int(os.environ.get('COMPRESS_CACHE_SIZE', 256)),
+        DATABASE_REPLICA_URLS=os.environ.get('DATABASE_REPLICA_URLS', ''),
+        REPLICA_STICKY_SECONDS=int(
+            os.environ.get('REPLICA_STICKY_SECONDS', 10)),
+        REPLICA_MAX_LAG_SECONDS=float(
+            os.environ.get('REPLICA_MAX_LAG_SECONDS', 10)),
+        REPLICA_CHECK_INTERVAL=float(
+            os.environ.get('REPLICA_CHECK_INTERVAL', 5)),
+        REPLICA_CONNECT_TIMEOUT=int(
+            os.environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+    )
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
+    init_replicas(app)
+    app.extensions['response_cache'] = make_cache(app.config)
+    app.extensions['search_index'] = make_index(app.config)
+    app.extensions['costar_graph'] = make_graph(app.config)
+    app.extensions['json_provider'] = make_provider(app.config)
+    metrics = init_metrics(app)
+    init_compression(app)
     CORS(app)
 
     # CORS Headers
@@ -19,25 +89,72 @@ def create_app(test_config=None):
                              'GET,PUT,POST,DELETE,OPTIONS')
         return response
 
+    '''
+    GET /metrics
+        - it is a public endpoint, meant for the Prometheus scraper
+        - returns the latency histograms (total, auth, db and serialize)
+          and SQL statements per request of this worker, by route, method
+          and status, and the counters of the caches and search index, in
+          the Prometheus text format
+    '''
+    @app.route('/metrics')
+    def get_metrics():
+        return Response(metrics.render(), content_type=CONTENT_TYPE)
+
     '''
     GET /actors
         - it is a public endpoint
-        - it contain a list of actors data
-        - return status code 200 and json {"success": True, "actors": actors}
-          where actors is the list of actors or appropriate status code
-		  indicating reason for failure
+        - it contain a page of actors data ordered by id
+        - accepts ?limit= (capped by MAX_PAGE_SIZE) and ?after=<cursor>,
+          ?all=true returns every actor when ALLOW_UNPAGINATED is set
+        - accepts ?view=short|long and ?fields=id,name,... to limit the
+          returned fields, short views don't touch the roles table
+        - accepts ?age_min=, ?age_max=, ?gender= and ?movie_id= filters
+        - ?ids=1,2,3 returns the actors with these ids in the requested
+          order instead of a page, the ids without a actor are listed in
+          "missing"
+        - ?stream=true (or Accept: application/x-ndjson) streams the whole
+          table in chunks read from a server-side cursor
+        - responses carry an ETag, If-None-Match returns 304 when the
+          tables didn't change
+        - responses are cached until the next write to actors, movies or
+          roles
+        - return status code 200 and json
+          {"success": True, "actors": actors, "next": cursor}
+          where actors is the list of actors and cursor the value of
+          ?after= for the next page (null on the last page) or appropriate
+          status code indicating reason for failure
     '''
     @app.route('/actors')
     @requires_auth('get:movies')
+    @conditional('actors', 'movies', 'roles')
+    @cached('actors', 'movies', 'roles')
     def get_actors(payload):
+        fields = requested_fields(Actor)
+        ids = requested_ids()
+        if ids is not None:
+            try:
+                actors, missing = fetch_by_ids(Actor, ids, fields)
+            except Exception as ex:
+                abort(422)
+            return jsonify({
+                'success': True,
+                'actors': actors,
+                'missing': missing
+            })
+        criteria = list_filters(Actor)
+        if wants_stream():
+            return stream_response(Actor, 'actors', fields, criteria)
+        limit, after_id = page_args()
         try:
-            # fetch list of actors ordered by id
-            actors = list(
-                map(Actor.long, Actor.query.order_by(Actor.id)))
+            # fetch a page of actors ordered by id
+            actors, next_cursor = list_page(Actor, limit, after_id,
+                                            fields, criteria)
 
             return jsonify({
                 "success": True,
-                "actors": actors
+                "actors": actors,
+                "next": next_cursor
             })
         except Exception as ex:
             abort(422)
@@ -45,25 +162,220 @@ def create_app(test_config=None):
     '''
     GET /movies
         - it is a public endpoint
-        - it contain a list of movies data
-        - return status code 200 and json {"success": True, "movies": movies}
-          where movies is the list of movies or apppropriate status code
-          indicating reason for failure
+        - it contain a page of movies data ordered by id
+        - accepts ?limit= (capped by MAX_PAGE_SIZE) and ?after=<cursor>,
+          ?all=true returns every movie when ALLOW_UNPAGINATED is set
+        - accepts ?view=short|long and ?fields=id,title,... to limit the
+          returned fields, short views don't touch the roles table
+        - accepts ?release_date_from=, ?release_date_to= and ?actor_id=
+          filters
+        - ?ids=1,2,3 returns the movies with these ids in the requested
+          order instead of a page, the ids without a movie are listed in
+          "missing"
+        - ?stream=true (or Accept: application/x-ndjson) streams the whole
+          table in chunks read from a server-side cursor
+        - responses carry an ETag, If-None-Match returns 304 when the
+          tables didn't change
+        - responses are cached until the next write to actors, movies or
+          roles
+        - return status code 200 and json
+          {"success": True, "movies": movies, "next": cursor}
+          where movies is the list of movies and cursor the value of
+          ?after= for the next page (null on the last page) or apppropriate
+          status code indicating reason for failure
     '''
     @app.route('/movies')
     @requires_auth('get:movies')
+    @conditional('actors', 'movies', 'roles')
+    @cached('actors', 'movies', 'roles')
     def get_movies(payload):
+        fields = requested_fields(Movie)
+        ids = requested_ids()
+        if ids is not None:
+            try:
+                movies, missing = fetch_by_ids(Movie, ids, fields)
+            except Exception as ex:
+                abort(422)
+            return jsonify({
+                'success': True,
+                'movies': movies,
+                'missing': missing
+            })
+        criteria = list_filters(Movie)
+        if wants_stream():
+            return stream_response(Movie, 'movies', fields, criteria)
+        limit, after_id = page_args()
         try:
-            # fetch the list of movies
-            movies = list(map(Movie.long, Movie.query.order_by(Movie.id)))
+            # fetch a page of movies ordered by id
+            movies, next_cursor = list_page(Movie, limit, after_id,
+                                            fields, criteria)
 
             return jsonify({
                 'success': True,
-                'movies': movies
+                'movies': movies,
+                'next': next_cursor
             })
         except Exception as ex:
             abort(422)
 
+    '''
+    GET /actors/<id> and GET /movies/<id>
+        - where <id> is the existing actor / movie id
+        - they require the 'get:movies' permission
+        - accept ?view= and ?fields= like the list endpoints
+        - responses carry an ETag and are cached like the list endpoints
+        - return status code 200 and json {"success": True, "actors": actor}
+          (or "movies") where actor is an array containing only the actor,
+          or 404 when <id> is not found
+    '''
+    @app.route('/actors/<int:actor_id>')
+    @requires_auth('get:movies')
+    @conditional('actors', 'movies', 'roles')
+    @cached('actors', 'movies', 'roles')
+    def get_actor(payload, actor_id):
+        fields = requested_fields(Actor)
+        try:
+            actors, missing = fetch_by_ids(Actor, [actor_id], fields)
+        except Exception as ex:
+            abort(422)
+        if missing:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'actors': actors
+        })
+
+    @app.route('/movies/<int:movie_id>')
+    @requires_auth('get:movies')
+    @conditional('actors', 'movies', 'roles')
+    @cached('actors', 'movies', 'roles')
+    def get_movie(payload, movie_id):
+        fields = requested_fields(Movie)
+        try:
+            movies, missing = fetch_by_ids(Movie, [movie_id], fields)
+        except Exception as ex:
+            abort(422)
+        if missing:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'movies': movies
+        })
+
+    '''
+    GET /actors/<id>/costars
+        - where <id> is the existing actor id
+        - it requires the 'get:movies' permission
+        - it is served from an in-memory graph of the roles kept by every
+          worker
+        - ?limit= (default DEFAULT_PAGE_SIZE, capped by MAX_PAGE_SIZE) sets
+          the number of co-stars, the ones sharing the most movies first
+        - returns status code 200 and json
+          {"success": True, "costars": costars, "total": total} where
+          costars are actor.short() with the number of "shared_movies" and
+          total the number of co-stars, or 404 when <id> is not found
+    '''
+    @app.route('/actors/<int:actor_id>/costars')
+    @requires_auth('get:movies')
+    @conditional('actors', 'movies', 'roles')
+    @cached('actors', 'movies', 'roles')
+    def get_costars(payload, actor_id):
+        limit = read_limit(app.config['DEFAULT_PAGE_SIZE'],
+                           app.config['MAX_PAGE_SIZE'])
+
+        graph = app.extensions['costar_graph']
+        graph.ensure_fresh(app, request_versions(('roles',)))
+        shared, total = graph.costars(actor_id, limit)
+        actors = Actor.query.filter(
+            Actor.id.in_([actor_id] + list(shared))).all()
+        if actor_id not in {actor.id for actor in actors}:
+            abort(404)
+        costars = sorted((dict(actor.short(), shared_movies=shared[actor.id])
+                          for actor in actors if actor.id in shared),
+                         key=lambda costar: (-costar['shared_movies'],
+                                             costar['id']))
+        return jsonify({
+            'success': True,
+            'costars': costars,
+            'total': total
+        })
+
+    '''
+    GET /actors/<a>/path/<b>
+        - where <a> and <b> are existing actor ids
+        - it requires the 'get:movies' permission
+        - it is served from the in-memory graph of the roles
+        - returns status code 200 and json
+          {"success": True, "path": path, "degrees": degrees} where path
+          alternates actors and movies from <a> to <b>, each one its
+          short() with its "type", and degrees is the number of movies in
+          between, both null when the actors are more than
+          GRAPH_MAX_DEGREES apart, or 404 when an actor is not found
+    '''
+    @app.route('/actors/<int:actor_id>/path/<int:other_id>')
+    @requires_auth('get:movies')
+    @conditional('actors', 'movies', 'roles')
+    @cached('actors', 'movies', 'roles')
+    def get_path(payload, actor_id, other_id):
+        graph = app.extensions['costar_graph']
+        graph.ensure_fresh(app, request_versions(('roles',)))
+        ids = graph.path(actor_id, other_id,
+                         app.config['GRAPH_MAX_DEGREES']) or []
+        actors = {actor.id: actor for actor in Actor.query.filter(
+            Actor.id.in_(list({actor_id, other_id, *ids[::2]})))}
+        if actor_id not in actors or other_id not in actors:
+            abort(404)
+        movies = {movie.id: movie for movie in Movie.query.filter(
+            Movie.id.in_(ids[1::2]))} if len(ids) > 1 else {}
+
+        path = []
+        for i, id in enumerate(ids):
+            rows, kind = (actors, 'actors') if i % 2 == 0 else \
+                (movies, 'movies')
+            if id not in rows:
+                # deleted by another worker, the graph isn't rebuilt yet
+                path = []
+                break
+            path.append(dict(rows[id].short(), type=kind))
+        return jsonify({
+            'success': True,
+            'path': path or None,
+            'degrees': len(path) // 2 if path else None
+        })
+
+    '''
+    GET /search/suggest
+        - it requires the 'get:movies' permission
+        - ?q= is the text typed so far, case and accents are ignored and
+          every word of a name or title is matched by prefix
+        - ?type=actors|movies restricts the search, ?limit= (default 10,
+          capped by SEARCH_MAX_LIMIT) the number of suggestions
+        - returns status code 200 and json
+          {"success": True, "suggestions": suggestions} where suggestions
+          are {"type", "id", "name"} for actors and {"type", "id", "title"}
+          for movies, names starting with q first, or 400 without q
+    '''
+    @app.route('/search/suggest')
+    @requires_auth('get:movies')
+    def suggest(payload):
+        query = request.args.get('q', '').strip()
+        table = request.args.get('type')
+        limit = read_limit(10, app.config['SEARCH_MAX_LIMIT'])
+        if not query or table not in (None, 'actors', 'movies'):
+            abort(400)
+
+        search_index = app.extensions['search_index']
+        search_index.ensure_fresh(app, request_versions(('actors', 'movies')))
+        suggestions = [{
+            'type': kind,
+            'id': id,
+            'name' if kind == 'actors' else 'title': label
+        } for kind, id, label in search_index.suggest(query, limit, table)]
+        return jsonify({
+            'success': True,
+            'suggestions': suggestions
+        })
+
     '''
     POST /actors
         - it should create a new row in the actors table
@@ -82,42 +394,35 @@ def create_app(test_config=None):
             abort(400)
         name = body.get('name', None)
         age = body.get('age', None)
-        gender = body.get('gender', None)
         movies = body.get('movies', None)
         # check name and age
         if (name is None) | (age is None):
             abort(400)
-        # check if the actor already exist
-        actor_old = Actor.query.filter_by(name=name).all()
-        if len(actor_old) != 0:
-            abort(409)
-
-        # create a new actor
-        actor = Actor(name=name, age=age, gender=gender)
-        # add movies
-        if len(movies) > 0:
-            for movie in movies:
-                title = movie.get('title', None)
-                release_date = movie.get('release_date', None)
-                if (title is not None) and (release_date is not None):
-                    # check if the movie already exist in the db
-                    movie_row = Movie.query.filter_by(
-                        title=title).one_or_none()
-                    if movie_row:
-                        actor.movies.append(movie_row)
-                    else:
-                        movie_row = Movie(
-                            title=title, release_date=release_date)
-                        actor.movies.append(movie_row)
+
+        def create():
+            # the missing movies are created in one statement, before the
+            # actor as in POST /movies so both lock the rows in one order
+            movie_rows = get_or_create(Movie, movies or []).values()
+            # create a new actor, a duplicate name fails the insert
+            actor = insert_row(Actor, body)
+            link_rows(Actor, actor.id, [row.id for row in movie_rows])
+            new_actor = actor.long(movie_rows)
+            db.session.commit()
+            return new_actor
+
         try:
-            actor.insert()
-            new_actor = Actor.query.get(actor.id)
-            return jsonify({
-                'success': True,
-                'actors': [new_actor.long()]
-            })
+            new_actor = in_transaction(create)
+        except IntegrityError:
+            # the actor already exists
+            if Actor.query.filter_by(name=name).count():
+                abort(409)
+            abort(422)
         except Exception as ex:
             abort(422)
+        return jsonify({
+            'success': True,
+            'actors': [new_actor]
+        })
 
     '''
     POST /movies
@@ -142,38 +447,64 @@ def create_app(test_config=None):
         # check title and release_date
         if (title is None) | (release_date is None):
             abort(400)
-        # check if the movie already exist
-        movie_old = Movie.query.filter_by(title=title).all()
-        if len(movie_old) != 0:
-            abort(409)
-
-        # create a new movie
-        movie = Movie(title=title, release_date=release_date)
-        # add actors
-        if len(actors) > 0:
-            for actor in actors:
-                name = actor.get('name', None)
-                age = actor.get('age', None)
-                gender = actor.get('gender', None)
-                if (name is not None) and (age is not None):
-                    # check if the actor already exist in the db
-                    actor_row = Actor.query.filter_by(
-                        name=name).one_or_none()
-                    if actor_row:
-                        movie.actors.append(actor_row)
-                    else:
-                        actor_row = Actor(
-                            name=name, age=age, gender=gender)
-                        movie.actors.append(actor_row)
+
+        def create():
+            # create a new movie, a duplicate title fails the insert
+            movie = insert_row(Movie, body)
+            # the missing actors are created in one statement
+            actor_rows = get_or_create(Actor, actors or []).values()
+            link_rows(Movie, movie.id, [row.id for row in actor_rows])
+            new_movie = movie.long(actor_rows)
+            db.session.commit()
+            return new_movie
+
         try:
-            movie.insert()
-            new_movie = Movie.query.get(movie.id)
-            return jsonify({
-                'success': True,
-                'movies': [new_movie.long()]
-            })
+            new_movie = in_transaction(create)
+        except IntegrityError:
+            # the movie already exists
+            if Movie.query.filter_by(title=title).count():
+                abort(409)
+            abort(422)
         except Exception as ex:
             abort(422)
+        return jsonify({
+            'success': True,
+            'movies': [new_movie]
+        })
+
+    '''
+    POST /actors/bulk and POST /movies/bulk
+        - they should create many actors / movies from a json array, each
+          item has the same format as the POST /actors / POST /movies body
+        - they should require the 'post:actors' / 'post:movies' permission
+        - items are committed in batches of BULK_BATCH_SIZE, referenced
+          movies / actors are looked up with one query per batch
+        - returns status code 200 and json {"success": True, "results": r}
+          where r holds {"index", "status", "id"} for every item in the
+          request order, status is 200, 400 (invalid item), 409 (already
+          exists) or 422 (the batch failed to commit)
+    '''
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def add_actors_bulk(payload):
+        body = request.get_json()
+        if not isinstance(body, list):
+            abort(400)
+        return jsonify({
+            'success': True,
+            'results': bulk_create(Actor, body)
+        })
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def add_movies_bulk(payload):
+        body = request.get_json()
+        if not isinstance(body, list):
+            abort(400)
+        return jsonify({
+            'success': True,
+            'results': bulk_create(Movie, body)
+        })
 
     '''
     PATCH /actors/<id>
@@ -189,49 +520,36 @@ def create_app(test_config=None):
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
     def update_actor(payload, actor_id):
-        # search the actor in the database
-        actor = Actor.query.filter_by(id=actor_id).one_or_none()
-        if actor is None:
-            abort(404)
         # get the request body
         body = request.get_json()
-        name = body.get('name', None)
-        age = body.get('age', None)
-        gender = body.get('gender', None)
+        # the name, age and gender to update
+        values = {field: body[field] for field in ('name', 'age', 'gender')
+                  if body.get(field)}
         movies = body.get('movies', None)
-        # update the name
-        if name:
-            actor.name = name
-        # update the age
-        if age:
-            actor.age = age
-        # update the gender
-        if gender:
-            actor.gender = gender
-        # add new movies
-        if movies:
-            # get the existing movies titles
-            movies_titles = [m.title for m in actor.movies]
-            for movie in movies:
-                if movie['title'] not in movies_titles:
-                    # check if the movie already exist in the db
-                    movie_row = Movie.query.filter_by(
-                        title=movie['title']).one_or_none()
-                    if movie_row:
-                        actor.movies.append(movie_row)
-                    else:
-                        movie_new = Movie(title=movie['title'],
-                                          release_date=movie['release_date'])
-                        actor.movies.append(movie_new)
+
+        def update():
+            # update the actor, None when it doesn't exist
+            actor = update_row(Actor, actor_id, values)
+            if actor is None:
+                return None
+            # add new movies, the missing ones are created in one statement
+            if movies:
+                movie_rows = get_or_create(Movie, movies).values()
+                link_rows(Actor, actor_id, [row.id for row in movie_rows])
+            updated_actor = Actor.long_many([actor])[0]
+            db.session.commit()
+            return updated_actor
+
         try:
-            actor.update()
-            updated_actor = Actor.query.get(actor_id)
-            return jsonify({
-                'success': True,
-                'actors': [updated_actor.long()]
-            })
+            updated_actor = in_transaction(update)
         except Exception as ex:
             abort(422)
+        if updated_actor is None:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'actors': [updated_actor]
+        })
     '''
     PATCH /movies/<id>
         - where <id> is the existing movie id
@@ -246,46 +564,36 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
     def update_movie(payload, movie_id):
-        # search the movie in the database
-        movie = Movie.query.filter_by(id=movie_id).one_or_none()
-        if movie is None:
-            abort(404)
         # get the request body
         body = request.get_json()
-        title = body.get('title', None)
-        release_date = body.get('release_date', None)
+        # the title and release_date to update
+        values = {field: body[field] for field in ('title', 'release_date')
+                  if body.get(field)}
         actors = body.get('actors', None)
-        # update the title
-        if title:
-            movie.title = title
-        # update the release_date
-        if release_date:
-            movie.release_date = release_date
-        # add new actors
-        if actors:
-            # get the existing actors name
-            actors_names = [a.name for a in movie.actors]
-            for actor in actors:
-                if actor['name'] not in actors_names:
-                    # check if the actor already exist in the db
-                    actor_row = Actor.query.filter_by(
-                        name=actor['name']).one_or_none()
-                    if actor_row:
-                        movie.actors.append(actor_row)
-                    else:
-                        actor_new = Actor(name=actor['name'],
-                                          age=actor['age'],
-                                          gender=actor.get('gender', None))
-                        movie.actors.append(actor_new)
+
+        def update():
+            # update the movie, None when it doesn't exist
+            movie = update_row(Movie, movie_id, values)
+            if movie is None:
+                return None
+            # add new actors, the missing ones are created in one statement
+            if actors:
+                actor_rows = get_or_create(Actor, actors).values()
+                link_rows(Movie, movie_id, [row.id for row in actor_rows])
+            updated_movie = Movie.long_many([movie])[0]
+            db.session.commit()
+            return updated_movie
+
         try:
-            movie.update()
-            updated_movie = Movie.query.get(movie_id)
-            return jsonify({
-                'success': True,
-                'movies': [updated_movie.long()]
-            })
+            updated_movie = in_transaction(update)
         except Exception as ex:
             abort(422)
+        if updated_movie is None:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'movies': [updated_movie]
+        })
 
     '''
     DELETE /actors/<id>
@@ -0,0 +1,424 @@
+import time
+import random
+import datetime
+from flask import current_app
+from sqlalchemy import exc, types
+from sqlalchemy.dialects import postgresql
+from models import db, roles, Movie, Actor, bump_versions, record_rows
+
+
+# how each model is created in bulk and how it links to the other side
+SPECS = {
+    Actor: {
+        'key': 'name',
+        'fields': ('name', 'age', 'gender'),
+        'required': ('name', 'age'),
+        'nested': 'movies',
+        'column': 'actor_id'
+    },
+    Movie: {
+        'key': 'title',
+        'fields': ('title', 'release_date'),
+        'required': ('title', 'release_date'),
+        'nested': 'actors',
+        'column': 'movie_id'
+    }
+}
+RELATED = {Actor: Movie, Movie: Actor}
+ALIASES = {'release_date': 'release date'}
+# serialization_failure and deadlock_detected, the transaction can be run
+# again as it is
+RETRY_SQLSTATES = ('40001', '40P01')
+
+
+def valid_value(column, value):
+    """True when the database accepts `value` for `column`."""
+    kind = getattr(column.type, 'impl', column.type)
+    if isinstance(kind, types.Integer):
+        return isinstance(value, int) and not isinstance(value, bool) and \
+            -2 ** 31 <= value < 2 ** 31
+    if isinstance(kind, types.Date):
+        if isinstance(value, datetime.date):
+            return True
+        try:
+            datetime.date.fromisoformat(value)
+        except (TypeError, ValueError):
+            return False
+        return True
+    if isinstance(kind, types.String):
+        return isinstance(value, str) and \
+            (kind.length is None or len(value) <= kind.length)
+    return True
+
+
+def valid_fields(model, item):
+    """True when the database accepts the fields given in `item`."""
+    columns = model.__table__.c
+    return all(valid_value(columns[field], item[field])
+               for field in SPECS[model]['fields']
+               if item.get(field) is not None)
+
+
+def accepted(model, item):
+    """True when the database accepts `item` and its nested items."""
+    nested = item.get(SPECS[model]['nested']) or ()
+    return valid_fields(model, item) and \
+        all(valid_fields(RELATED[model], other) for other in nested
+            if isinstance(other, dict))
+
+
+def is_valid(model, item):
+    spec = SPECS[model]
+    return isinstance(item, dict) and \
+        all(item.get(field) is not None for field in spec['required']) and \
+        isinstance(item[spec['key']], str) and \
+        isinstance(item.get(spec['nested'], []), (list, type(None)))
+
+
+def reference_key(model, item):
+    """The key `item` references a row of `model` by, None without one."""
+    if isinstance(item, dict) and isinstance(item.get(SPECS[model]['key']),
+                                             str):
+        return item[SPECS[model]['key']]
+    return None
+
+
+def short(model, id, item):
+    """The short() representation of a row inserted from `item`."""
+    return dict(id=id, **{ALIASES.get(field, field): item.get(field)
+                          for field in SPECS[model]['fields']})
+
+
+def ids_by_key(model, keys):
+    """Return {key: id} for the rows of `model` whose key is in `keys`."""
+    if not keys:
+        return {}
+    column = getattr(model, SPECS[model]['key'])
+    rows = db.session.query(column, model.id).filter(column.in_(keys))
+    return dict(rows)
+
+
+def rows_by_key(model, keys):
+    """Return {key: row} for the rows of `model` whose key is in `keys`."""
+    keys = [key for key in keys if isinstance(key, str)]
+    if not keys:
+        return {}
+    column = getattr(model, SPECS[model]['key'])
+    return {getattr(row, SPECS[model]['key']): row
+            for row in model.query.filter(column.in_(keys))}
+
+
+def insert_missing(model, items, existing=None):
+    """Insert the valid `items` whose key isn't in `model` yet.
+
+    Returns the rows this transaction inserted, every column, as a result
+    to iterate once, or None when there was nothing to insert. Keys in
+    `existing` were already looked up and are skipped.
+
+    Postgres runs one INSERT ... ON CONFLICT DO NOTHING RETURNING: when
+    concurrent transactions insert the same key, the later one waits for
+    the first and skips the row instead of failing. Other databases look
+    the keys up when `existing` isn't given, INSERT OR IGNORE (INSERT
+    IGNORE on MySQL) the missing ones and read back as many rows as the
+    insert counted, the newest of those keys, so a row a concurrent
+    transaction inserted first isn't reported as created. Rows go in key
+    order, so transactions lock the keys they share in the same order.
+    """
+    spec = SPECS[model]
+    key = spec['key']
+    rows = {}
+    for item in items:
+        if is_valid(model, item) and \
+                (existing is None or item[key] not in existing):
+            rows.setdefault(item[key], {field: item.get(field)
+                                        for field in spec['fields']})
+    if not rows:
+        return None
+    table = model.__table__
+    values = [rows[k] for k in sorted(rows)]
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return db.session.execute(
+            postgresql.insert(table).values(values)
+            .on_conflict_do_nothing(index_elements=[key])
+            .returning(*table.c))
+
+    if existing is None:
+        existing = ids_by_key(model, list(rows))
+        values = [row for row in values if row[key] not in existing]
+        if not values:
+            return None
+    inserted = db.session.execute(
+        table.insert().values(values)
+        .prefix_with('OR IGNORE', dialect='sqlite')
+        .prefix_with('IGNORE', dialect='mysql')).rowcount
+    if not inserted:
+        return None
+    return db.session.execute(
+        table.select().where(table.c[key].in_([row[key] for row in values]))
+        .order_by(table.c.id.desc()).limit(inserted))
+
+
+def get_or_create(model, items):
+    """Return {key: row} for the keys of `items`, creating the rows of the
+    valid items that don't exist yet.
+
+    An item only needs its key to reference an existing row. When every
+    row exists this is one IN lookup, else insert_missing adds the others
+    and returns them. Created rows are recorded with track().
+    """
+    key = SPECS[model]['key']
+    keys = [item.get(key) for item in items if isinstance(item, dict)]
+    rows = rows_by_key(model, keys)
+    inserted = insert_missing(model, items, rows)
+    created = [] if inserted is None else \
+        list(db.session.query(model).instances(inserted))
+    rows.update((getattr(row, key), row) for row in created)
+    # skipped by the insert, another request created them meanwhile
+    rows.update(rows_by_key(model, [k for k in keys if k not in rows]))
+    if created:
+        track(model, created)
+    return rows
+
+
+def track(model, rows):
+    """Record `rows` written by a Core statement for the commit listeners,
+    the version of the table is bumped before the commit."""
+    db.session.info.setdefault('changed_tables', set()).add(
+        model.__tablename__)
+    record_rows([(model.__tablename__, row.id, row.short()) for row in rows])
+
+
+def written(model, statement, where):
+    """Run the INSERT or UPDATE `statement`, return the instances of the
+    rows it wrote with their stored values.
+
+    Postgres returns them with RETURNING, in the same statement. Other
+    databases read the rows matching `where` back, `where` is called
+    with the result of the statement.
+    """
+    table = model.__table__
+    if db.session.get_bind().dialect.name == 'postgresql':
+        result = db.session.execute(statement.returning(*table.c))
+    else:
+        result = db.session.execute(table.select().where(
+            where(db.session.execute(statement))))
+    return list(db.session.query(model).populate_existing()
+                .instances(result))
+
+
+def insert_row(model, item):
+    """Insert the row of `item`, return its instance.
+
+    A duplicate key raises IntegrityError, the caller doesn't need to look
+    the key up first.
+    """
+    table = model.__table__
+    row, = written(model, table.insert().values({
+        field: item.get(field) for field in SPECS[model]['fields']}),
+        lambda result: table.c.id == result.inserted_primary_key[0])
+    track(model, [row])
+    return row
+
+
+def update_row(model, id, values):
+    """Update the columns of `values` in the row `id` of `model`, return
+    its instance or None when there is no such row."""
+    table = model.__table__
+    where = table.c.id == id
+    if not values:
+        return db.session.query(model).get(id)
+    rows = written(model, table.update().where(where).values(values),
+                   lambda result: where)
+    if not rows:
+        return None
+    track(model, rows)
+    return rows[0]
+
+
+def link_rows(model, id, related_ids):
+    """Add the roles linking the row `id` of `model` to the rows
+    `related_ids` of the other model, skipping the existing ones."""
+    if not related_ids:
+        return
+    column = SPECS[model]['column']
+    related_column = SPECS[RELATED[model]]['column']
+    values = [{column: id, related_column: related_id}
+              for related_id in sorted(set(related_ids))]
+    if db.session.get_bind().dialect.name == 'postgresql':
+        statement = postgresql.insert(roles).on_conflict_do_nothing()
+    else:
+        statement = roles.insert().prefix_with('OR IGNORE', dialect='sqlite')\
+            .prefix_with('IGNORE', dialect='mysql')
+    if db.session.execute(statement.values(values)).rowcount:
+        db.session.info.setdefault('changed_tables', set()).add('roles')
+        record_links(values)
+
+
+def record_links(values):
+    """Record the roles rows `values` for the commit listeners."""
+    record_rows([('roles', (link['movie_id'], link['actor_id']), link)
+                 for link in values])
+
+
+def ids_of(model, inserted):
+    """{key: id} of the rows returned by insert_missing."""
+    if inserted is None:
+        return {}
+    key = SPECS[model]['key']
+    return {row[key]: row['id'] for row in inserted}
+
+
+def retryable(error):
+    """True for a serialization failure, a deadlock or a busy SQLite."""
+    return getattr(error.orig, 'pgcode', None) in RETRY_SQLSTATES or \
+        'database is locked' in str(error.orig)
+
+
+def in_transaction(work):
+    """Return work(), rolling the session back when it raises.
+
+    work() must run the whole transaction, commit included. It runs
+    again, up to DB_WRITE_ATTEMPTS times in all, on a serialization
+    failure or a deadlock, after an exponential backoff starting at
+    DB_RETRY_BACKOFF seconds, with jitter so the transactions that
+    collided don't collide again.
+    """
+    attempts = current_app.config['DB_WRITE_ATTEMPTS']
+    backoff = current_app.config['DB_RETRY_BACKOFF']
+    for attempt in range(attempts):
+        try:
+            return work()
+        except exc.DBAPIError as error:
+            db.session.rollback()
+            if attempt == attempts - 1 or not retryable(error):
+                raise
+        except Exception:
+            db.session.rollback()
+            raise
+        time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def insert_batch(model, batch, results):
+    """Insert one batch of validated items and record their status.
+
+    Every batch runs a fixed number of statements: one IN lookup for
+    conflicts, one for the referenced rows, insert_missing for the
+    missing related rows and for the new rows, a bulk insert of the roles
+    links, then one commit. The transaction is retried by in_transaction.
+    """
+    spec = SPECS[model]
+    related = RELATED[model]
+    related_spec = SPECS[related]
+    key = spec['key']
+    related_key = related_spec['key']
+
+    existing = ids_by_key(model, [item[key] for _, item in batch])
+    new = []
+    for index, item in batch:
+        if item[key] in existing:
+            results[index] = {'index': index, 'status': 409}
+        else:
+            new.append((index, item))
+    if not new:
+        return
+
+    # referenced rows, a key alone references an existing row, the first
+    # valid occurrence of a key creates it
+    references = set()
+    related_rows = {}
+    for _, item in new:
+        for nested in item.get(spec['nested']) or []:
+            reference = reference_key(related, nested)
+            if reference is None:
+                continue
+            references.add(reference)
+            if is_valid(related, nested):
+                related_rows.setdefault(reference, {
+                    field: nested.get(field)
+                    for field in related_spec['fields']})
+
+    def insert():
+        related_ids = ids_by_key(related, sorted(references))
+        created_related = ids_of(related, insert_missing(
+            related, list(related_rows.values()), related_ids))
+        related_ids.update(created_related)
+        # skipped by the insert, another request created them meanwhile
+        related_ids.update(ids_by_key(related, [
+            k for k in sorted(references) if k not in related_ids]))
+        # same for the new rows, they get a 409
+        new_ids = ids_of(model, insert_missing(
+            model, [item for _, item in new], existing))
+
+        links = set()
+        for _, item in new:
+            if item[key] not in new_ids:
+                continue
+            for nested in item.get(spec['nested']) or []:
+                reference = reference_key(related, nested)
+                if reference in related_ids:
+                    links.add((new_ids[item[key]], related_ids[reference]))
+        if links:
+            links = [{
+                spec['column']: owner_id,
+                related_spec['column']: related_id
+            } for owner_id, related_id in sorted(links)]
+            db.session.execute(roles.insert(), links)
+            record_links(links)
+        # core inserts don't go through the flush hooks
+        bump_versions([model.__tablename__, related.__tablename__, 'roles'])
+        record_rows(
+            [(related.__tablename__, related_ids[k],
+              short(related, related_ids[k], related_rows[k]))
+             for k in sorted(created_related)] +
+            [(model.__tablename__, new_ids[item[key]],
+              short(model, new_ids[item[key]], item))
+             for _, item in new if item[key] in new_ids])
+        db.session.commit()
+        return new_ids
+
+    try:
+        new_ids = in_transaction(insert)
+    except Exception:
+        for index, _ in new:
+            results[index] = {'index': index, 'status': 422}
+        return
+
+    for index, item in new:
+        if item[key] in new_ids:
+            results[index] = {'index': index, 'status': 200,
+                              'id': new_ids[item[key]]}
+        else:
+            results[index] = {'index': index, 'status': 409}
+
+
+def bulk_create(model, items):
+    """Create every item of `items` and return one result per item.
+
+    Items are committed in batches of BULK_BATCH_SIZE. An invalid item,
+    or one with a value the database would reject (nested items
+    included), gets status 400, an item whose key already exists (in the
+    database, earlier in the payload, or created meanwhile by another
+    request) 409, and every item of a batch that fails to commit 422.
+    Other items are not affected.
+    """
+    spec = SPECS[model]
+    key = spec['key']
+    batch_size = current_app.config['BULK_BATCH_SIZE']
+    results = [None] * len(items)
+    seen = set()
+
+    for start in range(0, len(items), batch_size):
+        batch = []
+        for index in range(start, min(start + batch_size, len(items))):
+            item = items[index]
+            if not is_valid(model, item) or not accepted(model, item):
+                results[index] = {'index': index, 'status': 400}
+            elif item[key] in seen:
+                results[index] = {'index': index, 'status': 409}
+            else:
+                seen.add(item[key])
+                batch.append((index, item))
+        if batch:
+            insert_batch(model, batch, results)
+    return results
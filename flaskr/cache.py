@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import weakref
+import tempfile
+import threading
+from functools import wraps
+from collections import OrderedDict
+from flask import request, current_app, make_response, Response
+from models import commit_listeners
+from .etag import request_versions
+from .streaming import wants_stream
+
+
+class LRUBackend:
+    """In-process LRU store, private to one worker."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            self._entries.move_to_end(key)
+            return item[0]
+
+    def set(self, key, entry, tables):
+        with self._lock:
+            self._entries[key] = (entry, frozenset(tables))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tables):
+        with self._lock:
+            for key in [key for key, (_, tagged) in self._entries.items()
+                        if tagged & tables]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """File backed store shared by every worker of a host.
+
+    Each process (and thread) opens its own connection to the same WAL
+    database. Entries are evicted oldest first once `maxsize` is reached.
+    Storage errors, like a locked database, are treated as misses.
+    """
+
+    EVICT_EVERY = 64
+
+    def __init__(self, path=None, maxsize=1024):
+        self.path = path or os.path.join(tempfile.gettempdir(),
+                                         'actors-movies-cache.sqlite3')
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._sets = 0
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, tables TEXT NOT NULL, '
+            'entry TEXT NOT NULL, created REAL NOT NULL)')
+
+    def _connect(self):
+        # connections must not cross a fork
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def get(self, key):
+        try:
+            row = self._connect().execute(
+                'SELECT entry FROM responses WHERE key = ?',
+                (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, entry, tables):
+        try:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (key, ',%s,' % ','.join(sorted(tables)), json.dumps(entry),
+                 time.time()))
+            self._sets += 1
+            if self._sets % self.EVICT_EVERY == 0:
+                conn.execute(
+                    'DELETE FROM responses WHERE key NOT IN (SELECT key '
+                    'FROM responses ORDER BY created DESC LIMIT ?)',
+                    (self.maxsize,))
+        except sqlite3.Error:
+            pass
+
+    def invalidate(self, tables):
+        try:
+            conn = self._connect()
+            for table in tables:
+                conn.execute('DELETE FROM responses WHERE tables LIKE ?',
+                             (f'%,{table},%',))
+        except sqlite3.Error:
+            pass
+
+    def __len__(self):
+        try:
+            return self._connect().execute(
+                'SELECT count(*) FROM responses').fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+
+class ResponseCache:
+    """Cache of read responses with hit and miss counters.
+
+    Keys hold the path, the query parameters, the caller's permissions and
+    the versions of the tables the response was built from, so a commit
+    anywhere makes older entries unreachable. Committed writes also drop
+    the entries of the tables they touched right away.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        _caches.add(self)
+
+    def key(self, payload, versions):
+        raw = json.dumps([
+            request.path,
+            sorted(request.args.items(multi=True)),
+            sorted(payload.get('permissions', [])),
+            sorted(versions.items())
+        ])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, key, entry, tables):
+        self.backend.set(key, entry, tables)
+
+    def invalidate(self, tables):
+        self.backend.invalidate(frozenset(tables))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'size': len(self.backend),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+_caches = weakref.WeakSet()
+
+
+def invalidate_caches(tables):
+    for cache in list(_caches):
+        cache.invalidate(tables)
+
+
+commit_listeners.append(invalidate_caches)
+
+
+def make_cache(config):
+    """Build the cache selected by RESPONSE_CACHE, None when disabled."""
+    kind = config['RESPONSE_CACHE']
+    if kind == 'memory':
+        return ResponseCache(LRUBackend(config['RESPONSE_CACHE_SIZE']))
+    if kind == 'sqlite':
+        return ResponseCache(SQLiteBackend(config['RESPONSE_CACHE_PATH'],
+                                           config['RESPONSE_CACHE_SIZE']))
+    return None
+
+
+def cached(*tables):
+    """Serve the view from the response cache of the app.
+
+    The view must be wrapped by requires_auth. Only complete 200 responses
+    are stored, streamed responses bypass the cache.
+    """
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            cache = current_app.extensions.get('response_cache')
+            if cache is None or wants_stream():
+                return f(payload, *args, **kwargs)
+
+            key = cache.key(payload, request_versions(tables))
+            entry = cache.get(key)
+            if entry is not None:
+                return Response(entry['body'], mimetype=entry['mimetype'])
+
+            response = make_response(f(payload, *args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                cache.set(key, {
+                    'body': response.get_data(as_text=True),
+                    'mimetype': response.mimetype
+                }, tables)
+            return response
+
+        return wrapper
+    return cached_decorator
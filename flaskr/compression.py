@@ -0,0 +1,150 @@
+import time
+import zlib
+from flask import request
+from .cache import LRUBackend
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/plain',
+                'text/html')
+
+
+class ResponseCompressor:
+    """gzip and brotli encoding of the responses, by Accept-Encoding.
+
+    Bodies under `min_size` bytes are sent as they are, streamed bodies
+    are always encoded, chunk by chunk. Encoded bodies of responses with
+    an ETag are kept in an LRU keyed by ETag and encoding: the ETag tells
+    the body didn't change, so a list served again (from the response
+    cache or not) isn't compressed again.
+    """
+
+    def __init__(self, encodings=('br', 'gzip'), min_size=500, gzip_level=6,
+                 brotli_level=4, cache_size=256):
+        self.encodings = [encoding for encoding in encodings
+                          if encoding == 'gzip' or
+                          encoding == 'br' and brotli is not None]
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_level = brotli_level
+        self.encoded = LRUBackend(cache_size)
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+        self.cache_hits = 0
+
+    def compressor(self, encoding):
+        """Return (process, finish) functions of a new compressor."""
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_level)
+            return compressor.process, compressor.finish
+        # wbits 31 writes the gzip header and trailer
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+        return compressor.compress, compressor.flush
+
+    def compress(self, data, encoding):
+        started = time.perf_counter()
+        process, finish = self.compressor(encoding)
+        encoded = process(data) + finish()
+        self.count(len(data), len(encoded), time.perf_counter() - started)
+        return encoded
+
+    def count(self, bytes_in, bytes_out, seconds):
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.seconds += seconds
+
+    def compress_stream(self, chunks, encoding, close):
+        """Encode the chunks of a streamed body as they are produced."""
+        process, finish = self.compressor(encoding)
+        try:
+            for chunk in chunks:
+                started = time.perf_counter()
+                encoded = process(chunk)
+                self.count(len(chunk), len(encoded),
+                           time.perf_counter() - started)
+                if encoded:
+                    yield encoded
+            started = time.perf_counter()
+            encoded = finish()
+            self.count(0, len(encoded), time.perf_counter() - started)
+            yield encoded
+        finally:
+            if close is not None:
+                close()
+
+    def __call__(self, response):
+        """after_request hook encoding `response` when it is worth it."""
+        if response.mimetype not in COMPRESSIBLE or \
+                response.direct_passthrough or \
+                'Content-Encoding' in response.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        if not 200 <= response.status_code < 300 or \
+                response.status_code in (204, 206):
+            return response
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+
+        etag, _ = response.get_etag()
+        if response.is_streamed:
+            original = response.response
+            response.response = self.compress_stream(
+                response.iter_encoded(), encoding,
+                getattr(original, 'close', None))
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            key = (etag, encoding)
+            encoded = self.encoded.get(key) if etag else None
+            if encoded is None:
+                encoded = self.compress(data, encoding)
+                if etag:
+                    self.encoded.set(key, encoded, ())
+            else:
+                self.cache_hits += 1
+                self.count(len(data), len(encoded), 0.0)
+            response.set_data(encoded)
+        if etag:
+            # a strong ETag names one representation
+            response.set_etag(f'{etag}-{encoding}')
+        response.headers['Content-Encoding'] = encoding
+        self.responses += 1
+        return response
+
+    def stats(self):
+        return {
+            'responses': self.responses,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': self.bytes_out / self.bytes_in if self.bytes_in else 0.0,
+            'seconds': self.seconds,
+            'cache_hits': self.cache_hits,
+            'cache_size': len(self.encoded)
+        }
+
+
+def init_compression(app):
+    """Encode the responses of `app`, return its ResponseCompressor.
+
+    Call it after init_metrics, the hooks run in reverse order so the
+    compression time is part of the request duration.
+    """
+    config = app.config
+    encodings = [encoding.strip() for encoding in
+                 config['COMPRESS_ENCODINGS'].split(',') if encoding.strip()]
+    compressor = ResponseCompressor(
+        encodings, config['COMPRESS_MIN_SIZE'], config['COMPRESS_GZIP_LEVEL'],
+        config['COMPRESS_BROTLI_LEVEL'], config['COMPRESS_CACHE_SIZE'])
+    app.extensions['compression'] = compressor
+    if compressor.encodings:
+        app.after_request(compressor)
+    return compressor
@@ -0,0 +1,61 @@
+import json
+import hashlib
+from functools import wraps
+from flask import request, make_response, Response
+from models import table_versions
+from .streaming import media_type
+
+
+def request_versions(tables):
+    """Return the versions of `tables`, read once per request."""
+    versions = request.environ.get('flaskr.table_versions')
+    if versions is None or not set(tables) <= set(versions):
+        versions = table_versions(tables)
+        request.environ['flaskr.table_versions'] = versions
+    return versions
+
+
+def compute_etag(versions):
+    """Strong ETag of the current request for the given table versions.
+
+    The JSON and NDJSON representations of a URL have different ETags,
+    `?stream=true` included.
+    """
+    raw = json.dumps([request.full_path, media_type(),
+                      sorted(versions.items())])
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def variant_etags(etag):
+    """`etag` and the ETags of its gzip and brotli encoded variants."""
+    return [etag, f'{etag}-br', f'{etag}-gzip']
+
+
+def conditional(*tables):
+    """Answer If-None-Match from the change versions of `tables`.
+
+    The versions are read before the view runs, so a write landing in
+    between can only make the ETag older than the body, never newer. When
+    the client already has the current version the view isn't called and
+    a 304 is returned. The responses carry `Vary: Accept`, the Accept
+    header picks the representation.
+    """
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = compute_etag(request_versions(tables))
+            for variant in variant_etags(etag):
+                if request.if_none_match.contains(variant):
+                    response = Response(status=304)
+                    response.set_etag(variant)
+                    response.vary.add('Accept')
+                    return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                response.vary.add('Accept')
+            return response
+
+        return wrapper
+    return conditional_decorator
@@ -0,0 +1,66 @@
+import datetime
+from flask import request, abort
+from sqlalchemy import select
+from models import roles, Movie, Actor
+
+
+def date_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+
+def int_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def movie_filters():
+    """?release_date_from=, ?release_date_to= (YYYY-MM-DD, inclusive) and
+    ?actor_id= (movies the actor played in)."""
+    criteria = []
+    date_from = date_arg('release_date_from')
+    if date_from is not None:
+        criteria.append(Movie.release_date >= date_from)
+    date_to = date_arg('release_date_to')
+    if date_to is not None:
+        criteria.append(Movie.release_date <= date_to)
+    actor_id = int_arg('actor_id')
+    if actor_id is not None:
+        criteria.append(Movie.id.in_(
+            select([roles.c.movie_id]).where(roles.c.actor_id == actor_id)))
+    return criteria
+
+
+def actor_filters():
+    """?age_min=, ?age_max= (inclusive), ?gender= and ?movie_id= (actors
+    of the movie)."""
+    criteria = []
+    age_min = int_arg('age_min')
+    if age_min is not None:
+        criteria.append(Actor.age >= age_min)
+    age_max = int_arg('age_max')
+    if age_max is not None:
+        criteria.append(Actor.age <= age_max)
+    gender = request.args.get('gender')
+    if gender is not None:
+        criteria.append(Actor.gender == gender)
+    movie_id = int_arg('movie_id')
+    if movie_id is not None:
+        criteria.append(Actor.id.in_(
+            select([roles.c.actor_id]).where(roles.c.movie_id == movie_id)))
+    return criteria
+
+
+def list_filters(model):
+    """Return the WHERE criteria asked in the query string for `model`."""
+    return movie_filters() if model is Movie else actor_filters()
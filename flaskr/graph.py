@@ -0,0 +1,262 @@
+import sys
+import heapq
+import operator
+import weakref
+import threading
+from array import array
+from collections import Counter
+from itertools import accumulate, islice
+from models import db, roles, row_listeners
+from .rebuild import Rebuildable
+
+
+ACTORS, MOVIES = 0, 1
+# edges changed since the arrays were built that trigger a rebuild, at
+# least COMPACT_MIN or one in COMPACT_RATIO of the edges
+COMPACT_MIN = 10000
+COMPACT_RATIO = 8
+SCAN_CHUNK_SIZE = 10000
+
+
+class CSR:
+    """Neighbours of the nodes of one side of the roles graph.
+
+    The neighbours of the node `id` are targets[offsets[id]:offsets[id +
+    1]]. Nodes are indexed by their primary key, so a node costs 4 bytes
+    of offset and an edge 4 bytes of target, without any Python object.
+    """
+
+    def __init__(self, sources=(), targets=()):
+        counts = array('I', bytes(4 * (max(sources, default=-1) + 2)))
+        for source in sources:
+            counts[source + 1] += 1
+        self.offsets = array('I', accumulate(counts))
+        if all(map(operator.le, sources, islice(sources, 1, None))):
+            self.targets = array('I', targets)
+            return
+        # counting sort of the targets by source, stable
+        positions = self.offsets[:-1]
+        self.targets = array('I', bytes(4 * len(targets)))
+        for source, target in zip(sources, targets):
+            self.targets[positions[source]] = target
+            positions[source] += 1
+
+    def __getitem__(self, id):
+        if id + 1 >= len(self.offsets):
+            return self.targets[:0]
+        return self.targets[self.offsets[id]:self.offsets[id + 1]]
+
+    def __len__(self):
+        return len(self.targets)
+
+    def memory(self):
+        return sys.getsizeof(self.offsets) + sys.getsizeof(self.targets)
+
+
+class RolesGraph:
+    """The actors and movies linked by roles, as two CSR arrays.
+
+    `_csr[ACTORS]` holds the movies of every actor and `_csr[MOVIES]` the
+    actors of every movie. Links written after the arrays were built are
+    kept aside, added ones in sets per node and removed ones as (movie,
+    actor) pairs, until the next load. Co-stars of an actor are the actors
+    of its movies, the path between two actors is found by a breadth-first
+    search run from both ends at once.
+    """
+
+    def __init__(self):
+        self._csr = (CSR(), CSR())
+        self._added = ({}, {})
+        self._removed = set()
+        self._changes = 0
+        self._lock = threading.RLock()
+
+    def load(self, links):
+        """Replace the content with `links` of (movie_id, actor_id)."""
+        movies, actors = array('I'), array('I')
+        for movie_id, actor_id in links:
+            movies.append(movie_id)
+            actors.append(actor_id)
+        csr = (CSR(actors, movies), CSR(movies, actors))
+        with self._lock:
+            self._csr = csr
+            self._added = ({}, {})
+            self._removed = set()
+            self._changes = 0
+
+    def neighbours(self, side, id):
+        """Movies of the actor `id` (side ACTORS) or actors of the movie
+        `id` (side MOVIES)."""
+        found = self._csr[side][id]
+        added = self._added[side].get(id)
+        if not added and not self._removed:
+            return found
+        if self._removed:
+            pair = (lambda n: (n, id)) if side == ACTORS else \
+                (lambda n: (id, n))
+            found = [n for n in found if pair(n) not in self._removed]
+        return list(found) + list(added or ())
+
+    def add(self, movie_id, actor_id):
+        with self._lock:
+            if (movie_id, actor_id) in self._removed:
+                self._removed.discard((movie_id, actor_id))
+            elif movie_id in self.neighbours(ACTORS, actor_id):
+                return
+            else:
+                self._added[ACTORS].setdefault(actor_id, set()).add(movie_id)
+                self._added[MOVIES].setdefault(movie_id, set()).add(actor_id)
+            self._changes += 1
+
+    def remove(self, movie_id, actor_id):
+        with self._lock:
+            added = self._added[ACTORS].get(actor_id)
+            if added and movie_id in added:
+                added.discard(movie_id)
+                self._added[MOVIES][movie_id].discard(actor_id)
+            elif (movie_id, actor_id) not in self._removed and \
+                    movie_id in self._csr[ACTORS][actor_id]:
+                self._removed.add((movie_id, actor_id))
+            else:
+                return
+            self._changes += 1
+
+    def remove_node(self, side, id):
+        """Remove the links of a deleted actor or movie."""
+        with self._lock:
+            for n in list(self.neighbours(side, id)):
+                if side == ACTORS:
+                    self.remove(n, id)
+                else:
+                    self.remove(id, n)
+
+    def costars(self, actor_id, limit):
+        """Return ({actor_id: shared movies} of the `limit` actors sharing
+        the most movies with `actor_id`, ties by id, and their count)."""
+        with self._lock:
+            shared = Counter()
+            for movie_id in self.neighbours(ACTORS, actor_id):
+                shared.update(self.neighbours(MOVIES, movie_id))
+        shared.pop(actor_id, None)
+        top = heapq.nsmallest(limit, shared.items(),
+                              key=lambda item: (-item[1], item[0]))
+        return dict(top), len(shared)
+
+    def path(self, source, target, max_degrees=6):
+        """Shortest [actor, movie, actor, ..., actor] ids from `source` to
+        `target`, None when they are more than `max_degrees` apart.
+
+        Every step expands the smaller frontier by one degree (actor to
+        movie to actor). A level is expanded completely, the meeting
+        actor with the shortest total distance wins.
+        """
+        if source == target:
+            return [source]
+        # actor -> (degree, movie, previous actor), per direction
+        parents = ({source: (0, None, None)}, {target: (0, None, None)})
+        movies_seen = (set(), set())
+        frontiers = [[source], [target]]
+        degrees = [0, 0]
+        with self._lock:
+            while frontiers[0] and frontiers[1] and \
+                    sum(degrees) < max_degrees:
+                side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+                seen, other = parents[side], parents[1 - side]
+                degree = degrees[side] + 1
+                best = None
+                frontier = []
+                for actor_id in frontiers[side]:
+                    for movie_id in self.neighbours(ACTORS, actor_id):
+                        if movie_id in movies_seen[side]:
+                            continue
+                        movies_seen[side].add(movie_id)
+                        for costar in self.neighbours(MOVIES, movie_id):
+                            if costar in seen:
+                                continue
+                            seen[costar] = (degree, movie_id, actor_id)
+                            frontier.append(costar)
+                            if costar in other and (
+                                    best is None or
+                                    other[costar][0] < other[best][0]):
+                                best = costar
+                if best is not None:
+                    return self._join(parents, best)
+                frontiers[side] = frontier
+                degrees[side] = degree
+        return None
+
+    @staticmethod
+    def _join(parents, meeting):
+        halves = []
+        for side in (0, 1):
+            half = [meeting]
+            _, movie_id, actor_id = parents[side][meeting]
+            while movie_id is not None:
+                half += [movie_id, actor_id]
+                _, movie_id, actor_id = parents[side][actor_id]
+            halves.append(half)
+        return halves[0][::-1] + halves[1][1:]
+
+    def __len__(self):
+        """Number of links."""
+        return len(self._csr[ACTORS]) - len(self._removed) + \
+            sum(map(len, self._added[ACTORS].values()))
+
+    def memory(self):
+        """Approximate bytes held by the graph."""
+        size = sum(csr.memory() for csr in self._csr)
+        size += sys.getsizeof(self._removed)
+        for added in self._added:
+            size += sys.getsizeof(added) + sum(map(sys.getsizeof,
+                                                   added.values()))
+        return size
+
+
+class CostarGraph(Rebuildable, RolesGraph):
+    """RolesGraph over the roles of the database, rebuilt from the roles
+    table as a Rebuildable. It is also rebuilt when the links kept aside
+    reach a fraction of the graph.
+    """
+
+    tables = ('roles',)
+
+    def read(self):
+        self.load(db.session.query(roles.c.movie_id, roles.c.actor_id)
+                  .order_by(roles.c.movie_id, roles.c.actor_id)
+                  .yield_per(SCAN_CHUNK_SIZE))
+
+    def must_rebuild(self):
+        return self._changes > max(COMPACT_MIN,
+                                   len(self._csr[ACTORS]) // COMPACT_RATIO)
+
+    def apply_rows(self, rows):
+        for table, id, values in rows:
+            if table == 'roles':
+                (self.add if values is not None else self.remove)(*id)
+            elif values is None and table in ('actors', 'movies'):
+                self.remove_node(ACTORS if table == 'actors' else MOVIES,
+                                 id)
+
+    def stats(self):
+        return {
+            'edges': len(self),
+            'changes': self._changes,
+            'memory_bytes': self.memory()
+        }
+
+
+_graphs = weakref.WeakSet()
+
+
+def apply_to_graphs(rows):
+    for graph in list(_graphs):
+        graph.apply(rows)
+
+
+row_listeners.append(apply_to_graphs)
+
+
+def make_graph(config):
+    graph = CostarGraph(rebuild_interval=config['GRAPH_REBUILD_INTERVAL'])
+    _graphs.add(graph)
+    return graph
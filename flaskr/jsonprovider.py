@@ -0,0 +1,123 @@
+import time
+import codecs
+import datetime
+import functools
+import flask
+from flask import current_app, json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# called with the seconds spent by providers that bypass app.json_encoder
+serialize_listeners = []
+
+
+@functools.lru_cache(maxsize=4096)
+def escape_char(char):
+    """\\uXXXX escape of a character, as json.dumps(ensure_ascii=True)."""
+    code = ord(char)
+    if code < 0x10000:
+        return '\\u%04x' % code
+    code -= 0x10000
+    return '\\u%04x\\u%04x' % (0xd800 | code >> 10, 0xdc00 | code & 0x3ff)
+
+
+def escape_non_ascii(error):
+    """Codec error handler escaping the characters ASCII can't encode."""
+    chars = error.object[error.start:error.end]
+    return ''.join(map(escape_char, chars)), error.end
+
+
+codecs.register_error('flaskr.json', escape_non_ascii)
+
+
+@functools.lru_cache(maxsize=4096)
+def http_date(value):
+    """Flask's encoding of a date or datetime, the same few repeat."""
+    return json.JSONEncoder().default(value)
+
+
+class StdlibProvider:
+    """flask.json with the compact separators of jsonify."""
+
+    name = 'stdlib'
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+
+class OrjsonProvider:
+    """orjson with the output of StdlibProvider.
+
+    Dates are handed back to Flask's encoder so they stay HTTP dates, keys
+    are sorted and non-ASCII characters escaped following JSON_SORT_KEYS
+    and JSON_AS_ASCII. Values orjson rejects, like integers over 64 bits,
+    are encoded by StdlibProvider. Only floats can differ, orjson writes
+    1e-7 where json writes 1e-07.
+    """
+
+    name = 'orjson'
+
+    def __init__(self, sort_keys=True, ensure_ascii=True):
+        self.option = orjson.OPT_PASSTHROUGH_DATETIME | \
+            orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            self.option |= orjson.OPT_SORT_KEYS
+        self.ensure_ascii = ensure_ascii
+        self.encoder = json.JSONEncoder()
+        self.fallback = StdlibProvider()
+
+    def default(self, o):
+        if isinstance(o, datetime.date):
+            return http_date(o)
+        return self.encoder.default(o)
+
+    def dumps(self, obj):
+        started = time.perf_counter()
+        try:
+            data = orjson.dumps(obj, default=self.default,
+                                option=self.option)
+        except orjson.JSONEncodeError:
+            return self.fallback.dumps(obj)
+        if self.ensure_ascii:
+            if not data.isascii():
+                data = data.decode().encode('ascii', 'flaskr.json')
+            # json escapes DEL too
+            data = data.replace(b'\x7f', b'\\u007f')
+        seconds = time.perf_counter() - started
+        for listener in serialize_listeners:
+            listener(seconds)
+        return data
+
+
+def make_provider(config):
+    """Build the provider selected by JSON_PROVIDER.
+
+    'auto' and 'orjson' use orjson when it is installed, 'stdlib' always
+    uses the json module.
+    """
+    if config['JSON_PROVIDER'] != 'stdlib' and orjson is not None:
+        return OrjsonProvider(config['JSON_SORT_KEYS'],
+                              config['JSON_AS_ASCII'])
+    return StdlibProvider()
+
+
+def jsonify(*args, **kwargs):
+    """flask.jsonify through the JSON provider of the app.
+
+    Pretty printed responses (debug mode) are left to flask.jsonify.
+    """
+    app = current_app
+    provider = app.extensions.get('json_provider')
+    if provider is None or app.debug or \
+            app.config['JSONIFY_PRETTYPRINT_REGULAR']:
+        return flask.jsonify(*args, **kwargs)
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both '
+                        'args and kwargs')
+    data = args[0] if len(args) == 1 else args or kwargs
+    return app.response_class(provider.dumps(data) + b'\n',
+                              mimetype=app.config['JSONIFY_MIMETYPE'])
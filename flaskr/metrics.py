@@ -0,0 +1,250 @@
+import time
+import threading
+from bisect import bisect_left
+from flask import request, has_request_context, json
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from auth import auth_listeners, jwks_cache, token_cache
+from models import db, pool_listeners
+from .jsonprovider import serialize_listeners
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# upper bounds of the latency buckets, in seconds
+SECONDS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+           5, 10)
+# upper bounds of the SQL statements per request buckets
+STATEMENTS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+PHASES = ('auth', 'pool', 'db', 'serialize')
+# keys of the stats sources that only grow, exported as counters
+COUNTERS = ('hits', 'misses', 'cache_hits')
+# per request counters, kept in the WSGI environ like the table versions
+ENVIRON_KEY = 'flaskr.metrics'
+
+
+class Histogram:
+    """Cumulative-at-render histogram with fixed bucket upper bounds."""
+
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self, bounds):
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, bounds, value):
+        self.counts[bisect_left(bounds, value)] += 1
+        self.sum += value
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def format_labels(labels):
+    return ','.join(f'{name}="{escape(value)}"' for name, value in labels)
+
+
+class Metrics:
+    """Request latencies and SQL counters of one worker.
+
+    Every request gets a histogram sample of its total latency, of the
+    time spent in requires_auth, waiting for a pooled connection, running
+    SQL and encoding JSON, and of the number of statements it ran,
+    labelled by route, method and status.
+    Observations only take a lock and a bisect, and the label space is
+    bounded by the URL rules, so it can stay on in production.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._phases = {}
+        self._statements = {}
+        self.sources = {}
+
+    def observe(self, labels, state, total):
+        with self._lock:
+            histogram = self._requests.get(labels)
+            if histogram is None:
+                histogram = self._requests[labels] = Histogram(SECONDS)
+            histogram.observe(SECONDS, total)
+            for phase in PHASES:
+                key = labels + (('phase', phase),)
+                histogram = self._phases.get(key)
+                if histogram is None:
+                    histogram = self._phases[key] = Histogram(SECONDS)
+                histogram.observe(SECONDS, state[phase])
+            histogram = self._statements.get(labels)
+            if histogram is None:
+                histogram = self._statements[labels] = Histogram(STATEMENTS)
+            histogram.observe(STATEMENTS, state['statements'])
+
+    def render(self):
+        """Return every metric in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name, help, bounds, histograms in (
+                    ('flaskr_request_duration_seconds',
+                     'Time spent handling a request.',
+                     SECONDS, self._requests),
+                    ('flaskr_request_phase_seconds',
+                     'Time spent authenticating, waiting for a connection, '
+                     'running SQL and encoding JSON per request.',
+                     SECONDS, self._phases),
+                    ('flaskr_request_sql_statements',
+                     'SQL statements executed per request.',
+                     STATEMENTS, self._statements)):
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} histogram')
+                for labels in sorted(histograms):
+                    histogram = histograms[labels]
+                    text = format_labels(labels)
+                    count = 0
+                    for bound, value in zip(bounds + ('+Inf',),
+                                            histogram.counts):
+                        count += value
+                        lines.append(f'{name}_bucket{{{text},le="{bound}"}} '
+                                     f'{count}')
+                    lines.append(f'{name}_sum{{{text}}} {histogram.sum!r}')
+                    lines.append(f'{name}_count{{{text}}} {count}')
+
+        for source, stats in sorted(self.sources.items()):
+            values = stats() if stats is not None else None
+            for key, value in sorted((values or {}).items()):
+                if isinstance(value, bool) or \
+                        not isinstance(value, (int, float)):
+                    continue
+                name = f'flaskr_{source}_{key}'
+                if key in COUNTERS:
+                    name += '_total'
+                    lines.append(f'# TYPE {name} counter')
+                else:
+                    lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+
+def request_state():
+    if not has_request_context():
+        return None
+    return request.environ.get(ENVIRON_KEY)
+
+
+def add_auth_time(seconds):
+    state = request_state()
+    if state is not None:
+        state['auth'] += seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    state = request_state()
+    if state is not None:
+        conn.info.setdefault('flaskr.started', []).append(
+            (state, time.perf_counter()))
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context,
+                  executemany):
+    started = conn.info.get('flaskr.started')
+    if started:
+        state, start = started.pop()
+        state['db'] += time.perf_counter() - start
+        state['statements'] += 1
+
+
+@event.listens_for(Engine, 'handle_error')
+def failed_statement(context):
+    started = context.connection.info.get('flaskr.started') \
+        if context.connection is not None else None
+    if started:
+        state, start = started.pop()
+        state['db'] += time.perf_counter() - start
+        state['statements'] += 1
+
+
+def add_pool_time(seconds):
+    state = request_state()
+    if state is not None:
+        state['pool'] += seconds
+
+
+def add_serialize_time(seconds):
+    state = request_state()
+    if state is not None:
+        state['serialize'] += seconds
+
+
+auth_listeners.append(add_auth_time)
+pool_listeners.append(add_pool_time)
+serialize_listeners.append(add_serialize_time)
+
+
+class TimedJSONEncoder(json.JSONEncoder):
+    """Flask's encoder, adding the encoding time to the request metrics."""
+
+    def encode(self, o):
+        state = request_state()
+        if state is None:
+            return super().encode(o)
+        started = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            state['serialize'] += time.perf_counter() - started
+
+
+def init_metrics(app):
+    """Record the requests of `app` in a Metrics stored in its extensions."""
+    metrics = Metrics()
+    metrics.sources.update({
+        'jwks_cache': jwks_cache.stats,
+        'token_cache': token_cache.stats,
+        'response_cache': getattr(app.extensions.get('response_cache'),
+                                  'stats', None),
+        'search_index': app.extensions['search_index'].stats,
+        'costar_graph': app.extensions['costar_graph'].stats,
+        'db_pool': lambda: getattr(db.get_engine(app).pool, 'stats',
+                                   dict)(),
+        'compression': lambda: getattr(app.extensions.get('compression'),
+                                       'stats', dict)(),
+        'replicas': getattr(app.extensions.get('replicas'), 'stats', None)
+    })
+    app.extensions['metrics'] = metrics
+    app.json_encoder = TimedJSONEncoder
+
+    @app.before_request
+    def start_request():
+        request.environ[ENVIRON_KEY] = {
+            'started': time.perf_counter(),
+            'auth': 0.0,
+            'pool': 0.0,
+            'db': 0.0,
+            'serialize': 0.0,
+            'statements': 0
+        }
+
+    @app.after_request
+    def record_request(response):
+        state = request.environ.get(ENVIRON_KEY)
+        if state is None:
+            return response
+        rule = request.url_rule
+        labels = (('route', rule.rule if rule is not None else 'unmatched'),
+                  ('method', request.method),
+                  ('status', str(response.status_code)))
+
+        def observe():
+            metrics.observe(labels, state,
+                            time.perf_counter() - state['started'])
+        # streamed bodies are produced after this hook, count them at close
+        if response.is_streamed:
+            response.call_on_close(observe)
+        else:
+            observe()
+        return response
+
+    return metrics
@@ -0,0 +1,76 @@
+import json
+import base64
+from flask import request, abort, current_app
+
+
+def encode_cursor(last_id):
+    """Return an opaque cursor pointing after the row `last_id`."""
+    raw = json.dumps({'id': last_id}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the id stored in `cursor` or abort with 400."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        last_id = json.loads(base64.urlsafe_b64decode(padded))['id']
+    except Exception:
+        abort(400)
+    if not isinstance(last_id, int):
+        abort(400)
+    return last_id
+
+
+def read_limit(default, maximum):
+    """Return `?limit=` capped by `maximum`, `default` without it.
+
+    Aborts with 400 unless the limit is a positive integer.
+    """
+    limit = request.args.get('limit')
+    if limit is None:
+        return default
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, maximum)
+
+
+def page_args():
+    """Read `limit`, `after` and `all` from the query string.
+
+    Returns (limit, after_id). limit is None when the client asked for the
+    whole table with `?all=true` and the deployment allows it.
+    """
+    if request.args.get('all', '').lower() in ('1', 'true'):
+        if not current_app.config['ALLOW_UNPAGINATED']:
+            abort(400)
+        return None, None
+
+    limit = read_limit(current_app.config['DEFAULT_PAGE_SIZE'],
+                       current_app.config['MAX_PAGE_SIZE'])
+
+    after = request.args.get('after')
+    after_id = decode_cursor(after) if after else None
+    return limit, after_id
+
+
+def paginate(query, column, limit, after_id):
+    """Return (rows, next_cursor) for one keyset page of `query`.
+
+    The page is selected with `column > after_id` so deep pages cost the
+    same as the first one. One extra row is fetched to know whether a next
+    page exists.
+    """
+    query = query.order_by(column)
+    if limit is None:
+        return query.all(), None
+    if after_id is not None:
+        query = query.filter(column > after_id)
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1].id)
+    return rows, None
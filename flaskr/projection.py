@@ -0,0 +1,114 @@
+from flask import request, abort
+from models import db, Movie, Actor, RELATED_CHUNK_SIZE
+from .pagination import paginate
+
+
+# output field -> model attribute, and the name of the nested collection
+FIELDS = {
+    Actor: ({'id': 'id', 'name': 'name', 'age': 'age', 'gender': 'gender'},
+            'movies'),
+    Movie: ({'id': 'id', 'title': 'title', 'release date': 'release_date'},
+            'actors')
+}
+ALIASES = {'release_date': 'release date'}
+
+
+def requested_fields(model):
+    """Return the output fields asked with ?view=short|long and ?fields=.
+
+    `view=short` is every scalar field of short(), `view=long` (default)
+    adds the nested collection like long(). `?fields=` picks individual
+    fields and wins over `?view=`. Unknown names abort with 400.
+    """
+    scalars, relation = FIELDS[model]
+    view = request.args.get('view', 'long')
+    if view not in ('short', 'long'):
+        abort(400)
+
+    fields = request.args.get('fields')
+    if fields:
+        names = []
+        for name in fields.split(','):
+            name = ALIASES.get(name.strip(), name.strip())
+            if name not in scalars and name != relation:
+                abort(400)
+            if name not in names:
+                names.append(name)
+        return names
+
+    names = list(scalars)
+    if view == 'long':
+        names.append(relation)
+    return names
+
+
+def list_page(model, limit, after_id, names, criteria=()):
+    """Return (items, next_cursor) for one page limited to `names`.
+
+    `criteria` are WHERE clauses applied before paging. Only the nested
+    collection needs the roles table and full ORM rows. Without it the
+    query selects just the requested columns.
+    """
+    scalars, relation = FIELDS[model]
+    if relation in names:
+        rows, next_cursor = paginate(model.query.filter(*criteria),
+                                     model.id, limit, after_id)
+        items = model.long_many(rows)
+        if len(names) <= len(scalars):
+            items = [{name: item[name] for name in names} for item in items]
+        return items, next_cursor
+
+    # the id column is always selected, the cursor is built from it
+    columns = [model.id] + [getattr(model, scalars[name])
+                            for name in names if name != 'id']
+    rows, next_cursor = paginate(db.session.query(*columns)
+                                 .filter(*criteria), model.id,
+                                 limit, after_id)
+    items = [{name: getattr(row, scalars[name]) for name in names}
+             for row in rows]
+    return items, next_cursor
+
+
+def requested_ids():
+    """Return the ids of ?ids=1,2,3 in the requested order, without
+    duplicates, or None without ?ids=. Anything but integers aborts with
+    400."""
+    value = request.args.get('ids')
+    if value is None:
+        return None
+    try:
+        ids = [int(id) for id in value.split(',') if id.strip()]
+    except ValueError:
+        abort(400)
+    if not ids:
+        abort(400)
+    return list(dict.fromkeys(ids))
+
+
+def fetch_by_ids(model, ids, names):
+    """Return (items, missing) for the rows `ids` limited to `names`.
+
+    The rows are read with one primary key IN query, plus one for the
+    nested collection when it is asked for, per RELATED_CHUNK_SIZE ids so
+    the bound parameters stay within the database limits. Items follow
+    the order of `ids`, missing lists the ids without a row.
+    """
+    scalars, relation = FIELDS[model]
+    found = {}
+    for start in range(0, len(ids), RELATED_CHUNK_SIZE):
+        chunk = ids[start:start + RELATED_CHUNK_SIZE]
+        if relation in names:
+            rows = model.query.filter(model.id.in_(chunk)).all()
+            for row, item in zip(rows, model.long_many(rows)):
+                if len(names) <= len(scalars):
+                    item = {name: item[name] for name in names}
+                found[row.id] = item
+        else:
+            columns = [model.id] + [getattr(model, scalars[name])
+                                    for name in names if name != 'id']
+            rows = db.session.query(*columns).filter(model.id.in_(chunk))
+            found.update((row.id, {name: getattr(row, scalars[name])
+                                   for name in names})
+                         for row in rows)
+    return ([found[id] for id in ids if id in found],
+            [id for id in ids if id not in found])
@@ -0,0 +1,90 @@
+import time
+import threading
+from models import db, table_versions
+
+
+class Rebuildable:
+    """In-memory copy of database tables kept fresh by each worker.
+
+    The copy is built on first use (or by `build()` at worker start) and
+    then follows the rows committed by this worker through `apply()`.
+    Rows written by other workers are picked up by a background rebuild,
+    at most every `rebuild_interval` seconds, when the versions of
+    `tables` moved.
+
+    Subclasses set `tables`, load the copy from the database in `read()`
+    and apply written rows in `apply_rows()`, both under `self._lock`
+    when they change the copy. `must_rebuild()` can ask for a rebuild
+    regardless of the versions.
+    """
+
+    tables = ()
+
+    def __init__(self, rebuild_interval=60, **kwargs):
+        super().__init__(**kwargs)
+        self.rebuild_interval = rebuild_interval
+        self.versions = None
+        self.built_at = None
+        self._rebuilding = False
+        self._replay = None
+
+    def read(self):
+        raise NotImplementedError
+
+    def apply_rows(self, rows):
+        raise NotImplementedError
+
+    def must_rebuild(self):
+        return False
+
+    def build(self):
+        # rows committed while the tables are read are applied again after
+        with self._lock:
+            self._replay = []
+        try:
+            versions = table_versions(self.tables)
+            self.read()
+        finally:
+            with self._lock:
+                replay, self._replay = self._replay, None
+        self.versions = versions
+        self.built_at = time.monotonic()
+        self.apply(replay)
+
+    def rebuild_async(self, app):
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+
+        def rebuild():
+            try:
+                with app.app_context():
+                    self.build()
+                    db.session.remove()
+            finally:
+                self._rebuilding = False
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def ensure_fresh(self, app, versions):
+        """Build the copy if needed, rebuild it when other workers wrote.
+
+        `versions` may hold other tables than `tables`, they are ignored.
+        """
+        if self.built_at is None:
+            with self._lock:
+                if self.built_at is None:
+                    self.build()
+            return
+        versions = {table: versions[table] for table in self.tables}
+        if self.must_rebuild() or versions != self.versions and \
+                time.monotonic() - self.built_at > self.rebuild_interval:
+            self.rebuild_async(app)
+
+    def apply(self, rows):
+        with self._lock:
+            if self._replay is not None:
+                self._replay.extend(rows)
+        if self.built_at is None:
+            return
+        self.apply_rows(rows)
@@ -0,0 +1,209 @@
+import time
+import random
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request
+from sqlalchemy import create_engine, event, exc, text
+from models import READ_ENGINE_KEY, engine_options
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# expiry time of the primary stickiness of a client that wrote
+STICKY_COOKIE = 'flaskr_primary_until'
+# 0 when the replica replayed all it received, else the age of the last
+# transaction it replayed
+LAG_SQL = text(
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() '
+    'THEN 0 ELSE EXTRACT(EPOCH FROM now() - '
+    'pg_last_xact_replay_timestamp()) END')
+
+
+class ReplicaSet:
+    """Read replicas and their health.
+
+    Every `check_interval` seconds a request starts a background check of
+    the replicas, the ones that answer and lag at most `max_lag` seconds
+    are used until the next check. A replica whose connection fails is
+    dropped until the next check. Without a healthy replica, until the
+    first check is done too, reads go to the primary.
+    """
+
+    def __init__(self, urls, options=None, max_lag=10, check_interval=5):
+        self.engines = [create_engine(url, **(options or {}).get(url, {}))
+                        for url in urls]
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self.failed)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.healthy = []
+        self.next_check = 0.0
+        self._lock = threading.Lock()
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.sticky_reads = 0
+        self.failures = 0
+
+    def measure_lag(self, engine):
+        """Seconds `engine` lags behind the primary, 0 if not a standby."""
+        with engine.connect() as conn:
+            if conn.dialect.name != 'postgresql' or \
+                    not conn.scalar(text('SELECT pg_is_in_recovery()')):
+                conn.execute(text('SELECT 1'))
+                return 0.0
+            return float(conn.scalar(LAG_SQL) or 0)
+
+    def check(self):
+        healthy = []
+        for engine in self.engines:
+            try:
+                lag = self.measure_lag(engine)
+            except exc.SQLAlchemyError:
+                continue
+            if lag <= self.max_lag:
+                healthy.append(engine)
+        self.healthy = healthy
+
+    def check_async(self):
+        """Check the replicas in a daemon thread, released by it."""
+        def check():
+            try:
+                self.check()
+            finally:
+                self._lock.release()
+        threading.Thread(target=check, daemon=True).start()
+
+    def pick(self):
+        """Return the engine of a healthy replica, None for the primary."""
+        now = time.monotonic()
+        # requests keep the previous result during a check, a replica that
+        # doesn't answer only slows the check down
+        if now >= self.next_check and self._lock.acquire(blocking=False):
+            self.next_check = now + self.check_interval
+            self.check_async()
+        healthy = self.healthy
+        if not healthy:
+            self.primary_reads += 1
+            return None
+        self.replica_reads += 1
+        return random.choice(healthy)
+
+    def failed(self, context):
+        if context.engine in self.healthy:
+            self.failures += 1
+            self.healthy = [engine for engine in self.healthy
+                            if engine is not context.engine]
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+    def stats(self):
+        return {
+            'replicas': len(self.engines),
+            'healthy': len(self.healthy),
+            'replica_reads': self.replica_reads,
+            'primary_reads': self.primary_reads,
+            'sticky_reads': self.sticky_reads,
+            'failures': self.failures
+        }
+
+
+class StickyClients:
+    """Expiry times of the primary stickiness of the clients that wrote,
+    keyed by the SHA-256 of their bearer token.
+
+    Every entry lasts the same `window`, so the oldest ones come first and
+    the expired ones are dropped from the front as new ones are added.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._expiries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        now = time.time()
+        with self._lock:
+            self._expiries[key] = now + self.window
+            self._expiries.move_to_end(key)
+            while next(iter(self._expiries.values())) <= now:
+                self._expiries.popitem(last=False)
+
+    def __contains__(self, key):
+        expires_at = self._expiries.get(key)
+        return expires_at is not None and expires_at > time.time()
+
+    def __len__(self):
+        return len(self._expiries)
+
+
+def client_key():
+    """SHA-256 of the bearer token of the request, None without one."""
+    parts = request.headers.get('Authorization', '').split()
+    if len(parts) != 2 or parts[0].lower() != 'bearer':
+        return None
+    return hashlib.sha256(parts[1].encode()).hexdigest()
+
+
+def sticky(cookie):
+    """True while the stickiness cookie of a client is not expired."""
+    try:
+        return float(cookie or 0) > time.time()
+    except ValueError:
+        return False
+
+
+def init_replicas(app):
+    """Route the reads of safe requests to the replicas of
+    DATABASE_REPLICA_URLS, return the ReplicaSet or None without any.
+
+    A client that wrote reads from the primary for REPLICA_STICKY_SECONDS,
+    so it reads its own writes. The stickiness is kept by bearer token in
+    this worker, and in a cookie for the clients that send it back to the
+    other workers.
+    """
+    config = app.config
+    urls = [url.strip() for url in config['DATABASE_REPLICA_URLS'].split(',')
+            if url.strip()]
+    if not urls:
+        app.extensions['replicas'] = None
+        return None
+    options = {url: engine_options(config, url) for url in urls}
+    for url in urls:
+        if url.startswith('postgres'):
+            options[url]['connect_args'] = {
+                'connect_timeout': config['REPLICA_CONNECT_TIMEOUT']}
+    replicas = ReplicaSet(urls, options,
+                          config['REPLICA_MAX_LAG_SECONDS'],
+                          config['REPLICA_CHECK_INTERVAL'])
+    app.extensions['replicas'] = replicas
+    window = config['REPLICA_STICKY_SECONDS']
+    clients = StickyClients(window)
+
+    @app.before_request
+    def route_reads():
+        if request.method not in SAFE_METHODS:
+            return
+        key = client_key()
+        if key is not None and key in clients or \
+                sticky(request.cookies.get(STICKY_COOKIE)):
+            replicas.sticky_reads += 1
+            return
+        engine = replicas.pick()
+        if engine is not None:
+            request.environ[READ_ENGINE_KEY] = engine
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method not in SAFE_METHODS and \
+                response.status_code < 400 and window > 0:
+            key = client_key()
+            if key is not None:
+                clients.add(key)
+            response.set_cookie(STICKY_COOKIE, '%.3f' % (time.time() + window),
+                                max_age=window, httponly=True,
+                                samesite='Lax')
+        return response
+
+    return replicas
@@ -0,0 +1,342 @@
+import sys
+import weakref
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+from models import db, Movie, Actor, row_listeners
+from .rebuild import Rebuildable
+
+
+# only the first KEY_LENGTH folded characters of every word start are kept
+KEY_LENGTH = 16
+KINDS = ('actors', 'movies')
+LABELS = {'actors': 'name', 'movies': 'title'}
+
+
+def fold(text):
+    """Lower case `text` and strip its accents."""
+    if text.isascii():
+        return text.lower()
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed
+                   if not unicodedata.combining(c)).casefold()
+
+
+def word_starts(folded):
+    """Positions of the words of `folded`, the first one is always 0."""
+    return [i for i, c in enumerate(folded)
+            if c.isalnum() and (i == 0 or not folded[i - 1].isalnum())] or [0]
+
+
+class SortedKeys:
+    """Sorted (key, ref) pairs packed in blocks of at most 2 * BLOCK.
+
+    A block is one bytes blob of UTF-8 keys with an array of offsets and
+    a parallel array of refs, so an entry costs a few bytes instead of a
+    Python object. The first pair of every block is kept in `_firsts` to
+    find the block of a key by bisection. Inserts and deletes only copy
+    one block.
+    """
+
+    BLOCK = 512
+
+    def __init__(self, entries=()):
+        self._blobs = []
+        self._offsets = []
+        self._refs = []
+        self._firsts = []
+        self._size = len(entries)
+        for start in range(0, len(entries), self.BLOCK):
+            self._append(entries[start:start + self.BLOCK])
+
+    def _append(self, chunk):
+        keys = [key for key, _ in chunk]
+        self._blobs.append(b''.join(keys))
+        self._offsets.append(array('I', accumulate(map(len, keys),
+                                                   initial=0)))
+        self._refs.append(array('q', (ref for _, ref in chunk)))
+        self._firsts.append(chunk[0])
+
+    def _pair(self, block, i):
+        offsets = self._offsets[block]
+        return (self._blobs[block][offsets[i]:offsets[i + 1]],
+                self._refs[block][i])
+
+    def _locate(self, pair):
+        """(block, index) of the first entry not smaller than `pair`."""
+        block = max(bisect_right(self._firsts, pair) - 1, 0)
+        lo, hi = 0, len(self._refs[block])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._pair(block, mid) < pair:
+                lo = mid + 1
+            else:
+                hi = mid
+        return block, lo
+
+    def insert(self, key, ref):
+        if not self._refs:
+            self._append([(key, ref)])
+            self._size = 1
+            return
+        block, i = self._locate((key, ref))
+        offsets = self._offsets[block]
+        start = offsets[i]
+        self._blobs[block] = b''.join((self._blobs[block][:start], key,
+                                       self._blobs[block][start:]))
+        shifted = offsets[:i + 1]
+        shifted.extend(offset + len(key) for offset in offsets[i:])
+        self._offsets[block] = shifted
+        self._refs[block].insert(i, ref)
+        if i == 0:
+            self._firsts[block] = (key, ref)
+        self._size += 1
+        if len(self._refs[block]) > 2 * self.BLOCK:
+            self._split(block)
+
+    def _split(self, block):
+        pairs = [self._pair(block, i)
+                 for i in range(len(self._refs[block]))]
+        del self._blobs[block], self._offsets[block], self._refs[block]
+        del self._firsts[block]
+        for part in (pairs[self.BLOCK:], pairs[:self.BLOCK]):
+            keys = [key for key, _ in part]
+            self._blobs.insert(block, b''.join(keys))
+            self._offsets.insert(block, array('I', accumulate(
+                map(len, keys), initial=0)))
+            self._refs.insert(block, array('q', (ref for _, ref in part)))
+            self._firsts.insert(block, part[0])
+
+    def remove(self, key, ref):
+        if not self._refs:
+            return
+        block, i = self._locate((key, ref))
+        if i == len(self._refs[block]) or self._pair(block, i) != (key, ref):
+            return
+        offsets = self._offsets[block]
+        start, end = offsets[i], offsets[i + 1]
+        self._blobs[block] = self._blobs[block][:start] + \
+            self._blobs[block][end:]
+        shifted = offsets[:i + 1]
+        shifted.extend(offset - (end - start) for offset in offsets[i + 2:])
+        self._offsets[block] = shifted
+        del self._refs[block][i]
+        self._size -= 1
+        if not self._refs[block]:
+            del self._blobs[block], self._offsets[block], self._refs[block]
+            del self._firsts[block]
+        elif i == 0:
+            self._firsts[block] = self._pair(block, 0)
+
+    def scan(self, prefix):
+        """Yield the (key, ref) pairs whose key starts with `prefix`."""
+        if not self._refs:
+            return
+        block, i = self._locate((prefix, -1))
+        while block < len(self._refs):
+            for i in range(i, len(self._refs[block])):
+                pair = self._pair(block, i)
+                if not pair[0].startswith(prefix):
+                    return
+                yield pair
+            block, i = block + 1, 0
+
+    def __len__(self):
+        return self._size
+
+    def memory(self):
+        size = sys.getsizeof(self._firsts)
+        size += sum(sys.getsizeof(key) for key, _ in self._firsts)
+        for parts in (self._blobs, self._offsets, self._refs):
+            size += sys.getsizeof(parts) + sum(map(sys.getsizeof, parts))
+        return size
+
+
+class Labels:
+    """Labels of one kind indexed by id, in one append-only blob.
+
+    `_slots[id]` packs the offset and length + 1 of the UTF-8 label, 0
+    meaning no label. Replaced labels leave garbage in the blob until the
+    index is loaded again.
+    """
+
+    def __init__(self):
+        self._blob = bytearray()
+        self._slots = array('Q')
+        self._count = 0
+
+    def get(self, id):
+        if id >= len(self._slots) or not self._slots[id]:
+            return None
+        slot = self._slots[id]
+        start, length = slot >> 20, (slot & 0xFFFFF) - 1
+        return self._blob[start:start + length].decode()
+
+    def set(self, id, label):
+        raw = label.encode()
+        if len(raw) > 0xFFFFE:
+            # cut on a character boundary
+            raw = raw[:0xFFFFE].decode(errors='ignore').encode()
+        if id >= len(self._slots):
+            self._slots.extend(bytes(8 * (id + 1 - len(self._slots))))
+        if not self._slots[id]:
+            self._count += 1
+        self._slots[id] = len(self._blob) << 20 | (len(raw) + 1)
+        self._blob += raw
+
+    def delete(self, id):
+        if id < len(self._slots) and self._slots[id]:
+            self._slots[id] = 0
+            self._count -= 1
+
+    def __len__(self):
+        return self._count
+
+    def memory(self):
+        return sys.getsizeof(self._blob) + sys.getsizeof(self._slots)
+
+
+class PrefixIndex:
+    """In-memory type-ahead index over actor names and movie titles.
+
+    Every name is folded (case and accents) and indexed once per word, so
+    "bra" finds "Brad Pitt" and "Zoe Brand". Keys of first words and of
+    later words live in two SortedKeys, a ref packs id << 1 | kind.
+    Suggestions are names starting with the query, then names with a
+    later word starting with it, each in alphabetical order.
+    """
+
+    def __init__(self, scan_limit=1000):
+        self.scan_limit = scan_limit
+        self._first = SortedKeys()
+        self._other = SortedKeys()
+        self._labels = (Labels(), Labels())
+        self._lock = threading.RLock()
+
+    def _entries(self, kind, id, label):
+        folded = fold(label)
+        for position in word_starts(folded):
+            key = folded[position:position + KEY_LENGTH].encode()
+            yield position == 0, key, id << 1 | kind
+
+    def load(self, rows):
+        """Replace the content with `rows` of (table, id, label)."""
+        first, other = [], []
+        labels = (Labels(), Labels())
+        for table, id, label in rows:
+            kind = KINDS.index(table)
+            labels[kind].set(id, label)
+            for is_first, key, ref in self._entries(kind, id, label):
+                (first if is_first else other).append((key, ref))
+        first.sort()
+        other.sort()
+        first, other = SortedKeys(first), SortedKeys(other)
+        with self._lock:
+            self._first, self._other = first, other
+            self._labels = labels
+
+    def add(self, table, id, label):
+        kind = KINDS.index(table)
+        with self._lock:
+            self.remove(table, id)
+            self._labels[kind].set(id, label)
+            for is_first, key, ref in self._entries(kind, id, label):
+                (self._first if is_first else self._other).insert(key, ref)
+
+    def remove(self, table, id):
+        kind = KINDS.index(table)
+        with self._lock:
+            label = self._labels[kind].get(id)
+            if label is None:
+                return
+            for is_first, key, ref in self._entries(kind, id, label):
+                (self._first if is_first else self._other).remove(key, ref)
+            self._labels[kind].delete(id)
+
+    def suggest(self, query, limit=10, table=None):
+        """Return up to `limit` (table, id, label) matching `query`."""
+        folded = fold(query).strip()
+        if not folded:
+            return []
+        prefix = folded[:KEY_LENGTH].encode()
+        found = []
+        seen = set()
+        with self._lock:
+            for keys, is_first in ((self._first, True),
+                                   (self._other, False)):
+                scanned = 0
+                for _, ref in keys.scan(prefix):
+                    scanned += 1
+                    if len(found) == limit or scanned > self.scan_limit:
+                        break
+                    kind, id = ref & 1, ref >> 1
+                    if ref in seen or \
+                            (table is not None and KINDS[kind] != table):
+                        continue
+                    label = self._labels[kind].get(id)
+                    # keys are truncated, check long queries on the label
+                    if len(folded) > KEY_LENGTH and not (
+                            fold(label).startswith(folded) if is_first
+                            else folded in fold(label)):
+                        continue
+                    seen.add(ref)
+                    found.append((KINDS[kind], id, label))
+        return found
+
+    def __len__(self):
+        return len(self._first) + len(self._other)
+
+    def memory(self):
+        """Approximate bytes held by the index."""
+        return self._first.memory() + self._other.memory() + \
+            sum(labels.memory() for labels in self._labels)
+
+
+class SearchIndex(Rebuildable, PrefixIndex):
+    """PrefixIndex over the actors and movies of the database, rebuilt
+    from the actors and movies tables as a Rebuildable."""
+
+    tables = KINDS
+
+    def read(self):
+        rows = [('actors', id, name)
+                for id, name in db.session.query(Actor.id, Actor.name)]
+        rows += [('movies', id, title) for id, title
+                 in db.session.query(Movie.id, Movie.title)]
+        self.load(rows)
+
+    def apply_rows(self, rows):
+        for table, id, values in rows:
+            if table not in LABELS:
+                continue
+            if values is None:
+                self.remove(table, id)
+            else:
+                self.add(table, id, values[LABELS[table]])
+
+    def stats(self):
+        return {
+            'keys': len(self),
+            'actors': len(self._labels[0]),
+            'movies': len(self._labels[1]),
+            'memory_bytes': self.memory()
+        }
+
+
+_indexes = weakref.WeakSet()
+
+
+def apply_to_indexes(rows):
+    for index in list(_indexes):
+        index.apply(rows)
+
+
+row_listeners.append(apply_to_indexes)
+
+
+def make_index(config):
+    index = SearchIndex(rebuild_interval=config['SEARCH_REBUILD_INTERVAL'])
+    _indexes.add(index)
+    return index
@@ -0,0 +1,81 @@
+from itertools import islice
+from flask import Response, request, current_app, json, stream_with_context
+from models import db
+from .projection import FIELDS
+
+
+NDJSON = 'application/x-ndjson'
+
+
+def media_type():
+    """NDJSON when the client prefers it, else JSON."""
+    if request.accept_mimetypes.best == NDJSON:
+        return NDJSON
+    return 'application/json'
+
+
+def wants_stream():
+    """True when the client asked for ?stream=true or for NDJSON."""
+    return request.args.get('stream', '').lower() in ('1', 'true') or \
+        media_type() == NDJSON
+
+
+def batches(query, batch_size):
+    """Iterate a server-side cursor over `query` in lists of batch_size."""
+    rows = iter(query.execution_options(stream_results=True)
+                .yield_per(batch_size))
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def stream_items(model, names, batch_size, criteria=()):
+    """Yield every row of `model` matching `criteria`, ordered by id.
+
+    Rows are read in fixed batches, the nested collection is loaded with
+    one query per batch, so memory doesn't grow with the table.
+    """
+    scalars, relation = FIELDS[model]
+    if relation in names:
+        query = model.query.filter(*criteria).order_by(model.id)
+        for batch in batches(query, batch_size):
+            for item in model.long_many(batch):
+                if len(names) <= len(scalars):
+                    item = {name: item[name] for name in names}
+                yield item
+        return
+
+    columns = [getattr(model, scalars[name]) for name in names]
+    query = db.session.query(*columns).filter(*criteria).order_by(model.id)
+    for batch in batches(query, batch_size):
+        for row in batch:
+            yield {name: getattr(row, scalars[name]) for name in names}
+
+
+def stream_response(model, key, names, criteria=()):
+    """Return a chunked response with every row of `model` matching
+    `criteria`.
+
+    NDJSON clients get one object per line, other clients get the usual
+    {"success": true, key: [...], "next": null} document.
+    """
+    batch_size = current_app.config['STREAM_BATCH_SIZE']
+    items = stream_items(model, names, batch_size, criteria)
+
+    if media_type() == NDJSON:
+        def generate():
+            for item in items:
+                yield json.dumps(item) + '\n'
+        return Response(stream_with_context(generate()), mimetype=NDJSON)
+
+    def generate():
+        yield '{"success": true, "next": null, "%s": [' % key
+        separator = ''
+        for item in items:
+            yield separator + json.dumps(item)
+            separator = ','
+        yield ']}\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
@@ -0,0 +1,56 @@
+import time
+from sqlalchemy.orm import configure_mappers
+from auth import jwks_cache
+from models import db, Movie, Actor, table_versions
+from .projection import FIELDS, list_page
+
+
+def warm_up(app):
+    """Do the first-request work of a worker before it takes traffic.
+
+    Fetches the Auth0 signing keys, configures the mappers, opens a
+    pooled connection and runs the first page query of both list
+    endpoints, long and short, then builds the search index and the
+    co-star graph. Steps already done (in the gunicorn master before the
+    fork) are skipped. Returns {step: seconds}. A failing step is logged
+    and skipped, the worker then does it on its first request like
+    without warm-up.
+    """
+    timings = {}
+
+    def step(name, f):
+        started = time.perf_counter()
+        try:
+            f()
+        except Exception:
+            app.logger.exception('warm-up step %s failed', name)
+        timings[name] = time.perf_counter() - started
+
+    def hot_queries():
+        limit = app.config['DEFAULT_PAGE_SIZE']
+        provider = app.extensions['json_provider']
+        table_versions()
+        for model in (Actor, Movie):
+            scalars, relation = FIELDS[model]
+            for names in (list(scalars) + [relation], list(scalars)):
+                items, _ = list_page(model, limit, None, names)
+                provider.dumps(items)
+
+    def search_index():
+        index = app.extensions['search_index']
+        if index.built_at is None:
+            index.build()
+
+    def costar_graph():
+        graph = app.extensions['costar_graph']
+        if graph.built_at is None:
+            graph.build()
+
+    step('jwks', jwks_cache.prefetch)
+    step('mappers', configure_mappers)
+    with app.app_context():
+        step('queries', hot_queries)
+        step('search_index', search_index)
+        step('costar_graph', costar_graph)
+        db.session.remove()
+    return timings
@@ -0,0 +1,60 @@
+# gunicorn settings, read from the working directory by `gunicorn wsgi:app`
+# GUNICORN_CMD_ARGS and command line options override them
+import os
+import multiprocessing
+
+cores = multiprocessing.cpu_count()
+cooperative = os.environ.get('WSGI_APP') == 'wsgi_async'
+
+# Heroku sets WEB_CONCURRENCY from the dyno size
+workers = int(os.environ.get('WEB_CONCURRENCY', 2 * cores + 1))
+if cooperative:
+    worker_class = 'gevent'
+    worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 100))
+elif cores == 1:
+    # one core can't run more processes in parallel, threads still
+    # overlap the waits on Postgres
+    worker_class = 'gthread'
+    threads = int(os.environ.get('THREADS', 4))
+else:
+    worker_class = 'sync'
+
+# build create_app() once in the master, workers share its memory pages
+# until they write to them; gevent must patch before the app is imported
+preload_app = not cooperative
+# recycle workers to bound slow leaks, jitter avoids restarting them all
+max_requests = int(os.environ.get('MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', 100))
+timeout = int(os.environ.get('TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+
+
+def on_starting(server):
+    if not server.cfg.preload_app:
+        return
+    from flaskr.warmup import warm_up
+    from models import db
+    app = server.app.wsgi()
+    server.log.info('master warm-up %s', warm_up(app))
+    # connections must not be inherited by the workers
+    db.get_engine(app).dispose()
+    if app.extensions.get('replicas'):
+        app.extensions['replicas'].dispose()
+
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+    from models import db
+    # drop any connection copied from the master, the pool opens new ones
+    app = server.app.wsgi()
+    db.get_engine(app).dispose()
+    if app.extensions.get('replicas'):
+        app.extensions['replicas'].dispose()
+
+
+def post_worker_init(worker):
+    from flaskr.warmup import warm_up
+    worker.log.info('worker %s warm-up %s', worker.pid,
+                    warm_up(worker.wsgi))
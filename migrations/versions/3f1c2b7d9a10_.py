@@ -0,0 +1,34 @@
+"""add table_versions
+
+Revision ID: 3f1c2b7d9a10
+Revises: ba2945112c14
+Create Date: 2026-10-18 09:12:41.502113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2b7d9a10'
+down_revision = 'ba2945112c14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [
+        {'name': 'actors', 'version': 0},
+        {'name': 'movies', 'version': 0},
+        {'name': 'roles', 'version': 0}
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
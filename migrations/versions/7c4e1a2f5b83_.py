@@ -0,0 +1,56 @@
+"""roles primary key, actor index and cascading foreign keys
+
+Revision ID: 7c4e1a2f5b83
+Revises: 3f1c2b7d9a10
+Create Date: 2026-10-18 11:02:17.846520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c4e1a2f5b83'
+down_revision = '3f1c2b7d9a10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep one row per (movie_id, actor_id) and drop incomplete links
+    op.execute('CREATE TABLE roles_dedup AS SELECT DISTINCT movie_id, '
+               'actor_id FROM roles WHERE movie_id IS NOT NULL '
+               'AND actor_id IS NOT NULL')
+    op.execute('DELETE FROM roles')
+    op.execute('INSERT INTO roles (movie_id, actor_id) '
+               'SELECT movie_id, actor_id FROM roles_dedup')
+    op.execute('DROP TABLE roles_dedup')
+
+    op.alter_column('roles', 'movie_id', existing_type=sa.Integer(),
+                    nullable=False)
+    op.alter_column('roles', 'actor_id', existing_type=sa.Integer(),
+                    nullable=False)
+    op.drop_constraint('roles_movie_id_fkey', 'roles', type_='foreignkey')
+    op.drop_constraint('roles_actor_id_fkey', 'roles', type_='foreignkey')
+    op.create_foreign_key('roles_movie_id_fkey', 'roles', 'movies',
+                          ['movie_id'], ['id'], ondelete='CASCADE')
+    op.create_foreign_key('roles_actor_id_fkey', 'roles', 'actors',
+                          ['actor_id'], ['id'], ondelete='CASCADE')
+    op.create_primary_key('roles_pkey', 'roles', ['movie_id', 'actor_id'])
+    op.create_index(op.f('ix_roles_actor_id'), 'roles', ['actor_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_roles_actor_id'), table_name='roles')
+    op.drop_constraint('roles_pkey', 'roles', type_='primary')
+    op.drop_constraint('roles_actor_id_fkey', 'roles', type_='foreignkey')
+    op.drop_constraint('roles_movie_id_fkey', 'roles', type_='foreignkey')
+    op.create_foreign_key('roles_movie_id_fkey', 'roles', 'movies',
+                          ['movie_id'], ['id'])
+    op.create_foreign_key('roles_actor_id_fkey', 'roles', 'actors',
+                          ['actor_id'], ['id'])
+    op.alter_column('roles', 'actor_id', existing_type=sa.Integer(),
+                    nullable=True)
+    op.alter_column('roles', 'movie_id', existing_type=sa.Integer(),
+                    nullable=True)
@@ -0,0 +1,29 @@
+"""indexes for the list filters
+
+Revision ID: 9d2b6e4c1f07
+Revises: 7c4e1a2f5b83
+Create Date: 2026-10-18 13:27:05.113904
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9d2b6e4c1f07'
+down_revision = '7c4e1a2f5b83'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_movies_release_date'), 'movies',
+                    ['release_date'], unique=False)
+    op.create_index(op.f('ix_actors_age'), 'actors', ['age'], unique=False)
+    op.create_index(op.f('ix_actors_gender'), 'actors', ['gender'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_actors_gender'), table_name='actors')
+    op.drop_index(op.f('ix_actors_age'), table_name='actors')
+    op.drop_index(op.f('ix_movies_release_date'), table_name='movies')
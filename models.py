@@ -1,13 +1,154 @@
 import os
-from flask_sqlalchemy import SQLAlchemy
+import time
+import datetime
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
+from sqlalchemy import orm, event, types, exc
+from sqlalchemy.orm.attributes import OP_APPEND
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import Select
 from sqlalchemy_utils.types.choice import ChoiceType
 
 database_path = os.environ.get('DATABASE_URL')
+# engine the SELECTs of the current request run on, set by the replica
+# routing of flaskr, absent for the primary
+READ_ENGINE_KEY = 'flaskr.read_engine'
 
-db = SQLAlchemy()
+
+class RoutingSession(SignallingSession):
+    """Session that runs the SELECTs of a request on the engine stored
+    under READ_ENGINE_KEY in its WSGI environ.
+
+    Flushes, and statements run through session.connection() like the
+    version bumps, always use the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, Select) and not self._flushing and \
+                has_request_context():
+            engine = request.environ.get(READ_ENGINE_KEY)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 
+
+class ISODate(types.TypeDecorator):
+    """Date column that also accepts YYYY-MM-DD strings.
+
+    Request bodies carry dates as strings. Postgres parses them itself,
+    other databases (SQLite for the benchmarks) need a date object.
+    """
+    impl = types.Date
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str) and dialect.name != 'postgresql':
+            return datetime.date.fromisoformat(value)
+        return value
+
+
+'''
+pool_listeners
+    functions called with the seconds each connection checkout waited
+'''
+pool_listeners = []
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that measures how long checkouts wait for a connection.
+
+    Every wait is passed to the functions of `pool_listeners` and added to
+    the counters of `stats()`. On Postgres, `statement_timeout` (ms, 0
+    disables it) is set on each connection at checkout, once per physical
+    connection.
+    """
+
+    def __init__(self, creator, statement_timeout=0, **kw):
+        super().__init__(creator, **kw)
+        self.statement_timeout = statement_timeout
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.checkouts += 1
+            self.wait_seconds += waited
+            for listener in pool_listeners:
+                listener(waited)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.statement_timeout = self.statement_timeout
+        return pool
+
+    def stats(self):
+        capacity = self.size() + max(self._max_overflow, 0)
+        return {
+            'size': self.size(),
+            'max_overflow': self._max_overflow,
+            'checked_out': self.checkedout(),
+            'overflow': max(self.overflow(), 0),
+            'saturation': self.checkedout() / capacity if capacity else 0.0,
+            'checkouts': self.checkouts,
+            'wait_seconds': self.wait_seconds,
+            'timeouts': self.timeouts
+        }
+
+
+@event.listens_for(TimedQueuePool, 'checkout')
+def set_statement_timeout(dbapi_connection, connection_record,
+                          connection_proxy):
+    pool = connection_proxy._pool
+    timeout = int(pool.statement_timeout or 0)
+    if pool._dialect.name != 'postgresql' or \
+            connection_record.info.get('statement_timeout') == timeout:
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('SET statement_timeout = %d' % timeout)
+    cursor.close()
+    # a rolled back transaction would undo the SET
+    dbapi_connection.commit()
+    connection_record.info['statement_timeout'] = timeout
+
+
+def engine_options(config, database_path):
+    """SQLALCHEMY_ENGINE_OPTIONS for the DB_* keys of `config`.
+
+    SQLite keeps the pool chosen by SQLAlchemy, the pool options only
+    apply to server databases.
+    """
+    if not database_path or database_path.startswith('sqlite'):
+        return {}
+    options = {'poolclass': TimedQueuePool}
+    for key, option in (('DB_POOL_SIZE', 'pool_size'),
+                        ('DB_MAX_OVERFLOW', 'max_overflow'),
+                        ('DB_POOL_TIMEOUT', 'pool_timeout'),
+                        ('DB_POOL_RECYCLE', 'pool_recycle'),
+                        ('DB_POOL_PRE_PING', 'pool_pre_ping'),
+                        ('DB_STATEMENT_TIMEOUT', 'statement_timeout')):
+        if config.get(key) is not None:
+            options[option] = config[key]
+    return options
+
+
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
@@ -18,6 +159,8 @@ def setup_db(app, database_path=database_path):
     """This function config the app with the database."""
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config,
+                                                             database_path)
     db.app = app
     db.init_app(app)
     migrate.init_app(app, db)
@@ -27,11 +170,35 @@ def setup_db(app, database_path=database_path):
 roles
 '''
 roles = db.Table('roles',
-                 db.Column('movie_id', db.Integer, db.ForeignKey('movies.id')),
-                 db.Column('actor_id', db.Integer, db.ForeignKey('actors.id'))
-
+                 db.Column('movie_id', db.Integer,
+                           db.ForeignKey('movies.id', ondelete='CASCADE'),
+                           primary_key=True),
+                 db.Column('actor_id', db.Integer,
+                           db.ForeignKey('actors.id', ondelete='CASCADE'),
+                           primary_key=True, index=True)
                  )
 
+'''
+related_rows(column, ids, model, join_column)
+    loads the rows of `model` linked through roles to every id in `ids`
+    and returns them grouped by id, using one IN query per chunk of ids
+'''
+RELATED_CHUNK_SIZE = 500
+
+
+def related_rows(column, ids, model, join_column):
+    related = {}
+    for start in range(0, len(ids), RELATED_CHUNK_SIZE):
+        chunk = ids[start:start + RELATED_CHUNK_SIZE]
+        rows = db.session.query(column, model)\
+            .join(model, model.id == join_column)\
+            .filter(column.in_(chunk))\
+            .order_by(model.id)
+        for owner_id, row in rows:
+            related.setdefault(owner_id, []).append(row)
+    return related
+
+
 '''
 Movie
 '''
@@ -43,7 +210,7 @@ class Movie(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(), nullable=False, index=True, unique=True)
-    release_date = db.Column(db.Date, nullable=False)
+    release_date = db.Column(ISODate, nullable=False, index=True)
     actors = db.relationship('Actor',
                              secondary=roles,
                              backref=db.backref('movies', lazy='dynamic'),
@@ -70,14 +237,30 @@ class Movie(db.Model):
             'release date': self.release_date,
         }
 
-    def long(self):
+    def long(self, actors=None):
+        """`actors` are the actors of the movie when they are loaded."""
+        if actors is None:
+            actors = self.actors.order_by(Actor.id).all()
         return {
             'id': self.id,
             'title': self.title,
             'release date': self.release_date,
-            'actors': list(map(Actor.short, self.actors.all()))
+            'actors': list(map(Actor.short, sorted(actors,
+                                                   key=lambda a: a.id)))
         }
 
+    @staticmethod
+    def long_many(movies):
+        """Same as long() for every movie, loading all actors at once."""
+        actors = related_rows(roles.c.movie_id, [m.id for m in movies],
+                              Actor, roles.c.actor_id)
+        return [{
+            'id': movie.id,
+            'title': movie.title,
+            'release date': movie.release_date,
+            'actors': list(map(Actor.short, actors.get(movie.id, [])))
+        } for movie in movies]
+
 
 '''
 Actor
@@ -90,8 +273,8 @@ class Actor(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False, index=True, unique=True)
-    age = db.Column(db.Integer, nullable=False)
-    gender = db.Column(db.String(50))
+    age = db.Column(db.Integer, nullable=False, index=True)
+    gender = db.Column(db.String(50), index=True)
 
     def __repr__(self):
         return f'<Actor name: {self.name}>'
@@ -115,11 +298,158 @@ class Actor(db.Model):
             'gender': self.gender
         }
 
-    def long(self):
+    def long(self, movies=None):
+        """`movies` are the movies of the actor when they are loaded."""
+        if movies is None:
+            movies = self.movies.order_by(Movie.id).all()
         return {
             'id': self.id,
             'name': self.name,
             'age': self.age,
             'gender': self.gender,
-            'movies': list(map(Movie.short, self.movies.all()))
+            'movies': list(map(Movie.short, sorted(movies,
+                                                   key=lambda m: m.id)))
         }
+
+    @staticmethod
+    def long_many(actors):
+        """Same as long() for every actor, loading all movies at once."""
+        movies = related_rows(roles.c.actor_id, [a.id for a in actors],
+                              Movie, roles.c.movie_id)
+        return [{
+            'id': actor.id,
+            'name': actor.name,
+            'age': actor.age,
+            'gender': actor.gender,
+            'movies': list(map(Movie.short, movies.get(actor.id, [])))
+        } for actor in actors]
+
+
+'''
+TableVersion
+    one change counter per table, bumped in the same transaction as every
+    write so readers can tell whether a table changed with one cheap query
+'''
+VERSIONED_TABLES = ('actors', 'movies', 'roles')
+
+
+class TableVersion(db.Model):
+    """Change counter of a table"""
+    __tablename__ = 'table_versions'
+
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+@event.listens_for(TableVersion.__table__, 'after_create')
+def create_versions(target, connection, **kw):
+    connection.execute(target.insert(), [
+        {'name': name, 'version': 0} for name in VERSIONED_TABLES])
+
+
+def bump_versions(tables, session=None):
+    """Increment the version of `tables` in the current transaction.
+
+    The tables are also remembered until the transaction ends, on commit
+    they are passed to every function of `commit_listeners`.
+    """
+    if not tables:
+        return
+    session = session or db.session
+    session.info.setdefault('written_tables', set()).update(tables)
+    # always lock the rows in the same order
+    session.connection().execute(
+        TableVersion.__table__.update()
+        .where(TableVersion.name.in_(sorted(tables)))
+        .values(version=TableVersion.version + 1))
+
+
+def table_versions(tables=VERSIONED_TABLES):
+    """Return {table: version} for `tables`."""
+    return dict(db.session.query(TableVersion.name, TableVersion.version)
+                .filter(TableVersion.name.in_(tables)))
+
+
+def roles_changed(target, value, initiator):
+    # the ids may not be known yet, the links are recorded after the flush
+    db.session.info.setdefault('changed_tables', set()).add('roles')
+    db.session.info.setdefault('changed_links', []).append(
+        (target, value, initiator.op is OP_APPEND))
+
+
+event.listen(Movie.actors, 'append', roles_changed)
+event.listen(Movie.actors, 'remove', roles_changed)
+
+
+def record_rows(rows, session=None):
+    """Remember written rows until the transaction ends.
+
+    `rows` are (table, id, values) tuples where values is the short()
+    representation of the row, or None when it was deleted. The id of a
+    roles row is its (movie_id, actor_id) pair. On commit they are passed
+    to every function of `row_listeners`.
+    """
+    session = session or db.session
+    session.info.setdefault('written_rows', []).extend(rows)
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_changes(session, flush_context):
+    tables = session.info.pop('changed_tables', set())
+    rows = []
+    for movie, actor, added in session.info.pop('changed_links', ()):
+        link = {'movie_id': movie.id, 'actor_id': actor.id}
+        rows.append(('roles', (movie.id, actor.id), link if added else None))
+    for obj in session.new:
+        if isinstance(obj, (Actor, Movie)):
+            tables.add(obj.__tablename__)
+            rows.append((obj.__tablename__, obj.id, obj.short()))
+    for obj in session.deleted:
+        if isinstance(obj, (Actor, Movie)):
+            # the roles rows of a deleted row go with it
+            tables.update((obj.__tablename__, 'roles'))
+            rows.append((obj.__tablename__, obj.id, None))
+    for obj in session.dirty:
+        if isinstance(obj, (Actor, Movie)) and \
+                session.is_modified(obj, include_collections=False):
+            tables.add(obj.__tablename__)
+            rows.append((obj.__tablename__, obj.id, obj.short()))
+    bump_versions(tables, session)
+    record_rows(rows, session)
+
+
+'''
+commit_listeners and row_listeners
+    functions called after each commit with the set of written tables and
+    with the list of written rows, they must not use the session
+'''
+commit_listeners = []
+row_listeners = []
+
+
+@event.listens_for(db.session, 'before_commit')
+def track_statements(session):
+    # the tables written by Core statements are left to the last flush,
+    # when there is nothing to flush they are bumped here
+    session.flush()
+    bump_versions(session.info.pop('changed_tables', None), session)
+
+
+@event.listens_for(db.session, 'after_commit')
+def notify_commit(session):
+    tables = session.info.pop('written_tables', None)
+    rows = session.info.pop('written_rows', None)
+    if tables:
+        for listener in commit_listeners:
+            listener(tables)
+    if rows:
+        for listener in row_listeners:
+            listener(rows)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changes(session):
+    session.info.pop('written_tables', None)
+    session.info.pop('written_rows', None)
+    session.info.pop('changed_tables', None)
+    session.info.pop('changed_links', None)
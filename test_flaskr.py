@@ -1,8 +1,26 @@
+import os
 import unittest
 import json
+import time
+import tempfile
+import datetime
+import gzip
+import threading
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, create_engine, exc
 from flaskr import create_app
-from models import setup_db, Movie, Actor, db
+from models import (setup_db, Movie, Actor, db, roles, TimedQueuePool,
+                    row_listeners)
+from sqlalchemy.exc import IntegrityError
+from auth import JWKSCache, TokenCache, AuthError
+from flaskr.cache import ResponseCache, SQLiteBackend
+from flaskr.search import PrefixIndex, Labels
+from flaskr.graph import RolesGraph, ACTORS
+from flaskr.warmup import warm_up
+from flaskr import jsonprovider
+from flaskr.compression import brotli
+from flaskr.bulk import in_transaction, insert_missing, get_or_create
 from test_data import actors
 from access_token import tokens
 
@@ -25,6 +43,63 @@ def populate_db(db, data=actors):
         actor_row.insert()
 
 
+def generate_actors(count, prefix='extra'):
+    """Build `count` actors, each playing in Movie 1 and in its own movie"""
+    return [{
+        'name': f'{prefix} actor {i}',
+        'age': 20 + i % 50,
+        'gender': 'M' if i % 2 else 'F',
+        'movies': [
+            {'title': 'Movie 1', 'release_date': '2015-03-03'},
+            {'title': f'{prefix} movie {i}', 'release_date': '2012-01-01'}
+        ]
+    } for i in range(count)]
+
+
+class QueryCounter:
+    """Counts the SQL statements executed on `engine` inside the block"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def _count(self, conn, cursor, statement, *args):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+# the most SQL statements each endpoint may run for the requests below,
+# they must not depend on the size of the catalog or of the request body
+QUERY_BUDGETS = {
+    'GET /actors': 3,
+    'GET /movies': 3,
+    'GET /actors?view=short': 2,
+    'GET /actors?ids=': 3,
+    'GET /movies/<id>': 3,
+    'GET /movies?stream=true': 3,
+    'GET /search/suggest': 4,
+    'GET /actors/<id>/costars': 4,
+    'GET /actors/<a>/path/<b>': 5,
+    'GET /metrics': 0,
+    'POST /actors': 4,
+    'POST /movies': 5,
+    'POST /actors/bulk': 8,
+    'PATCH /actors': 3,
+    'PATCH /actors +movies': 6,
+    'PATCH /movies': 3,
+    'DELETE /actors': 5,
+    'DELETE /movies': 5
+}
+
+
 # new data
 new_actor = {
     'name': 'actor 3',
@@ -230,6 +305,1206 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['delete'], 1)
 
+    # query counts, list options, conditional and compressed responses,
+    # bulk writes, search, metrics and the co-star graph
+
+    @contextmanager
+    def assertQueryBudget(self, endpoint):
+        """Fail when the block runs more statements than QUERY_BUDGETS
+        allows `endpoint`"""
+        with self.app.app_context(), QueryCounter(db.engine) as queries:
+            yield queries
+        self.assertLessEqual(queries.count, QUERY_BUDGETS[endpoint],
+                             '\n'.join(queries.statements))
+
+    def count_queries(self, method, path, body=None):
+        """Return the number of statements run by one request"""
+        with self.app.app_context(), QueryCounter(db.engine) as queries:
+            res = self.client.open(path, method=method, json=body, headers={
+                "Authorization": f'Bearer {self.producer}'
+            })
+            res.get_data()
+        self.assertEqual(res.status_code, 200)
+        return queries.count
+
+    def test_query_budgets(self):
+        bulk = generate_actors(5, 'bulk')
+        for endpoint, path, body in (
+                ('GET /actors', '/actors', None),
+                ('GET /movies', '/movies', None),
+                ('GET /actors?view=short', '/actors?view=short', None),
+                ('GET /actors?ids=', '/actors?ids=2,1', None),
+                ('GET /movies/<id>', '/movies/1', None),
+                ('GET /movies?stream=true', '/movies?stream=true', None),
+                ('GET /search/suggest', '/search/suggest?q=mov', None),
+                ('GET /actors/<id>/costars', '/actors/1/costars', None),
+                ('GET /actors/<a>/path/<b>', '/actors/1/path/2', None),
+                ('GET /metrics', '/metrics', None),
+                ('POST /actors', '/actors', self.new_actor),
+                ('POST /movies', '/movies', self.new_movie),
+                ('POST /actors/bulk', '/actors/bulk', bulk),
+                ('PATCH /actors', '/actors/1', {'age': 25}),
+                ('PATCH /actors +movies', '/actors/1',
+                 {'movies': self.new_actor['movies']}),
+                ('PATCH /movies', '/movies/1', {'title': 'Movie 10'}),
+                ('DELETE /actors', '/actors/2', None),
+                ('DELETE /movies', '/movies/2', None)):
+            method = endpoint.split()[0]
+            with self.subTest(endpoint=endpoint):
+                with self.assertQueryBudget(endpoint):
+                    res = self.client.open(path, method=method, json=body,
+                                           headers={
+                                               "Authorization":
+                                               f'Bearer {self.producer}'
+                                           })
+                    res.get_data()
+                self.assertEqual(res.status_code, 200)
+
+    def test_list_query_counts_do_not_grow(self):
+        paths = ('/actors', '/movies', '/actors?view=short',
+                 '/movies?view=short', '/actors?stream=true',
+                 '/movies?stream=true', '/actors?gender=F',
+                 '/movies?actor_id=1')
+        small = [self.count_queries('GET', path) for path in paths]
+        with self.app.app_context():
+            populate_db(db, generate_actors(40))
+        large = [self.count_queries('GET', path) for path in paths]
+
+        self.assertEqual(large, small)
+
+    def test_write_query_counts_do_not_grow(self):
+        with self.app.app_context():
+            populate_db(db, generate_actors(10))
+        titles = [{'title': f'extra movie {i}', 'release_date': '2012-01-01'}
+                  for i in range(10)]
+        names = [{'name': f'extra actor {i}', 'age': 30} for i in range(10)]
+        counts = {}
+        for size in (1, 10):
+            counts[size] = [
+                self.count_queries('POST', '/actors', {
+                    'name': f'new actor {size}', 'age': 30,
+                    'movies': titles[:size]}),
+                self.count_queries('POST', '/movies', {
+                    'title': f'new movie {size}', 'release_date': '2001-01-01',
+                    'actors': names[:size]}),
+                self.count_queries('PATCH', '/actors/1', {
+                    'movies': titles[:size]}),
+                self.count_queries('PATCH', '/movies/1', {
+                    'actors': names[:size]}),
+                self.count_queries('POST', '/actors/bulk', [{
+                    'name': f'bulk actor {size} {i}', 'age': 30,
+                    'movies': titles} for i in range(size)])
+            ]
+
+        self.assertEqual(counts[10], counts[1])
+
+    def test_get_actors_paginated(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        res = self.client.get('/actors?limit=1', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertEqual(data['actors'][0]['name'], 'actor 1')
+        self.assertIsNotNone(data['next'])
+
+        res = self.client.get(f'/actors?limit=1&after={data["next"]}',
+                              headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertEqual(data['actors'][0]['name'], 'actor 2')
+        self.assertIsNone(data['next'])
+
+    def test_get_movies_bad_limit(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        for limit in ('abc', '0', '-5', '2.5'):
+            res = self.client.get(f'/movies?limit={limit}', headers=headers)
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_bad_cursor(self):
+        res = self.client.get('/movies?after=not-a-cursor',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movies_short_view(self):
+        with self.app.app_context():
+            with QueryCounter(db.engine) as queries:
+                res = self.client.get('/movies?view=short', headers={
+                    "Authorization": f'Bearer {self.assistant}'
+                })
+        data = json.loads(res.data)
+        movie = data['movies'][0]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 4)
+        self.assertEqual(set(movie), {'id', 'title', 'release date'})
+        self.assertFalse(any('roles' in statement
+                             for statement in queries.statements))
+
+    def test_get_actors_fields(self):
+        res = self.client.get('/actors?fields=name,movies',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+        data = json.loads(res.data)
+        actor = data['actors'][0]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(actor), {'name', 'movies'})
+        self.assertEqual(len(actor['movies']), 2)
+
+    def test_get_actors_by_ids(self):
+        res = self.client.get('/actors?ids=2,99,1,2',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], [2, 1])
+        self.assertEqual(data['missing'], [99])
+        self.assertEqual(len(data['actors'][1]['movies']), 2)
+
+    def test_get_movies_by_ids_fields(self):
+        res = self.client.get('/movies?ids=2,1&fields=title',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'], [{'title': 'Movie 2'},
+                                          {'title': 'Movie 1'}])
+        self.assertEqual(data['missing'], [])
+
+    def test_get_actors_bad_ids(self):
+        res = self.client.get('/actors?ids=1,one',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_ids_query_count_does_not_grow(self):
+        with self.app.app_context():
+            populate_db(db, generate_actors(40))
+        few = self.count_queries('GET', '/actors?ids=1,2')
+        many = self.count_queries(
+            'GET', '/actors?ids=' + ','.join(map(str, range(1, 60))))
+
+        self.assertEqual(many, few)
+
+    def test_get_actors_by_many_ids(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        ids = ','.join(map(str, range(1200, 0, -1)))
+        for view in ('short', 'long'):
+            res = self.client.get(f'/actors?view={view}&ids={ids}',
+                                  headers=headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([actor['id'] for actor in data['actors']],
+                             [2, 1])
+            self.assertEqual(len(data['missing']), 1198)
+
+    def test_get_actor(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        res = self.client.get('/actors/1', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'][0]['name'], 'actor 1')
+        self.assertEqual(len(data['actors'][0]['movies']), 2)
+
+        res = self.client.get('/actors/1', headers=dict(
+            headers, **{'If-None-Match': res.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+    def test_get_movie_not_found(self):
+        res = self.client.get('/movies/1000',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movie_no_auth(self):
+        res = self.client.get('/movies/1')
+
+        self.assertEqual(res.status_code, 401)
+
+    def test_get_actors_unknown_field(self):
+        res = self.client.get('/actors?fields=salary',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_stream(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        res = self.client.get('/actors?stream=true', headers=headers)
+        data = json.loads(res.data)
+        paged = json.loads(self.client.get('/actors', headers=headers).data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['actors'], paged['actors'])
+
+    def test_get_movies_ndjson(self):
+        res = self.client.get('/movies?view=short',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}',
+                                  "Accept": 'application/x-ndjson'
+                              })
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(json.loads(lines[0])['title'], 'Movie 1')
+
+    def test_get_movies_not_modified(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        res = self.client.get('/movies', headers=headers)
+        etag = res.headers['ETag']
+
+        with self.app.app_context():
+            with QueryCounter(db.engine) as queries:
+                res = self.client.get('/movies', headers=dict(
+                    headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(queries.count, 1)
+
+    def test_get_movies_ndjson_has_own_etag(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        etag = self.client.get('/movies', headers=headers).headers['ETag']
+        res = self.client.get('/movies', headers=dict(headers, **{
+            'Accept': 'application/x-ndjson', 'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertIn('Accept', res.headers['Vary'])
+
+    def test_get_movies_stream_etag_per_media_type(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        res = self.client.get('/movies?stream=true', headers=headers)
+        etag = res.headers['ETag']
+
+        self.assertEqual(res.mimetype, 'application/json')
+        res = self.client.get('/movies?stream=true', headers=dict(headers, **{
+            'Accept': 'application/x-ndjson', 'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertNotEqual(res.headers['ETag'], etag)
+        res = self.client.get('/movies?stream=true', headers=dict(
+            headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_get_movies_gzip(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        plain = self.client.get('/movies', headers=headers)
+        res = self.client.get('/movies', headers=dict(
+            headers, **{'Accept-Encoding': 'gzip'}))
+        again = self.client.get('/movies', headers=dict(
+            headers, **{'If-None-Match': res.headers['ETag']}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertEqual(res.headers['ETag'],
+                         plain.headers['ETag'][:-1] + '-gzip"')
+        self.assertEqual(again.status_code, 304)
+
+    def test_compressed_body_reused(self):
+        headers = {"Authorization": f'Bearer {self.assistant}',
+                   "Accept-Encoding": 'gzip'}
+        compression = self.app.extensions['compression']
+        first = self.client.get('/actors', headers=headers)
+        second = self.client.get('/actors', headers=headers)
+
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(compression.cache_hits, 1)
+
+    def test_small_responses_not_compressed(self):
+        res = self.client.get('/actors?view=short&limit=1',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}',
+                                  "Accept-Encoding": 'gzip'
+                              })
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+    def test_get_movies_stream_gzip(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        res = self.client.get('/movies?stream=true', headers=dict(
+            headers, **{'Accept-Encoding': 'gzip'}))
+        data = json.loads(gzip.decompress(res.data))
+        paged = json.loads(self.client.get('/movies', headers=headers).data)
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(data['movies'], paged['movies'])
+
+    @unittest.skipIf(brotli is None, 'brotli is not installed')
+    def test_get_movies_brotli(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        plain = self.client.get('/movies', headers=headers)
+        res = self.client.get('/movies', headers=dict(
+            headers, **{'Accept-Encoding': 'gzip, deflate, br'}))
+
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(res.data), plain.data)
+
+    def test_concurrent_writes_share_new_rows(self):
+        """Threads creating actors and movies that name the same new
+        movies and actors all succeed, each name is created once"""
+        titles = [f'shared movie {i}' for i in range(4)]
+        names = [f'shared actor {i}' for i in range(4)]
+        statuses = []
+
+        def write(i):
+            client = self.app.test_client()
+            headers = {"Authorization": f'Bearer {self.producer}'}
+            for j in range(5):
+                res = client.post('/actors', headers=headers, json={
+                    'name': f'writer {i}-{j}', 'age': 30,
+                    'movies': [{'title': title, 'release_date': '2020-01-01'}
+                               for title in titles[j % 2:]]})
+                statuses.append(res.status_code)
+                res = client.post('/movies', headers=headers, json={
+                    'title': f'written {i}-{j}',
+                    'release_date': '2020-01-01',
+                    'actors': [{'name': name, 'age': 40}
+                               for name in names[j % 2:]]})
+                statuses.append(res.status_code)
+
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [200] * 80)
+        with self.app.app_context():
+            self.assertEqual(
+                Movie.query.filter(Movie.title.in_(titles)).count(), 4)
+            self.assertEqual(
+                Actor.query.filter(Actor.name.in_(names)).count(), 4)
+            movie = Movie.query.filter_by(title=titles[0]).one()
+            self.assertEqual(movie.actors.count(), 24)
+
+    def test_in_transaction_retries_deadlocks(self):
+        class Deadlock(Exception):
+            pgcode = '40P01'
+        calls = []
+
+        def work():
+            calls.append(1)
+            if len(calls) < 3:
+                raise exc.OperationalError('UPDATE', {}, Deadlock())
+            return 'done'
+
+        with self.app.test_request_context():
+            self.assertEqual(in_transaction(work), 'done')
+            self.assertEqual(len(calls), 3)
+
+            class Invalid(Exception):
+                pgcode = '22P02'
+            calls.clear()
+
+            def invalid():
+                calls.append(1)
+                raise exc.DataError('INSERT', {}, Invalid())
+
+            with self.assertRaises(exc.DataError):
+                in_transaction(invalid)
+            self.assertEqual(len(calls), 1)
+
+    def test_post_actor_created_meanwhile(self):
+        headers = {"Authorization": f'Bearer {self.producer}'}
+        inserted = []
+        with self.app.app_context():
+            engine = db.engine
+
+            # the row is committed by another connection just before the
+            # handler inserts it
+            def concurrent_insert(conn, cursor, statement, *args):
+                if statement.startswith('INSERT INTO actors') and \
+                        not inserted:
+                    inserted.append(statement)
+                    engine.execute(Actor.__table__.insert(), {
+                        'name': self.new_actor['name'], 'age': 50})
+
+            event.listen(engine, 'before_cursor_execute', concurrent_insert)
+            try:
+                res = self.client.post('/actors', headers=headers,
+                                       json=self.new_actor)
+            finally:
+                event.remove(engine, 'before_cursor_execute',
+                             concurrent_insert)
+
+        self.assertEqual(res.status_code, 409)
+
+    def test_post_actors_bulk_with_director(self):
+        items = generate_actors(3, 'bulk') + [
+            {'name': 'actor 1', 'age': 30},
+            {'name': 'no age'}
+        ]
+        res = self.client.post('/actors/bulk',
+                               headers={
+                                   "Authorization": f'Bearer {self.director}'
+                               },
+                               json=items)
+        data = json.loads(res.data)
+        statuses = [result['status'] for result in data['results']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(statuses, [200, 200, 200, 409, 400])
+        with self.app.app_context():
+            actor = Actor.query.get(data['results'][0]['id'])
+            self.assertEqual(actor.name, 'bulk actor 0')
+            self.assertEqual(actor.movies.count(), 2)
+            self.assertEqual(Movie.query.filter_by(title='Movie 1')
+                             .one().actors.count(), 5)
+
+    def test_post_actors_bulk_bad_items(self):
+        items = generate_actors(1, 'bulk') + [
+            {'name': 'bad movies', 'age': 30, 'movies': 5},
+            {'name': 'bad age', 'age': 'thirty'},
+            {'name': 'bad release date', 'age': 30,
+             'movies': [{'title': 'bad date', 'release_date': 'soon'}]}
+        ]
+        res = self.client.post('/actors/bulk',
+                               headers={
+                                   "Authorization": f'Bearer {self.director}'
+                               },
+                               json=items)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['status'] for result in data['results']],
+                         [200, 400, 400, 400])
+
+    def test_post_actors_bulk_references_by_title(self):
+        res = self.client.post('/actors/bulk',
+                               headers={
+                                   "Authorization": f'Bearer {self.director}'
+                               },
+                               json=[{'name': 'bulk actor', 'age': 30,
+                                      'movies': [{'title': 'Movie 1'},
+                                                 {'title': 'no such movie'}]}])
+        data = json.loads(res.data)
+
+        self.assertEqual(data['results'][0]['status'], 200)
+        with self.app.app_context():
+            actor = Actor.query.get(data['results'][0]['id'])
+            self.assertEqual([movie.title for movie in actor.movies],
+                             ['Movie 1'])
+
+    def test_post_movies_bulk_with_director(self):
+        res = self.client.post('/movies/bulk',
+                               headers={
+                                   "Authorization": f'Bearer {self.director}'
+                               },
+                               json=[self.new_movie])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['code'], 'unauthorized')
+
+    def test_etag_changes_after_write(self):
+        headers = {"Authorization": f'Bearer {self.director}'}
+        etag = self.client.get('/actors', headers=headers).headers['ETag']
+        self.client.patch('/actors/1', headers=headers, json={'age': 25})
+        res = self.client.get('/actors', headers=dict(
+            headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_actors_cached_until_write(self):
+        headers = {"Authorization": f'Bearer {self.director}'}
+        cache = self.app.extensions['response_cache']
+        self.client.get('/actors', headers=headers)
+        self.client.get('/actors', headers=headers)
+
+        self.assertEqual(cache.hits, 1)
+
+        self.client.patch('/actors/1', headers=headers, json={'age': 25})
+        res = self.client.get('/actors', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(data['actors'][0]['age'], 25)
+
+    def test_roles_rejects_duplicate_links(self):
+        with self.app.app_context():
+            with self.assertRaises(IntegrityError):
+                db.session.execute(roles.insert(),
+                                   {'movie_id': 1, 'actor_id': 1})
+            db.session.rollback()
+
+    def test_get_movies_filtered(self):
+        res = self.client.get('/movies?release_date_from=2015-01-01'
+                              '&release_date_to=2016-12-31&actor_id=2',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ['Movie 1', 'Movie 3'])
+
+    def test_get_actors_filtered(self):
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        res = self.client.get('/actors?age_min=30&age_max=60&gender=F',
+                              headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ['actor 2'])
+
+        res = self.client.get('/actors?movie_id=1&limit=1', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ['actor 1'])
+        self.assertIsNotNone(data['next'])
+
+    def test_get_actors_bad_filter(self):
+        res = self.client.get('/actors?age_min=old',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_search_suggest(self):
+        headers = {"Authorization": f'Bearer {self.director}'}
+        res = self.client.get('/search/suggest?q=MOV&type=movies&limit=2',
+                              headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([s['title'] for s in data['suggestions']],
+                         ['Movie 1', 'Movie 2'])
+
+        self.client.post('/actors', headers=headers, json=self.new_actor)
+        res = self.client.get('/search/suggest?q=actor 3', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual([s['name'] for s in data['suggestions']],
+                         ['actor 3'])
+
+    def test_metrics(self):
+        self.client.get('/movies',
+                        headers={
+                            "Authorization": f'Bearer {self.assistant}'
+                        })
+        self.client.get('/movies')
+        res = self.client.get('/metrics')
+        text = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('flaskr_request_duration_seconds_count{route="/movies",'
+                      'method="GET",status="200"} 1', text)
+        self.assertIn('flaskr_request_duration_seconds_count{route="/movies",'
+                      'method="GET",status="401"} 1', text)
+        for phase in ('auth', 'db', 'serialize'):
+            self.assertIn('flaskr_request_phase_seconds_count{route="/movies",'
+                          f'method="GET",status="200",phase="{phase}"}} 1',
+                          text)
+        self.assertNotIn('flaskr_request_sql_statements_sum{route="/movies",'
+                         'method="GET",status="200"} 0.0', text)
+        self.assertIn('# TYPE flaskr_token_cache_hits_total counter', text)
+        self.assertIn('flaskr_response_cache_misses_total 1', text)
+
+    def test_search_suggest_without_query(self):
+        res = self.client.get('/search/suggest',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_search_suggest_bad_limit(self):
+        res = self.client.get('/search/suggest?q=mov&limit=abc',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_warm_up(self):
+        timings = warm_up(self.app)
+
+        self.assertEqual(set(timings),
+                         {'jwks', 'mappers', 'queries', 'search_index',
+                          'costar_graph'})
+        self.assertIsNotNone(self.app.extensions['search_index'].built_at)
+        self.assertIsNotNone(self.app.extensions['costar_graph'].built_at)
+
+    def test_get_costars(self):
+        res = self.client.get('/actors/1/costars',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['costars'][0]['name'], 'actor 2')
+        self.assertEqual(data['costars'][0]['shared_movies'], 1)
+
+    def test_get_costars_not_found(self):
+        res = self.client.get('/actors/1000/costars',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_costars_bad_limit(self):
+        res = self.client.get('/actors/1/costars?limit=abc',
+                              headers={
+                                  "Authorization": f'Bearer {self.assistant}'
+                              })
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_graph_not_rebuilt_without_writes(self):
+        graph = self.app.extensions['costar_graph']
+        graph.rebuild_interval = 0
+        rebuilds = []
+        graph.rebuild_async = rebuilds.append
+        headers = {"Authorization": f'Bearer {self.assistant}'}
+        for path in ('/actors/1/costars', '/actors/1/path/2') * 3:
+            self.assertEqual(self.client.get(path, headers=headers)
+                             .status_code, 200)
+
+        self.assertEqual(rebuilds, [])
+
+    def test_path_follows_writes(self):
+        headers = {"Authorization": f'Bearer {self.producer}'}
+        res = self.client.get('/actors/1/path/2', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['degrees'], 1)
+        self.assertEqual([(step['type'], step['id']) for step in data['path']],
+                         [('actors', 1), ('movies', 1), ('actors', 2)])
+
+        # actor 4 plays with actor 2 in the new movie
+        res = self.client.post('/movies', headers=headers,
+                               json=self.new_movie)
+        movie_id = json.loads(res.data)['movies'][0]['id']
+        res = self.client.get('/actors/1/path/3', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['degrees'], 2)
+        self.assertEqual([step['id'] for step in data['path']],
+                         [1, 1, 2, movie_id, 3])
+
+        self.client.delete('/actors/2', headers=headers)
+        res = self.client.get('/actors/1/path/3', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(data['path'])
+        self.assertIsNone(data['degrees'])
+
+    def test_orm_links_are_recorded(self):
+        written = []
+        row_listeners.append(written.extend)
+        try:
+            with self.app.app_context():
+                movie = Movie(title='Linked', release_date='2020-01-01')
+                actor = Actor.query.get(1)
+                movie.actors.append(actor)
+                db.session.add(movie)
+                db.session.commit()
+                link = ('roles', (movie.id, 1),
+                        {'movie_id': movie.id, 'actor_id': 1})
+
+                self.assertIn(link, written)
+
+                movie.actors.remove(actor)
+                db.session.commit()
+
+                self.assertIn(('roles', (movie.id, 1), None), written)
+        finally:
+            row_listeners.remove(written.extend)
+
+    def test_long_many_matches_long(self):
+        with self.app.app_context():
+            actors = Actor.query.order_by(Actor.id).all()
+            movies = Movie.query.order_by(Movie.id).all()
+
+            self.assertEqual(Actor.long_many(actors),
+                             [actor.long() for actor in actors])
+            self.assertEqual(Movie.long_many(movies),
+                             [movie.long() for movie in movies])
+
+    def test_long_many_query_count_is_constant(self):
+        with self.app.app_context():
+            actors = Actor.query.all()
+            with QueryCounter(db.engine) as small:
+                Actor.long_many(actors)
+
+            populate_db(db, generate_actors(20))
+            actors = Actor.query.all()
+            movies = Movie.query.all()
+            with QueryCounter(db.engine) as large:
+                Actor.long_many(actors)
+            with QueryCounter(db.engine) as large_movies:
+                Movie.long_many(movies)
+
+            self.assertEqual(len(actors), 22)
+            self.assertEqual(small.count, 1)
+            self.assertEqual(large.count, small.count)
+            self.assertEqual(large_movies.count, small.count)
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test cases"""
+
+    def setUp(self):
+        self.fetches = 0
+        self.fail = False
+        self.cache = JWKSCache(url='http://jwks.local', ttl=60,
+                               min_refresh_interval=60)
+        self.cache._fetch = self.fake_fetch
+
+    def fake_fetch(self):
+        self.fetches += 1
+        if self.fail:
+            raise OSError('auth0 is down')
+        return {'keys': [{'kid': 'key-1', 'kty': 'RSA', 'use': 'sig',
+                          'n': 'n', 'e': 'AQAB'}]}
+
+    def test_keys_are_fetched_once(self):
+        for _ in range(10):
+            self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(self.cache.hits, 10)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        for _ in range(10):
+            self.assertIsNone(self.cache.get_key('unknown'))
+
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(self.cache.misses, 10)
+
+    def test_last_good_keys_are_served_when_refresh_fails(self):
+        self.cache.get_key('key-1')
+        self.fail = True
+
+        self.assertFalse(self.cache.refresh())
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.cache.refresh_failures, 1)
+
+    def test_failed_first_fetch_is_rate_limited(self):
+        self.fail = True
+        for _ in range(10):
+            with self.assertRaises(AuthError) as raised:
+                self.cache.get_key('key-1')
+
+        self.assertEqual(raised.exception.status_code, 503)
+        self.assertEqual(self.fetches, 1)
+
+    def test_sync_refresh_keeps_async_flag(self):
+        self.cache._refreshing = True
+        self.cache.refresh()
+
+        self.assertTrue(self.cache._refreshing)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test cases"""
+
+    def setUp(self):
+        self.verified = 0
+        self.cache = TokenCache(maxsize=2, negative_ttl=60)
+
+    def fake_verify(self, token):
+        self.verified += 1
+        if token == 'bad':
+            raise AuthError({'code': 'invalid_header',
+                             'description': 'bad token'}, 400)
+        return {'exp': time.time() + 60, 'permissions': [token]}
+
+    def test_repeated_token_is_verified_once(self):
+        for _ in range(5):
+            payload = self.cache.verify('good', self.fake_verify)
+
+        self.assertEqual(payload['permissions'], ['good'])
+        self.assertEqual(self.verified, 1)
+        self.assertEqual(self.cache.hits, 4)
+
+    def test_failures_are_cached(self):
+        for _ in range(3):
+            with self.assertRaises(AuthError) as ctx:
+                self.cache.verify('bad', self.fake_verify)
+
+        self.assertEqual(ctx.exception.status_code, 400)
+        self.assertEqual(self.verified, 1)
+
+    def test_cache_is_bounded(self):
+        for token in ['a', 'b', 'c', 'a']:
+            self.cache.verify(token, self.fake_verify)
+
+        self.assertEqual(self.cache.stats()['size'], 2)
+        self.assertEqual(self.verified, 4)
+
+    def test_disabled_cache(self):
+        cache = TokenCache(maxsize=0)
+        for _ in range(3):
+            cache.verify('good', self.fake_verify)
+
+        self.assertEqual(self.verified, 3)
+
+
+class SQLiteBackendTestCase(unittest.TestCase):
+    """This class represents the shared response cache store test cases"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.backend = SQLiteBackend(self.path, maxsize=10)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_entries_are_shared(self):
+        self.backend.set('key', {'body': '[]'}, {'actors'})
+        other = SQLiteBackend(self.path)
+
+        self.assertEqual(other.get('key'), {'body': '[]'})
+
+    def test_invalidate_by_table(self):
+        self.backend.set('actors', {'body': '[]'}, {'actors'})
+        self.backend.set('movies', {'body': '[]'}, {'movies'})
+        ResponseCache(self.backend).invalidate({'actors'})
+
+        self.assertIsNone(self.backend.get('actors'))
+        self.assertIsNotNone(self.backend.get('movies'))
+
+
+class PrefixIndexTestCase(unittest.TestCase):
+    """This class represents the type-ahead index test cases"""
+
+    def setUp(self):
+        self.index = PrefixIndex()
+        self.index.load([('actors', 1, 'Brad Pitt'),
+                         ('actors', 2, 'Zoë Brand'),
+                         ('movies', 1, 'Brazil')])
+
+    def suggest(self, query, **kwargs):
+        return [label for _, _, label in self.index.suggest(query, **kwargs)]
+
+    def test_first_words_rank_first(self):
+        self.assertEqual(self.suggest('bra'),
+                         ['Brad Pitt', 'Brazil', 'Zoë Brand'])
+
+    def test_long_label_is_cut_between_characters(self):
+        labels = Labels()
+        labels.set(1, 'a' + 'é' * 0x80000)
+
+        self.assertEqual(labels.get(1), 'a' + 'é' * 0x7FFFE)
+
+    def test_case_and_accents_are_ignored(self):
+        self.assertEqual(self.suggest('ZOE'), ['Zoë Brand'])
+
+    def test_type_and_limit(self):
+        self.assertEqual(self.suggest('bra', table='actors', limit=1),
+                         ['Brad Pitt'])
+
+    def test_incremental_updates(self):
+        self.index.add('actors', 1, 'Bradley Cooper')
+        self.index.remove('movies', 1)
+
+        self.assertEqual(self.suggest('bra'), ['Bradley Cooper', 'Zoë Brand'])
+        self.assertEqual(self.suggest('pitt'), [])
+
+
+class RolesGraphTestCase(unittest.TestCase):
+    """This class represents the co-star graph test cases"""
+
+    def setUp(self):
+        # a chain 1 - 2 - 3 - 4 of actors, actor 5 plays alone
+        self.graph = RolesGraph()
+        self.graph.load([(1, 1), (1, 2), (2, 2), (2, 3), (3, 3), (3, 4),
+                         (4, 5)])
+
+    def test_costars(self):
+        self.assertEqual(self.graph.costars(2, 10), ({1: 1, 3: 1}, 2))
+        self.assertEqual(self.graph.costars(5, 10), ({}, 0))
+
+    def test_path(self):
+        self.assertEqual(self.graph.path(1, 4), [1, 1, 2, 2, 3, 3, 4])
+        self.assertEqual(self.graph.path(4, 1), [4, 3, 3, 2, 2, 1, 1])
+        self.assertEqual(self.graph.path(2, 2), [2])
+        self.assertIsNone(self.graph.path(1, 5))
+        self.assertIsNone(self.graph.path(1, 4, max_degrees=2))
+
+    def test_incremental_updates(self):
+        # a movie of actors 1 and 4 is a shortcut
+        self.graph.add(5, 1)
+        self.graph.add(5, 4)
+        self.assertEqual(self.graph.path(1, 4), [1, 5, 4])
+        self.assertEqual(self.graph.costars(1, 10), ({2: 1, 4: 1}, 2))
+
+        self.graph.remove(5, 4)
+        self.graph.remove(2, 3)
+        self.assertIsNone(self.graph.path(1, 4))
+
+        self.graph.add(2, 3)
+        self.graph.remove_node(ACTORS, 2)
+        self.assertIsNone(self.graph.path(1, 3))
+        self.assertEqual(self.graph.path(3, 4), [3, 3, 4])
+
+
+class TimedQueuePoolTestCase(unittest.TestCase):
+    """This class represents the measured connection pool test cases"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.engine = create_engine(f'sqlite:///{self.path}',
+                                    poolclass=TimedQueuePool, pool_size=1,
+                                    max_overflow=0, pool_timeout=0.05,
+                                    statement_timeout=1000)
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_saturation_and_timeouts(self):
+        conn = self.engine.connect()
+        stats = self.engine.pool.stats()
+
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['saturation'], 1.0)
+        with self.assertRaises(exc.TimeoutError):
+            self.engine.connect()
+        stats = self.engine.pool.stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['wait_seconds'], 0.05)
+        conn.close()
+
+    def test_statement_timeout_survives_recreate(self):
+        self.engine.dispose()
+
+        self.assertIsInstance(self.engine.pool, TimedQueuePool)
+        self.assertEqual(self.engine.pool.statement_timeout, 1000)
+
+
+class JSONProviderTestCase(unittest.TestCase):
+    """This class represents the JSON provider test cases"""
+
+    document = {
+        'success': True,
+        'movies': [{
+            'title': 'Amélie \x7f \U0001f3ac',
+            'release date': datetime.date(2001, 4, 25),
+            'id': 7,
+            'actors': []
+        }],
+        'next': None
+    }
+
+    def test_stdlib_keeps_jsonify_format(self):
+        data = jsonprovider.StdlibProvider().dumps(self.document)
+
+        self.assertEqual(data, (
+            b'{"movies":[{"actors":[],"id":7,"release date":'
+            b'"Wed, 25 Apr 2001 00:00:00 GMT","title":'
+            b'"Am\\u00e9lie \\u007f \\ud83c\\udfac"}],"next":null,'
+            b'"success":true}'))
+
+    @unittest.skipIf(jsonprovider.orjson is None, 'orjson is not installed')
+    def test_orjson_matches_stdlib(self):
+        stdlib = jsonprovider.StdlibProvider()
+        fast = jsonprovider.OrjsonProvider()
+
+        self.assertEqual(fast.dumps(self.document),
+                         stdlib.dumps(self.document))
+        # out of orjson's range, encoded by the fallback
+        self.assertEqual(fast.dumps({'n': 2 ** 70}),
+                         stdlib.dumps({'n': 2 ** 70}))
+
+
+class InsertMissingSQLiteTestCase(unittest.TestCase):
+    """This class represents the insert_missing and get_or_create test
+    cases without RETURNING"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.app = create_app({'RESPONSE_CACHE': 'none'})
+        setup_db(self.app, f'sqlite:///{self.path}')
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        os.remove(self.path)
+
+    def test_row_inserted_meanwhile_is_not_reported(self):
+        items = [{'name': 'Meanwhile', 'age': 30},
+                 {'name': 'Created', 'age': 40}]
+        with self.app.app_context():
+            # committed by another transaction after the lookup
+            db.engine.execute(Actor.__table__.insert(),
+                              name='Meanwhile', age=20)
+            rows = insert_missing(Actor, items, {})
+
+            self.assertEqual([row.name for row in rows], ['Created'])
+
+    def test_row_created_after_lookup_is_found(self):
+        inserted = []
+
+        def concurrent_insert(conn, cursor, statement, *args):
+            if statement.startswith('INSERT OR IGNORE') and not inserted:
+                inserted.append(statement)
+                engine.execute(Actor.__table__.insert(),
+                               name='Meanwhile', age=20)
+
+        with self.app.app_context():
+            engine = db.engine
+            event.listen(engine, 'before_cursor_execute', concurrent_insert)
+            try:
+                rows = get_or_create(Actor, [{'name': 'Meanwhile',
+                                              'age': 30}])
+            finally:
+                event.remove(engine, 'before_cursor_execute',
+                             concurrent_insert)
+
+            self.assertEqual(rows['Meanwhile'].age, 20)
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class represents the read replica routing test cases, with a
+    SQLite file standing in for the replica"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        replica = create_engine(f'sqlite:///{self.path}')
+        db.metadata.create_all(replica)
+        replica.execute(Actor.__table__.insert(), name='Replica Actor',
+                        age=30, gender='F')
+        replica.dispose()
+        self.app = create_app({
+            'DATABASE_REPLICA_URLS': f'sqlite:///{self.path}',
+            'RESPONSE_CACHE': 'none'
+        })
+        self.replicas = self.app.extensions['replicas']
+        self.client = self.app.test_client()
+        setup_db(self.app, 'postgresql:///capstonedb_test')
+        with self.app.app_context():
+            db.create_all()
+            populate_db(db)
+        self.check()
+
+    def check(self):
+        """Run the health check now instead of in the background"""
+        self.replicas.check()
+        self.replicas.next_check = time.monotonic() + 60
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+        self.replicas.dispose()
+        os.remove(self.path)
+
+    def actor_names(self, client=None, role='ASSISTANT'):
+        res = (client or self.client).get('/actors', headers={
+            "Authorization": f'Bearer {tokens[role]}'
+        })
+        self.assertEqual(res.status_code, 200)
+        return [actor['name'] for actor in json.loads(res.data)['actors']]
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.actor_names(), ['Replica Actor'])
+        self.assertEqual(self.replicas.stats()['replica_reads'], 1)
+
+    def test_writer_reads_primary_for_a_while(self):
+        res = self.client.post('/actors', json=new_actor, headers={
+            "Authorization": f'Bearer {tokens["PRODUCER"]}'
+        })
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(new_actor['name'], self.actor_names())
+        self.assertEqual(self.actor_names(self.app.test_client()),
+                         ['Replica Actor'])
+
+    def test_writer_token_reads_primary_without_cookie(self):
+        res = self.client.post('/actors', json=new_actor, headers={
+            "Authorization": f'Bearer {tokens["PRODUCER"]}'
+        })
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(new_actor['name'],
+                      self.actor_names(self.app.test_client(), 'PRODUCER'))
+        self.assertEqual(self.actor_names(self.app.test_client()),
+                         ['Replica Actor'])
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        self.replicas.measure_lag = lambda engine: 60
+        self.check()
+
+        self.assertNotIn('Replica Actor', self.actor_names())
+        self.assertEqual(self.replicas.stats()['primary_reads'], 1)
+
+    def test_check_runs_in_background(self):
+        checked = threading.Event()
+        self.replicas.measure_lag = lambda engine: checked.wait(5) and 60
+        self.replicas.next_check = 0
+
+        # the request doesn't wait for the replica being checked
+        self.assertEqual(self.actor_names(), ['Replica Actor'])
+        checked.set()
+        self.replicas._lock.acquire(timeout=5)
+        self.replicas._lock.release()
+        self.assertEqual(self.replicas.stats()['healthy'], 0)
+
+    def test_failed_replica_falls_back_to_primary(self):
+        os.remove(self.path)
+        os.mkdir(self.path)
+        try:
+            self.check()
+            self.assertNotIn('Replica Actor', self.actor_names())
+        finally:
+            os.rmdir(self.path)
+            open(self.path, 'w').close()
+
 
 if __name__ == '__main__':
     unittest.main()
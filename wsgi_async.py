@@ -0,0 +1,19 @@
+# cooperative entry point, run it with gevent workers:
+#     gunicorn --worker-class gevent --worker-connections 100 wsgi_async:app
+# the patches must run before anything imports socket, ssl or psycopg2
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+from auth import jwks_cache
+from flaskr import create_app
+
+app = create_app()
+# fetch the signing keys in a greenlet instead of in the first request
+jwks_cache.refresh_async()
+
+if __name__ == '__main__':
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(('127.0.0.1', 5000), app).serve_forever()